@@ -17,102 +17,176 @@
 # under the License.
 #
 
-import fortworth as _fortworth
+import asyncio as _asyncio
+import concurrent.futures as _futures
 import logging as _logging
+import mimetypes as _mimetypes
+import multiprocessing as _multiprocessing
 import os as _os
-import requests as _requests
-import requests.exceptions as _requests_exceptions
-import shutil as _shutil
-import threading as _threading
-import time as _time
-import traceback as _traceback
+import signal as _signal
 
+from .blobs import BlobStore, DigestCache, media_types
+from .catalog import Catalog
+from .cleaner import BuildCleaner
+from .dircache import DirectoryCache
+from .filecache import FileCache
 from .httpserver import HttpServer
+from .metrics import MetricsDumpThread, add_collectors, describe_metrics
+from .quotas import Quotas
+from .staging import StagingArea
+from .uploads import UploadSessions
+from .yum import PackageCache
 
 _log = _logging.getLogger("app")
 
 class Application:
-    def __init__(self, home, data_dir=None, http_port=8080):
+    def __init__(self, home, data_dir=None, http_port=8080, io_threads=8, read_size=None,
+                 file_cache_size=64 * 1024 * 1024, workers=1, quotas_file=None):
         self.home = home
         self.data_dir = data_dir
         self.http_port = http_port
+        self.io_threads = io_threads
+        self.workers = workers
+
+        # The chunk size for sending files, if not the default
+        self.read_size = read_size
 
         if self.data_dir is None:
             self.data_dir = _os.path.join(self.home, "data")
 
-        self.builds_dir = _os.path.join(self.data_dir, "builds")
+        for extension, media_type in media_types.items():
+            _mimetypes.add_type(media_type, extension)
 
-        self.cleaner_thread = _BuildCleanerThread(self)
-        self.http_server = HttpServer(self, port=self.http_port)
+        self.builds_dir = _os.path.join(self.data_dir, "builds")
+        self.temp_dir = _os.path.join(self.data_dir, "temp")
+        self.blobs_dir = _os.path.join(self.data_dir, "blobs")
+        self.metrics_dir = _os.path.join(self.data_dir, "metrics")
+        self.uploads_dir = _os.path.join(self.data_dir, "uploads")
+        self.staging_dir = _os.path.join(self.data_dir, "staging")
+        self.packages_dir = _os.path.join(self.data_dir, "packages")
+        self.checksums_dir = _os.path.join(self.data_dir, "checksums")
+
+        self.blob_store = BlobStore(self.blobs_dir, self.temp_dir)
+        self.catalog = Catalog(_os.path.join(self.data_dir, "catalog.db"))
+        self.upload_sessions = UploadSessions(self.uploads_dir)
+        self.staging_area = StagingArea(self.staging_dir, self.builds_dir)
+        self.quotas = Quotas.load(quotas_file) if quotas_file else Quotas()
+        self.package_cache = PackageCache(self.packages_dir)
+        self.checksum_cache = DigestCache(self.checksums_dir)
+
+        # Pending repodata updates, by build
+        self.repodata_timers = dict()
+
+        # Small, frequently requested files are served from memory
+        self.file_cache = FileCache(file_cache_size)
+        self.directory_cache = DirectoryCache()
+
+        # Blocking file I/O for uploads runs here, off the event loop
+        self.io_executor = _futures.ThreadPoolExecutor(io_threads, thread_name_prefix="io")
+
+        # The number of uploads in progress in each worker process, for
+        # deferring cleaner work.  The count of a worker that exits is
+        # reset, since its uploads ended with it.
+        self.upload_counts = _multiprocessing.Array("i", self.workers)
+
+        # The process running the cleaner, for triggering it from others
+        self.cleaner_pid = _multiprocessing.Value("i", 0)
+
+        self.cleaner = BuildCleaner(self)
+        self.http_server = HttpServer(self, port=self.http_port, workers=self.workers)
+
+        self.metrics = self.http_server.metrics
+        describe_metrics(self.metrics)
+        add_collectors(self.metrics, self)
+
+        self.inherited_state = list()
+
+    @property
+    def active_uploads(self):
+        with self.upload_counts.get_lock():
+            return sum(self.upload_counts)
+
+    def start_upload(self):
+        with self.upload_counts.get_lock():
+            self.upload_counts[self.http_server.worker_index] += 1
+
+    def end_upload(self):
+        with self.upload_counts.get_lock():
+            self.upload_counts[self.http_server.worker_index] -= 1
 
     def run(self):
         _logging.basicConfig(level=_logging.DEBUG)
 
-        if not _os.path.exists(self.builds_dir):
-            _os.makedirs(self.builds_dir)
+        for dir in (self.builds_dir, self.temp_dir, self.blobs_dir, self.metrics_dir, self.uploads_dir,
+                    self.staging_dir, self.packages_dir, self.checksums_dir):
+            if not _os.path.exists(dir):
+                _os.makedirs(dir)
 
-        self.cleaner_thread.start()
-        self.http_server.run()
+        # Snapshots from a previous run are not continued
+        for name in _os.listdir(self.metrics_dir):
+            _os.remove(_os.path.join(self.metrics_dir, name))
 
-class _BuildCleanerThread(_threading.Thread):
-    def __init__(self, app):
-        super().__init__()
+        self.catalog.open(self.builds_dir)
 
-        self.app = app
-        self.daemon = True
+        # With several workers, each worker opens its own catalog
+        # connection after the fork
 
-    def run(self):
-        while True:
-            _time.sleep(60)
+        if self.workers > 1:
+            self.catalog.close()
 
+        self.http_server.run()
+
+    # Called in each worker process.  Locks, connections, and caches are
+    # created fresh, so nothing is shared with the parent or the other
+    # workers.  The inherited ones are kept so that their finalizers do
+    # not run in the worker.
+    def init_worker(self):
+        self.inherited_state.extend((self.catalog, self.upload_sessions, self.file_cache,
+                                     self.directory_cache, self.io_executor))
+
+        self.catalog = Catalog(self.catalog.db_file)
+        self.catalog.open(self.builds_dir)
+
+        self.upload_sessions = UploadSessions(self.uploads_dir)
+        self.file_cache = FileCache(self.file_cache.max_bytes)
+        self.directory_cache = DirectoryCache(max_age=1)
+        self.io_executor = _futures.ThreadPoolExecutor(self.io_threads, thread_name_prefix="io")
+
+        self.metrics.reset()
+        MetricsDumpThread(self.metrics, self.metrics_dir).start()
+
+    # Called in the parent process when a worker exits.  The metrics
+    # snapshot of the exited process is removed, so it is not counted
+    # alongside that of its replacement.
+    def reset_worker(self, index, pid):
+        with self.upload_counts.get_lock():
+            self.upload_counts[index] = 0
+
+        for name in (f"{pid}.json", f"{pid}.json.temp"):
             try:
-                self.clean_builds()
-            except KeyboardInterrupt:
-                raise
-            except Exception:
-                _traceback.print_exc()
+                _os.remove(_os.path.join(self.metrics_dir, name))
+            except FileNotFoundError:
+                pass
 
-    def clean_builds(self):
-        _log.info("Cleaning builds")
+    # Called on the event loop of the serving process that runs the
+    # cleaner.  Other processes trigger it with a signal.
+    def start_cleaner(self):
+        loop = _asyncio.get_running_loop()
+        loop.add_signal_handler(_signal.SIGUSR1, self.cleaner.trigger)
 
-        try:
-            data = _fortworth.stagger_get_data()
-        except _requests_exceptions.ConnectionError as e:
-            _log.warn(f"Failed connecting to Stagger: {e}")
+        self.cleaner_pid.value = _os.getpid()
+
+        return loop.create_task(self.cleaner.run())
+
+    def trigger_cleaner(self):
+        if not self.cleaner_pid.value:
             return
 
-        for repo_id in _os.listdir(self.app.builds_dir):
-            repo_dir = _os.path.join(self.app.builds_dir, repo_id)
-
-            for branch_id in _os.listdir(repo_dir):
-                branch_dir = _os.path.join(repo_dir, branch_id)
-
-                for build_id in _os.listdir(branch_dir):
-                    build_dir = _os.path.join(branch_dir, build_id)
-                    fq_build_id = f"{repo_id}/{branch_id}/{build_id}"
-
-                    _log.info(f"Considering build {fq_build_id} for deletion")
-
-                    if _time.time() - _os.path.getmtime(build_dir) < 60 * 60:
-                        _log.info("  The build was recently added; leaving it")
-                        continue
-                    else:
-                        _log.info("  The build is old enough to go to the next check")
-
-                    try:
-                        tags = data["repos"][repo_id]["branches"][branch_id]["tags"]
-                    except KeyError:
-                        _log.info(f"  The build has no tags (1); deleting it")
-                        _shutil.rmtree(build_dir, ignore_errors=True)
-                        continue
-
-                    for key, value in tags.items():
-                        if value.get("build_id") == build_id:
-                            _log.info("  The build has a tag; leaving it")
-                            break
-                    else:
-                        _log.info("  The build has no tags (2); deleting it")
-                        _shutil.rmtree(build_dir, ignore_errors=True)
+        # The cleaner process may be restarting
+        try:
+            _os.kill(self.cleaner_pid.value, _signal.SIGUSR1)
+        except ProcessLookupError:
+            pass
 
 if __name__ == "__main__":
     app = Application(_os.getcwd())
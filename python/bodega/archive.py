@@ -0,0 +1,180 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import os as _os
+import tarfile as _tarfile
+import time as _time
+import zipfile as _zipfile
+import zlib as _zlib
+
+from .blobs import is_compressible
+
+# Format name to media type and file extension
+archive_formats = {
+    "tar": ("application/x-tar", ".tar"),
+    "tar.gz": ("application/gzip", ".tar.gz"),
+    "zip": ("application/zip", ".zip"),
+}
+
+_chunk_size = 1024 * 1024
+
+# The earliest time a zip entry can record
+_zip_epoch = 315532800 + 86400
+
+# The archive content follows from the file paths and digests, so the
+# manifest digest of the build identifies it
+def archive_etag(manifest_digest, format):
+    return f'"{manifest_digest}-{format}"'
+
+# Yields the archive of a build dir in pieces of about one chunk.  File
+# data is read a chunk at a time and each piece is produced only when
+# the consumer asks for it, so memory use does not grow with the build.
+def generate_archive(build_dir, format):
+    assert format in archive_formats, format
+
+    files = _list_files(build_dir)
+
+    if format == "zip":
+        return _generate_zip(files)
+
+    chunks = _generate_tar(files)
+
+    if format == "tar.gz":
+        chunks = _compress(chunks)
+
+    return _coalesce(chunks)
+
+def _list_files(build_dir):
+    for root, dirs, names in _os.walk(build_dir):
+        dirs.sort()
+
+        for name in sorted(names):
+            fs_path = _os.path.join(root, name)
+            yield fs_path, _os.path.relpath(fs_path, build_dir)
+
+# Writes the tar stream directly, so file content passes through in
+# chunks instead of being copied by tarfile in one call
+def _generate_tar(files):
+    total = 0
+
+    for fs_path, path in files:
+        with open(fs_path, "rb") as f:
+            stat_result = _os.fstat(f.fileno())
+
+            info = _tarfile.TarInfo(path)
+            info.size = stat_result.st_size
+            info.mtime = int(stat_result.st_mtime)
+            info.mode = stat_result.st_mode & 0o777
+
+            header = info.tobuf(_tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            yield header
+
+            remaining = info.size
+
+            while remaining:
+                chunk = f.read(min(_chunk_size, remaining))
+
+                if not chunk:
+                    raise OSError(f"File changed while archiving: {fs_path}")
+
+                remaining -= len(chunk)
+                yield chunk
+
+        padding = -info.size % _tarfile.BLOCKSIZE
+        total += len(header) + info.size + padding
+
+        yield bytes(padding)
+
+    total += 2 * _tarfile.BLOCKSIZE
+
+    yield bytes(2 * _tarfile.BLOCKSIZE + -total % _tarfile.RECORDSIZE)
+
+def _compress(chunks):
+    compressor = _zlib.compressobj(6, _zlib.DEFLATED, 16 + _zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+def _coalesce(chunks):
+    buffer = bytearray()
+
+    for chunk in chunks:
+        buffer += chunk
+
+        if len(buffer) >= _chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+
+    if buffer:
+        yield bytes(buffer)
+
+# Zipfile writes to an unseekable stream using data descriptors.  Files
+# that are already compressed are stored.
+def _generate_zip(files):
+    sink = _ZipSink()
+
+    with _zipfile.ZipFile(sink, "w") as zip_file:
+        for fs_path, path in files:
+            with open(fs_path, "rb") as f:
+                stat_result = _os.fstat(f.fileno())
+
+                info = _zipfile.ZipInfo(path, _time.localtime(max(stat_result.st_mtime, _zip_epoch))[:6])
+                info.external_attr = (stat_result.st_mode & 0xFFFF) << 16
+                info.file_size = stat_result.st_size
+
+                if is_compressible(path):
+                    info.compress_type = _zipfile.ZIP_DEFLATED
+
+                with zip_file.open(info, "w") as entry:
+                    while True:
+                        chunk = f.read(_chunk_size)
+
+                        if not chunk:
+                            break
+
+                        entry.write(chunk)
+
+                        if len(sink.buffer) >= _chunk_size:
+                            yield sink.take()
+
+            if len(sink.buffer) >= _chunk_size:
+                yield sink.take()
+
+    yield sink.take()
+
+class _ZipSink:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
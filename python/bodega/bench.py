@@ -0,0 +1,221 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import argparse as _argparse
+import multiprocessing as _multiprocessing
+import os as _os
+import requests as _requests
+import threading as _threading
+import time as _time
+
+from plano import *
+
+from .tests import TestServer
+
+_chunk = bytes(1024 * 1024)
+
+def main():
+    parser = _argparse.ArgumentParser(prog="bodega-bench")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    upload_latency = subparsers.add_parser("upload-latency",
+                                           help="GET latency while large uploads are running")
+    upload_latency.add_argument("--uploads", type=int, default=4, metavar="COUNT",
+                                help="Concurrent uploads (default 4)")
+    upload_latency.add_argument("--size", type=float, default=2, metavar="GB",
+                                help="Size of each upload (default 2)")
+    upload_latency.set_defaults(func=bench_upload_latency)
+
+    download_throughput = subparsers.add_parser("download-throughput",
+                                                help="Download throughput and server CPU per GB")
+    download_throughput.add_argument("--downloads", type=int, default=4, metavar="COUNT",
+                                     help="Concurrent downloads (default 4)")
+    download_throughput.add_argument("--size", type=float, default=0.5, metavar="GB",
+                                     help="Size of the downloaded file (default 0.5)")
+    download_throughput.add_argument("--rounds", type=int, default=4, metavar="COUNT",
+                                     help="Downloads per client (default 4)")
+    download_throughput.set_defaults(func=bench_download_throughput)
+
+    request_throughput = subparsers.add_parser("request-throughput",
+                                               help="Small-file GET requests per second by worker count")
+    request_throughput.add_argument("--workers", default="1,2,4", metavar="COUNTS",
+                                    help="Comma-separated server worker counts (default 1,2,4)")
+    request_throughput.add_argument("--clients", type=int, default=8, metavar="COUNT",
+                                    help="Concurrent client processes (default 8)")
+    request_throughput.add_argument("--duration", type=float, default=10, metavar="SECONDS",
+                                    help="Time to run at each worker count (default 10)")
+    request_throughput.set_defaults(func=bench_request_throughput)
+
+    args = parser.parse_args()
+
+    enable_logging(level="error")
+
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        pass
+
+def bench_upload_latency(args):
+    upload_size = int(args.size * 1024 ** 3)
+
+    with TestServer() as server:
+        build_url = f"{server.http_url}/bench/main/1"
+        small_url = f"{build_url}/repodata/repomd.xml"
+
+        _requests.put(small_url, data=b"<repomd/>\n").raise_for_status()
+
+        def upload(index):
+            def body():
+                for i in range(upload_size // len(_chunk)):
+                    yield _chunk
+
+            _requests.put(f"{build_url}/large-{index}.bin", data=body()).raise_for_status()
+
+        uploads = [_threading.Thread(target=upload, args=(i,)) for i in range(args.uploads)]
+        session = _requests.Session()
+        latencies = list()
+        start = _time.time()
+
+        for thread in uploads:
+            thread.start()
+
+        while any(x.is_alive() for x in uploads):
+            for url in (small_url, f"{server.http_url}/healthz"):
+                request_start = _time.perf_counter()
+                session.get(url).raise_for_status()
+                latencies.append(_time.perf_counter() - request_start)
+
+            _time.sleep(0.01)
+
+        for thread in uploads:
+            thread.join()
+
+        elapsed = _time.time() - start
+
+    total_gb = args.uploads * upload_size / 1024 ** 3
+
+    print(f"Uploaded {total_gb:.1f} GB in {elapsed:.1f} s ({total_gb / elapsed:.2f} GB/s)")
+    _print_latencies(latencies)
+
+# Compares the previous 64 KiB read path with the default one
+def bench_download_throughput(args):
+    file_size = int(args.size * 1024 ** 3)
+
+    print(f"{'read size':>10} {'GB/s':>8} {'CPU s/GB':>9}")
+
+    for read_size in (64 * 1024, None):
+        env = dict()
+
+        if read_size is not None:
+            env["BODEGA_READ_SIZE"] = read_size
+
+        with TestServer(**env) as server:
+            file_url = f"{server.http_url}/bench/main/1/large.bin"
+
+            def body():
+                for i in range(file_size // len(_chunk)):
+                    yield _chunk
+
+            _requests.put(file_url, data=body()).raise_for_status()
+
+            def download():
+                session = _requests.Session()
+
+                for i in range(args.rounds):
+                    with session.get(file_url, stream=True) as response:
+                        response.raise_for_status()
+
+                        for chunk in response.iter_content(1024 * 1024):
+                            pass
+
+            downloads = [_threading.Thread(target=download) for i in range(args.downloads)]
+            start_cpu = _process_cpu_time(server.pid)
+            start = _time.time()
+
+            for thread in downloads:
+                thread.start()
+
+            for thread in downloads:
+                thread.join()
+
+            elapsed = _time.time() - start
+            cpu = _process_cpu_time(server.pid) - start_cpu
+
+        total_gb = args.downloads * args.rounds * file_size / 1024 ** 3
+        label = "default" if read_size is None else f"{read_size // 1024} KiB"
+
+        print(f"{label:>10} {total_gb / elapsed:8.2f} {cpu / total_gb:9.2f}")
+
+# Clients are separate processes so the client side does not become the
+# bottleneck before the server does
+def bench_request_throughput(args):
+    print(f"{'workers':>8} {'requests/s':>11} {'p99 ms':>7}")
+
+    for workers in [int(x) for x in args.workers.split(",")]:
+        with TestServer(BODEGA_WORKERS=workers) as server:
+            build_url = f"{server.http_url}/bench/main/1"
+            urls = [f"{build_url}/repodata/repomd.xml", f"{build_url}/maven-metadata.xml",
+                    f"{build_url}/dir1", build_url]
+
+            _requests.put(urls[0], data=b"<repomd/>\n" * 100).raise_for_status()
+            _requests.put(urls[1], data=b"<metadata/>\n" * 100).raise_for_status()
+            _requests.put(f"{build_url}/dir1/file.txt", data=b"x" * 4096).raise_for_status()
+
+            with _multiprocessing.Pool(args.clients) as pool:
+                results = pool.starmap(_request_loop, [(urls, args.duration)] * args.clients)
+
+        count = sum(len(x) for x in results)
+        latencies = sorted(x for result in results for x in result)
+        p99 = _percentile(latencies, 0.99) * 1000
+
+        print(f"{workers:>8} {count / args.duration:11.0f} {p99:7.1f}")
+
+def _request_loop(urls, duration):
+    session = _requests.Session()
+    latencies = list()
+    end = _time.time() + duration
+
+    while _time.time() < end:
+        for url in urls:
+            start = _time.perf_counter()
+            session.get(url).raise_for_status()
+            latencies.append(_time.perf_counter() - start)
+
+    return latencies
+
+def _process_cpu_time(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / _os.sysconf("SC_CLK_TCK")
+
+def _print_latencies(latencies):
+    latencies = sorted(latencies)
+
+    print(f"GET requests: {len(latencies)}")
+
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        value = _percentile(latencies, fraction)
+        print(f"GET {name}: {value * 1000:.1f} ms")
+
+    print(f"GET max: {latencies[-1] * 1000:.1f} ms")
+
+def _percentile(values, fraction):
+    index = min(len(values) - 1, int(len(values) * fraction))
+    return values[index]
@@ -0,0 +1,372 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import base64 as _base64
+import contextlib as _contextlib
+import fcntl as _fcntl
+import gzip as _gzip
+import hashlib as _hashlib
+import json as _json
+import logging as _logging
+import mimetypes as _mimetypes
+import os as _os
+import re as _re
+import shutil as _shutil
+import time as _time
+import uuid as _uuid
+
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
+_log = _logging.getLogger("blobs")
+
+# Precompressed variants are stored next to the blob, by content coding
+_encodings = {"zstd": ".zst", "gzip": ".gz"} if _zstandard else {"gzip": ".gz"}
+
+# Larger files are compressed on request instead of at upload
+_variant_max_size = 64 * 1024 * 1024
+
+# Smaller files are not worth compressing
+compress_min_size = 1024
+
+_chunk_size = 1024 * 1024
+
+_compressed_extensions = {
+    ".bz2", ".gz", ".iso", ".jar", ".jpg", ".png", ".rpm", ".tgz", ".war", ".xz", ".zip", ".zst",
+}
+
+# Build file types missing from the system tables.  The application
+# registers them with mimetypes at startup.
+media_types = {
+    ".log": "text/plain",
+    ".md": "text/plain",
+    ".md5": "text/plain",
+    ".pom": "text/xml",
+    ".repo": "text/plain",
+    ".sha1": "text/plain",
+    ".sha256": "text/plain",
+    ".spec": "text/plain",
+}
+
+def is_compressible(path):
+    extension = _os.path.splitext(path)[1].lower()
+
+    if extension in _compressed_extensions:
+        return False
+
+    media_type = _mimetypes.guess_type(path)[0]
+
+    if media_type is None:
+        return False
+
+    return media_type.startswith("text/") or media_type.endswith(("/xml", "+xml", "/json", "+json", "/javascript"))
+
+_digest_regex = _re.compile("[0-9a-f]{64}")
+
+def is_digest(value):
+    return isinstance(value, str) and _digest_regex.fullmatch(value) is not None
+
+# The validator and Digest headers for a file with the given SHA-256
+# digest.  The ETag is strong, since the digest identifies the bytes.
+def digest_headers(digest):
+    value = _base64.b64encode(bytes.fromhex(digest)).decode()
+    return {"etag": f'"{digest}"', "digest": f"sha-256={value}"}
+
+# Raised when content does not match a digest supplied by the client
+class DigestMismatchError(Exception):
+    def __init__(self, algorithm):
+        super().__init__(f"The content does not match the {algorithm} digest")
+        self.algorithm = algorithm
+
+# Content-addressed file storage.  Each blob is stored once under its
+# SHA-256 digest, and build files are hard links to it.  The link
+# count of a blob is its reference count: a blob with one link is
+# referenced by no build and can be collected.
+
+class BlobStore:
+    encodings = _encodings
+
+    def __init__(self, blobs_dir, temp_dir):
+        self.blobs_dir = blobs_dir
+        self.temp_dir = temp_dir
+
+        # Held shared while a blob is refreshed and exclusive while
+        # garbage collection decides to remove it
+        self.lock_file = f"{blobs_dir}.lock"
+
+    def blob_path(self, digest):
+        return _os.path.join(self.blobs_dir, digest[:2], digest)
+
+    def exists(self, digest):
+        return _os.path.exists(self.blob_path(digest))
+
+    def variant_path(self, digest, encoding):
+        return self.blob_path(digest) + self.encodings[encoding]
+
+    # Writes the compressed variants of a blob, if they are worthwhile
+    # and do not exist yet.  The path is that of a file with the blob's
+    # content, for its type.  This is slow for large blobs, so callers
+    # submit it to the I/O executor.
+    def write_variants(self, digest, path):
+        blob_path = self.blob_path(digest)
+        size = _os.path.getsize(blob_path)
+
+        if size < compress_min_size or size > _variant_max_size or not is_compressible(path):
+            return
+
+        for encoding in self.encodings:
+            variant_path = self.variant_path(digest, encoding)
+
+            if _os.path.exists(variant_path):
+                continue
+
+            temp_path = _os.path.join(self.temp_dir, f"{_uuid.uuid4()}.variant")
+
+            with open(blob_path, "rb") as input, open(temp_path, "wb") as output:
+                _compress(input, output, encoding)
+
+            # A variant that does not save space is not kept
+            if _os.path.getsize(temp_path) >= size:
+                _os.remove(temp_path)
+                continue
+
+            _os.rename(temp_path, variant_path)
+
+    def blob_size(self, digest):
+        try:
+            return _os.path.getsize(self.blob_path(digest))
+        except FileNotFoundError:
+            return None
+
+    # Returns the size of the blob, or None if the store does not have
+    # it.  The change time of the blob is updated, so garbage
+    # collection keeps it until it is linked.
+    def refresh(self, digest):
+        blob_path = self.blob_path(digest)
+
+        with self._lock(_fcntl.LOCK_SH):
+            try:
+                return _touch(blob_path).st_size
+            except FileNotFoundError:
+                return None
+
+    def open_writer(self, md5=False):
+        return BlobWriter(self, md5)
+
+    # Moves a file with the given digest into the store.  If the store
+    # already has the blob, the file is removed and the blob refreshed.
+    def add(self, temp_path, digest):
+        blob_path = self.blob_path(digest)
+
+        _os.chmod(temp_path, 0o444)
+        _os.makedirs(_os.path.dirname(blob_path), exist_ok=True)
+
+        with self._lock(_fcntl.LOCK_SH):
+            try:
+                _os.link(temp_path, blob_path)
+            except FileExistsError:
+                _touch(blob_path)
+            finally:
+                _os.remove(temp_path)
+
+    def link(self, digest, fs_path):
+        temp_path = f"{fs_path}.{_uuid.uuid4()}.temp"
+
+        _os.makedirs(_os.path.dirname(fs_path), exist_ok=True)
+        _os.link(self.blob_path(digest), temp_path)
+
+        try:
+            _os.rename(temp_path, fs_path)
+        except OSError:
+            _os.remove(temp_path)
+            raise
+
+    def collect_garbage(self, min_age=60 * 60):
+        # The change time of a blob moves whenever a link is added or
+        # removed or the blob is refreshed, so recently published,
+        # released, or reused blobs are kept for a while
+
+        count = 0
+        size = 0
+        now = _time.time()
+
+        for prefix in _os.listdir(self.blobs_dir):
+            prefix_dir = _os.path.join(self.blobs_dir, prefix)
+
+            with self._lock(_fcntl.LOCK_EX):
+                for name in _os.listdir(prefix_dir):
+                    if not is_digest(name):
+                        continue
+
+                    blob_path = _os.path.join(prefix_dir, name)
+
+                    try:
+                        stat = _os.stat(blob_path)
+                    except FileNotFoundError:
+                        continue
+
+                    if stat.st_nlink > 1 or now - stat.st_ctime < min_age:
+                        continue
+
+                    _os.remove(blob_path)
+
+                    for suffix in self.encodings.values():
+                        try:
+                            _os.remove(blob_path + suffix)
+                        except FileNotFoundError:
+                            pass
+
+                    count += 1
+                    size += stat.st_size
+
+        if count:
+            _log.info(f"Collected {count} unreferenced blobs ({size} bytes)")
+
+        return count, size
+
+    # The lock is taken on a new descriptor each time, since flock
+    # locks belong to the open file and the threads of a process would
+    # otherwise share one
+    @_contextlib.contextmanager
+    def _lock(self, operation):
+        fd = _os.open(self.lock_file, _os.O_RDONLY | _os.O_CREAT, 0o644)
+
+        try:
+            _fcntl.flock(fd, operation)
+            yield
+        finally:
+            _os.close(fd)
+
+# Data is hashed as it is written, so the digest is ready at commit.  An
+# MD5 hash is kept as well if the client supplied an MD5 digest.
+class BlobWriter:
+    def __init__(self, store, md5=False):
+        self.store = store
+        self.temp_path = _os.path.join(store.temp_dir, f"{_uuid.uuid4()}.blob")
+        self.file = open(self.temp_path, "wb")
+        self.hash = _hashlib.sha256()
+        self.md5_hash = _hashlib.md5() if md5 else None
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+
+        if self.md5_hash is not None:
+            self.md5_hash.update(data)
+
+        self.file.write(data)
+        self.size += len(data)
+
+    # Expected is a map of "sha-256" or "md5" to a hex digest.  Raises
+    # DigestMismatchError if the data does not match.
+    def verify(self, expected):
+        hashes = {"sha-256": self.hash, "md5": self.md5_hash}
+
+        for algorithm, digest in expected.items():
+            if hashes[algorithm].hexdigest() != digest:
+                raise DigestMismatchError(algorithm)
+
+    def commit(self):
+        self.file.close()
+
+        digest = self.hash.hexdigest()
+        self.store.add(self.temp_path, digest)
+
+        return digest
+
+    def abort(self):
+        self.file.close()
+
+        try:
+            _os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+# Details derived from blob content, such as package headers and
+# checksums, stored as JSON files by digest.  Entries are computed once
+# and removed after the store no longer has the blob.
+class DigestCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    # Returns the cached value, or else the value of func(*args),
+    # which is cached unless it is None
+    def get(self, digest, func, *args):
+        cache_file = self._cache_file(digest)
+
+        try:
+            with open(cache_file) as f:
+                return _json.load(f)
+        except FileNotFoundError:
+            pass
+
+        value = func(*args)
+
+        if value is None:
+            return None
+
+        temp_file = f"{cache_file}.{_uuid.uuid4()}.temp"
+
+        _os.makedirs(_os.path.dirname(cache_file), exist_ok=True)
+
+        with open(temp_file, "w") as f:
+            _json.dump(value, f)
+
+        _os.rename(temp_file, cache_file)
+
+        return value
+
+    # Removes entries for blobs the store no longer has.  Returns the
+    # count of removed entries.
+    def collect_garbage(self, store):
+        count = 0
+
+        for prefix in _os.listdir(self.cache_dir):
+            prefix_dir = _os.path.join(self.cache_dir, prefix)
+
+            for name in _os.listdir(prefix_dir):
+                digest = name.removesuffix(".json")
+
+                if name.endswith(".json") and not store.exists(digest):
+                    _os.remove(_os.path.join(prefix_dir, name))
+                    count += 1
+
+        return count
+
+    def _cache_file(self, digest):
+        return _os.path.join(self.cache_dir, digest[:2], f"{digest}.json")
+
+# Updates the change time and leaves the modification time, which
+# archives record
+def _touch(path):
+    stat = _os.stat(path)
+    _os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return stat
+
+# Compresses the input file to the output file a chunk at a time
+def _compress(input, output, encoding):
+    if encoding == "gzip":
+        with _gzip.GzipFile("", "wb", 9, output) as stream:
+            _shutil.copyfileobj(input, stream, _chunk_size)
+    elif encoding == "zstd":
+        _zstandard.ZstdCompressor(level=12).copy_stream(input, output, read_size=_chunk_size)
+    else:
+        raise Exception(f"Unknown encoding: {encoding}")
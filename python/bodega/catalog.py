@@ -0,0 +1,379 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import collections as _collections
+import hashlib as _hashlib
+import logging as _logging
+import os as _os
+import sqlite3 as _sqlite3
+import threading as _threading
+import time as _time
+
+_log = _logging.getLogger("catalog")
+
+_schema = """
+create table if not exists builds (
+    repo text not null,
+    branch text not null,
+    build text not null,
+    created real not null,
+    file_count integer not null,
+    total_bytes integer not null,
+    accessed real not null,
+    primary key (repo, branch, build)
+);
+
+create index if not exists builds_created on builds (created);
+
+create table if not exists files (
+    repo text not null,
+    branch text not null,
+    build text not null,
+    path text not null,
+    size integer not null,
+    sha256 text,
+    primary key (repo, branch, build, path)
+);
+
+create table if not exists build_manifests (
+    repo text not null,
+    branch text not null,
+    build text not null,
+    sha256 text not null,
+    primary key (repo, branch, build)
+);
+
+create table if not exists staged_files (
+    repo text not null,
+    branch text not null,
+    build text not null,
+    path text not null,
+    size integer not null,
+    sha256 text,
+    primary key (repo, branch, build, path)
+);
+"""
+
+Build = _collections.namedtuple("Build", ("repo", "branch", "build", "created", "file_count",
+                                          "total_bytes", "accessed"))
+
+# Access times are written at most this often per build
+_access_interval = 60
+
+# The most builds whose last access time is remembered
+_access_times_max = 10000
+
+# A record of the builds and build files under the builds dir,
+# maintained as uploads complete and builds are deleted
+class Catalog:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = _threading.Lock()
+        self.conn = None
+        self.access_times = _collections.OrderedDict()
+
+    def open(self, builds_dir):
+        created = not _os.path.exists(self.db_file)
+
+        self.conn = _sqlite3.connect(self.db_file, timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self.conn.execute("pragma journal_mode = wal")
+        self.conn.execute("pragma synchronous = normal")
+        self.conn.executescript(_schema)
+
+        if created:
+            self.import_builds(builds_dir)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
+    def import_builds(self, builds_dir):
+        _log.info(f"Importing existing builds from {builds_dir}")
+
+        for repo in _list_dirs(builds_dir):
+            for branch in _list_dirs(_os.path.join(builds_dir, repo)):
+                for build in _list_dirs(_os.path.join(builds_dir, repo, branch)):
+                    build_dir = _os.path.join(builds_dir, repo, branch, build)
+                    created = _os.path.getmtime(build_dir)
+                    files = list()
+
+                    for root, dirs, names in _os.walk(build_dir):
+                        for name in names:
+                            fs_path = _os.path.join(root, name)
+                            path = _os.path.relpath(fs_path, build_dir)
+
+                            files.append((path, _os.path.getsize(fs_path), None))
+
+                    self.add_build(repo, branch, build, files, created=created)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def add_file(self, repo, branch, build, path, size, digest):
+        now = _time.time()
+        key = (repo, branch, build)
+
+        with self.lock, self.conn:
+            self.conn.execute("begin immediate")
+
+            old = self.conn.execute("select size from files where repo = ? and branch = ? and build = ? and path = ?",
+                                    key + (path,)).fetchone()
+
+            count_delta = 0 if old else 1
+            size_delta = size - (old[0] if old else 0)
+
+            self.conn.execute("insert or replace into files values (?, ?, ?, ?, ?, ?)",
+                              key + (path, size, digest))
+            self.conn.execute("delete from build_manifests where repo = ? and branch = ? and build = ?", key)
+            self.conn.execute("insert into builds values (?, ?, ?, ?, 1, ?, ?) "
+                              "on conflict (repo, branch, build) do update set "
+                              "file_count = file_count + ?, total_bytes = total_bytes + ?",
+                              key + (now, size, now, count_delta, size_delta))
+
+    def remove_file(self, repo, branch, build, path):
+        key = (repo, branch, build)
+
+        with self.lock, self.conn:
+            self.conn.execute("begin immediate")
+
+            old = self.conn.execute("select size from files where repo = ? and branch = ? and build = ? and path = ?",
+                                    key + (path,)).fetchone()
+
+            if old is None:
+                return
+
+            self.conn.execute("delete from files where repo = ? and branch = ? and build = ? and path = ?",
+                              key + (path,))
+            self.conn.execute("delete from build_manifests where repo = ? and branch = ? and build = ?", key)
+            self.conn.execute("update builds set file_count = file_count - 1, total_bytes = total_bytes - ? "
+                              "where repo = ? and branch = ? and build = ?", (old[0],) + key)
+
+    # Files is a sequence of (path, size, digest) tuples
+    def add_build(self, repo, branch, build, files, created=None):
+        now = _time.time()
+        key = (repo, branch, build)
+
+        if created is None:
+            created = now
+
+        with self.lock, self.conn:
+            self.conn.execute("begin immediate")
+
+            self.conn.executemany("insert or replace into files values (?, ?, ?, ?, ?, ?)",
+                                  (key + tuple(x) for x in files))
+            self.conn.execute("delete from build_manifests where repo = ? and branch = ? and build = ?", key)
+            self.conn.execute("insert or replace into builds values (?, ?, ?, ?, ?, ?, ?)",
+                              key + (created, len(files), sum(x[1] for x in files), now))
+
+    def add_staged_file(self, repo, branch, build, path, size, digest):
+        self._execute("insert or replace into staged_files values (?, ?, ?, ?, ?, ?)",
+                      (repo, branch, build, path, size, digest))
+
+    def remove_staged_file(self, repo, branch, build, path):
+        self._execute("delete from staged_files where repo = ? and branch = ? and build = ? and path = ?",
+                      (repo, branch, build, path))
+
+    # Moves the staged files of a build into the build records, in one
+    # transaction
+    def commit_staged_build(self, repo, branch, build):
+        now = _time.time()
+        key = (repo, branch, build)
+        where = "where repo = ? and branch = ? and build = ?"
+
+        with self.lock, self.conn:
+            self.conn.execute("begin immediate")
+
+            count, size = self.conn.execute(f"select count(*), coalesce(sum(size), 0) from staged_files {where}",
+                                            key).fetchone()
+
+            self.conn.execute(f"insert or replace into files select * from staged_files {where}", key)
+            self.conn.execute(f"delete from build_manifests {where}", key)
+            self.conn.execute("insert or replace into builds values (?, ?, ?, ?, ?, ?, ?)",
+                              key + (now, count, size, now))
+            self.conn.execute(f"delete from staged_files {where}", key)
+
+    def remove_staged_build(self, repo, branch, build):
+        self._execute("delete from staged_files where repo = ? and branch = ? and build = ?",
+                      (repo, branch, build))
+
+    def list_staged_builds(self):
+        return self._execute("select distinct repo, branch, build from staged_files")
+
+    def remove_build(self, repo, branch, build):
+        key = (repo, branch, build)
+
+        with self.lock, self.conn:
+            self.conn.execute("begin immediate")
+
+            self.conn.execute("delete from files where repo = ? and branch = ? and build = ?", key)
+            self.conn.execute("delete from builds where repo = ? and branch = ? and build = ?", key)
+            self.conn.execute("delete from build_manifests where repo = ? and branch = ? and build = ?", key)
+
+            self.access_times.pop(key, None)
+
+    # Recent access times are kept only for builds that exist, in LRU
+    # order, up to a limit
+    def touch_build(self, repo, branch, build):
+        now = _time.time()
+        key = (repo, branch, build)
+
+        with self.lock:
+            if now - self.access_times.get(key, 0) < _access_interval:
+                return
+
+            cursor = self.conn.execute("update builds set accessed = ? where repo = ? and branch = ? and build = ?",
+                                       (now,) + key)
+
+            if cursor.rowcount == 0:
+                return
+
+            self.access_times[key] = now
+            self.access_times.move_to_end(key)
+
+            if len(self.access_times) > _access_times_max:
+                self.access_times.popitem(last=False)
+
+    def get_build(self, repo, branch, build):
+        records = self._execute("select * from builds where repo = ? and branch = ? and build = ?",
+                                (repo, branch, build))
+
+        if records:
+            return Build(*records[0])
+
+    def get_file_digest(self, repo, branch, build, path):
+        records = self._execute("select sha256 from files where repo = ? and branch = ? and build = ? and path = ?",
+                                (repo, branch, build, path))
+
+        if records:
+            return records[0][0]
+
+    # Returns the SHA-256 digest of the build's manifest: the lines
+    # "{file digest}  {path}\n" for its files, in order of path, as
+    # sha256sum prints them.  Returns None if a file has no digest.  The
+    # result is stored until the build changes.
+    def get_manifest_digest(self, repo, branch, build):
+        key = (repo, branch, build)
+        where = "where repo = ? and branch = ? and build = ?"
+
+        # A stored digest is read without taking the write lock
+
+        records = self._execute(f"select sha256 from build_manifests {where}", key)
+
+        if records:
+            return records[0][0]
+
+        with self.lock, self.conn:
+            self.conn.execute("begin immediate")
+
+            record = self.conn.execute(f"select sha256 from build_manifests {where}", key).fetchone()
+
+            if record:
+                return record[0]
+
+            hash = _hashlib.sha256()
+
+            for path, digest in self.conn.execute(f"select path, sha256 from files {where} order by path", key):
+                if digest is None:
+                    return None
+
+                hash.update(f"{digest}  {path}\n".encode())
+
+            self.conn.execute("insert into build_manifests values (?, ?, ?, ?)", key + (hash.hexdigest(),))
+
+            return hash.hexdigest()
+
+    # Returns (path, size, digest) tuples for the files of the build, or
+    # of the staged build
+    def get_build_files(self, repo, branch, build, staged=False):
+        table = "staged_files" if staged else "files"
+
+        return self._execute(f"select path, size, sha256 from {table} where repo = ? and branch = ? and build = ?",
+                             (repo, branch, build))
+
+    # Returns a map of file name to digest for the files directly under
+    # dir_path in the build
+    def get_file_digests(self, repo, branch, build, dir_path):
+        records = self._execute("select path, sha256 from files where repo = ? and branch = ? and build = ?",
+                                (repo, branch, build))
+
+        return {_os.path.basename(x[0]): x[1] for x in records if _os.path.dirname(x[0]) == dir_path}
+
+    # Returns up to limit builds created before the given time, in order
+    # of creation, starting after the build at cursor
+    def list_builds_page(self, created_before, cursor=None, limit=1000):
+        if cursor is None:
+            cursor = (0, "", "", "")
+        else:
+            cursor = (cursor.created, cursor.repo, cursor.branch, cursor.build)
+
+        records = self._execute("select * from builds where created < ? "
+                                "and (created, repo, branch, build) > (?, ?, ?, ?) "
+                                "order by created, repo, branch, build limit ?",
+                                (created_before,) + cursor + (limit,))
+
+        return [Build(*x) for x in records]
+
+    # Returns the build count and total bytes of a repo, or of one branch
+    # of it.  The bytes include staged files.
+    def get_usage(self, repo, branch=None):
+        if branch is None:
+            where, params = "where repo = ?", (repo,)
+        else:
+            where, params = "where repo = ? and branch = ?", (repo, branch)
+
+        with self.lock:
+            count, size = self.conn.execute(f"select count(*), coalesce(sum(total_bytes), 0) from builds {where}",
+                                            params).fetchone()
+            staged_size, = self.conn.execute(f"select coalesce(sum(size), 0) from staged_files {where}",
+                                             params).fetchone()
+
+        return count, size + staged_size
+
+    # Returns (repo, branch, build count, total bytes) tuples
+    def get_branch_usage(self):
+        return self._execute("select repo, branch, count(*), sum(total_bytes) from builds "
+                             "group by repo, branch order by repo, branch")
+
+    # Returns (repo, build count, total bytes) tuples
+    def get_repo_usage(self):
+        return self._execute("select repo, count(*), sum(total_bytes) from builds group by repo order by repo")
+
+    def list_repos(self):
+        return [x[0] for x in self._execute("select distinct repo from builds order by repo")]
+
+    def list_branches(self, repo):
+        records = self._execute("select distinct branch from builds where repo = ? order by branch",
+                                (repo,))
+        return [x[0] for x in records]
+
+    def list_build_ids(self, repo, branch):
+        records = self._execute("select build from builds where repo = ? and branch = ? order by build",
+                                (repo, branch))
+        return [x[0] for x in records]
+
+    def list_branch_builds(self, repo, branch):
+        records = self._execute("select * from builds where repo = ? and branch = ? order by build",
+                                (repo, branch))
+        return [Build(*x) for x in records]
+
+def _list_dirs(dir):
+    return [x for x in _os.listdir(dir) if _os.path.isdir(_os.path.join(dir, x))]
@@ -0,0 +1,272 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import asyncio as _asyncio
+import concurrent.futures as _futures
+import logging as _logging
+import os as _os
+import time as _time
+import traceback as _traceback
+import uuid as _uuid
+
+from .stagger import StaggerError, StaggerTags
+
+_log = _logging.getLogger("cleaner")
+
+class CleanerStats:
+    def __init__(self):
+        self.start_time = _time.time()
+        self.duration = 0
+        self.considered = 0
+        self.deleted = 0
+        self.evicted = 0
+        self.bytes_freed = 0
+
+    def __repr__(self):
+        return (f"considered {self.considered} builds, deleted {self.deleted} "
+                f"({self.evicted} over quota), freed {self.bytes_freed} bytes in {self.duration:.1f} s")
+
+# The cleaner is a task on the event loop of one serving process.
+# Catalog queries, Stagger requests, and deletions run in its own
+# executor thread, so they do not hold up request handling or take
+# threads from the I/O executor.
+#
+# Each pass considers at most batch_size builds, resuming from where the
+# last pass stopped.  Passes run every max_interval seconds, and more
+# often as the disk fills or while a backlog of builds remains, down to
+# every min_interval seconds.  A trigger, from the Stagger webhook,
+# starts a pass at once, but no sooner than min_interval after the last
+# one.
+#
+# Files are removed at no more than delete_rate per second, waiting
+# while more than max_uploads uploads are in progress.
+
+class BuildCleaner:
+    def __init__(self, app, min_interval=10, max_interval=60, min_age=60 * 60, batch_size=1000,
+                 delete_rate=1000, max_uploads=4):
+        self.app = app
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.delete_rate = delete_rate
+        self.max_uploads = max_uploads
+
+        self.cursor = None
+        self.last_start = None
+        self.last_stats = None
+        self.stagger = StaggerTags()
+        self.executor = None
+        self.triggered = None
+
+    async def run(self):
+        self.executor = _futures.ThreadPoolExecutor(1, thread_name_prefix="cleaner")
+        self.triggered = _asyncio.Event()
+
+        try:
+            while True:
+                await self.wait()
+
+                try:
+                    await self.clean_builds()
+                except Exception:
+                    _traceback.print_exc()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Called on the event loop
+    def trigger(self):
+        if self.triggered is not None:
+            self.triggered.set()
+
+    async def wait(self):
+        interval = await self.run_blocking(self.next_interval)
+
+        try:
+            await _asyncio.wait_for(self.triggered.wait(), interval)
+        except _asyncio.TimeoutError:
+            return
+
+        self.triggered.clear()
+
+        if self.last_start is not None:
+            await _asyncio.sleep(self.last_start + self.min_interval - _time.monotonic())
+
+        _log.info("Cleaning triggered")
+
+    # Shorter as the disk goes from 70% to 90% full, and the shortest
+    # while the last pass left builds unconsidered
+    def next_interval(self):
+        if self.cursor is not None:
+            return self.min_interval
+
+        stat = _os.statvfs(self.app.builds_dir)
+        used = 1 - stat.f_bavail / stat.f_blocks if stat.f_blocks else 0
+        fraction = min(1, max(0, (used - 0.7) / 0.2))
+
+        return self.max_interval - fraction * (self.max_interval - self.min_interval)
+
+    async def run_blocking(self, func, *args):
+        loop = _asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def clean_builds(self):
+        if self.app.active_uploads > self.max_uploads:
+            _log.info("Deferring cleaning while uploads are in progress")
+            return
+
+        self.last_start = _time.monotonic()
+        start = _time.perf_counter()
+
+        stats = CleanerStats()
+
+        # Only deletions depend on the Stagger data.  Garbage is
+        # collected even if it cannot be fetched.
+
+        try:
+            changed = await self.stagger.update(self.executor)
+        except StaggerError as e:
+            self.observe_stagger_fetch(start, "error")
+            _log.warning(f"Failed getting data from Stagger: {e}; not deleting builds")
+        else:
+            self.observe_stagger_fetch(start, "changed" if changed else "unchanged")
+            await self.delete_untagged_builds(stats)
+
+        await self.collect_garbage(stats)
+
+        stats.duration = _time.time() - stats.start_time
+        self.last_stats = stats
+
+        metrics = self.app.metrics
+        metrics.inc("bodega_cleaner_passes_total")
+        metrics.observe("bodega_cleaner_pass_duration_seconds", stats.duration)
+        metrics.inc("bodega_cleaner_builds_deleted_total", stats.deleted)
+        metrics.inc("bodega_cleaner_builds_evicted_total", stats.evicted)
+        metrics.inc("bodega_cleaner_bytes_freed_total", stats.bytes_freed)
+
+        _log.info(f"Cleaned builds: {stats}")
+
+    async def delete_untagged_builds(self, stats):
+        catalog = self.app.catalog
+
+        builds = await self.run_blocking(catalog.list_builds_page, _time.time() - self.min_age,
+                                         self.cursor, self.batch_size)
+
+        if len(builds) < self.batch_size:
+            self.cursor = None
+        else:
+            self.cursor = builds[-1]
+
+        deletions = list()
+
+        for build in builds:
+            stats.considered += 1
+
+            if self.stagger.is_tagged(build.repo, build.branch, build.build):
+                _log.debug(f"Build {_build_id(build)} has a tag; leaving it")
+                continue
+
+            _log.debug(f"Build {_build_id(build)} has no tags; deleting it")
+            deletions.append(build)
+
+        await self.run_blocking(self.delete_builds, deletions, stats)
+
+        # Builds of repos and branches over quota are deleted next,
+        # regardless of age
+
+        evictions = await self.run_blocking(self.app.quotas.find_evictions, catalog, self.stagger.is_tagged)
+
+        for build in evictions:
+            _log.debug(f"Build {_build_id(build)} is over quota; deleting it")
+
+        stats.evicted = len(evictions)
+        await self.run_blocking(self.delete_builds, evictions, stats)
+
+    async def collect_garbage(self, stats):
+        count, size = await self.run_blocking(self.app.blob_store.collect_garbage)
+        stats.bytes_freed += size
+
+        await self.run_blocking(self.app.package_cache.collect_garbage, self.app.blob_store)
+        await self.run_blocking(self.app.checksum_cache.collect_garbage, self.app.blob_store)
+
+        count, size = await self.run_blocking(self.app.upload_sessions.collect_garbage)
+        stats.bytes_freed += size
+
+        if count:
+            _log.info(f"Removed {count} stale upload sessions")
+
+        count = await self.run_blocking(self.app.staging_area.collect_garbage, self.app.catalog)
+
+        if count:
+            _log.info(f"Removed {count} stale staged builds")
+
+    def observe_stagger_fetch(self, start, result):
+        self.app.metrics.observe("bodega_stagger_fetch_duration_seconds", _time.perf_counter() - start,
+                                 (("result", result),))
+
+    # Runs in the cleaner executor
+    def delete_builds(self, builds, stats):
+        for build in builds:
+            try:
+                self.delete_build(build, stats)
+            except Exception:
+                _traceback.print_exc()
+
+    def delete_build(self, build, stats):
+        # The build is removed from the catalog and moved out of the
+        # builds tree at once, then its files are removed gradually
+
+        build_dir = _os.path.join(self.app.builds_dir, build.repo, build.branch, build.build)
+        trash_dir = _os.path.join(self.app.temp_dir, f"{_uuid.uuid4()}.deleted")
+
+        self.app.catalog.remove_build(build.repo, build.branch, build.build)
+
+        try:
+            _os.rename(build_dir, trash_dir)
+        except FileNotFoundError:
+            return
+        finally:
+            self.app.file_cache.invalidate_dir(build_dir)
+            self.app.directory_cache.invalidate(build_dir)
+
+        for root, dirs, files in _os.walk(trash_dir, topdown=False):
+            for name in files + [x for x in dirs if _os.path.islink(_os.path.join(root, x))]:
+                fs_path = _os.path.join(root, name)
+                stat = _os.lstat(fs_path)
+
+                self.wait_to_delete()
+                _os.remove(fs_path)
+
+                # Files still linked from the blob store are freed
+                # later, by garbage collection
+                if stat.st_nlink == 1:
+                    stats.bytes_freed += stat.st_size
+
+            _os.rmdir(root)
+
+        stats.deleted += 1
+
+    def wait_to_delete(self):
+        _time.sleep(1 / self.delete_rate)
+
+        while self.app.active_uploads > self.max_uploads:
+            _time.sleep(1)
+
+def _build_id(build):
+    return f"{build.repo}/{build.branch}/{build.build}"
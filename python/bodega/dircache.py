@@ -0,0 +1,94 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import collections as _collections
+import os as _os
+import threading as _threading
+import time as _time
+
+# Rendered directory listings, keyed by directory.  An entry is used
+# while the directory's modification time is unchanged.  Uploads and
+# deletions also drop the entries for the directories they touch,
+# which covers listings that come from the catalog.  Events in other
+# processes are not seen, so with several workers entries also expire
+# after max_age seconds.
+
+class DirectoryCache:
+    def __init__(self, max_entries=1000, max_age=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+        self.lock = _threading.Lock()
+        self.entries = _collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    # Load is called to produce a new index on a miss.  It may return
+    # None, which is not cached.
+    def get(self, fs_path, load):
+        now = _time.monotonic()
+
+        try:
+            mtime = _os.stat(fs_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        with self.lock:
+            item = self.entries.get(fs_path)
+
+            if (item is not None and item[0] == mtime
+                and (self.max_age is None or now - item[2] < self.max_age)):
+                self.entries.move_to_end(fs_path)
+                self.hits += 1
+
+                return item[1]
+
+            self.misses += 1
+
+        index = load()
+
+        if index is not None:
+            with self.lock:
+                self.entries[fs_path] = (mtime, index, now)
+                self.entries.move_to_end(fs_path)
+
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        return index
+
+    # Drops the entries for the path, the directories above it, and
+    # the directories below it
+    def invalidate(self, fs_path):
+        fs_path = fs_path.rstrip(_os.sep)
+
+        with self.lock:
+            for key in list(self.entries):
+                if (key == fs_path or fs_path.startswith(key.rstrip(_os.sep) + _os.sep)
+                    or key.startswith(fs_path + _os.sep)):
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+            }
@@ -0,0 +1,189 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import collections as _collections
+import email.utils as _email_utils
+import gzip as _gzip
+import mimetypes as _mimetypes
+import os as _os
+import threading as _threading
+import time as _time
+
+from brbn import *
+
+from .blobs import compress_min_size, digest_headers, is_compressible
+
+# An in-memory LRU cache of small build files, bounded by total bytes.
+# Entries hold the response body, validators, and a gzip variant for
+# compressible files.  Uploads and deletions invalidate entries
+# directly, and an entry is checked against the file's metadata at
+# most once per revalidate interval, which covers changes made by
+# other processes.
+
+class FileCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_file_size=256 * 1024, revalidate_interval=1):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+
+        self.lock = _threading.Lock()
+        self.entries = _collections.OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, fs_path):
+        with self.lock:
+            entry = self.entries.get(fs_path)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(fs_path)
+
+        now = _time.monotonic()
+
+        if now - entry.checked > self.revalidate_interval:
+            try:
+                stat_result = _os.stat(fs_path)
+            except FileNotFoundError:
+                stat_result = None
+
+            if stat_result is None or _stat_key(stat_result) != entry.stat_key:
+                self.invalidate(fs_path)
+
+                with self.lock:
+                    self.misses += 1
+
+                return None
+
+            entry.checked = now
+
+        with self.lock:
+            self.hits += 1
+
+        return entry
+
+    # Reads the file and caches it, if it is small enough.  Returns the
+    # entry or None.  With the stored digest, the entry has the ETag and
+    # Digest headers derived from it.
+    def load(self, fs_path, stat_result, digest=None):
+        if self.max_bytes == 0 or stat_result.st_size > self.max_file_size:
+            return None
+
+        with open(fs_path, "rb") as f:
+            body = f.read()
+
+        if len(body) != stat_result.st_size:
+            return None
+
+        entry = _CacheEntry(fs_path, stat_result, body, digest)
+
+        with self.lock:
+            old = self.entries.pop(fs_path, None)
+
+            if old is not None:
+                self.size -= old.size
+
+            self.entries[fs_path] = entry
+            self.size += entry.size
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+        return entry
+
+    def invalidate(self, fs_path):
+        with self.lock:
+            entry = self.entries.pop(fs_path, None)
+
+            if entry is not None:
+                self.size -= entry.size
+
+    def invalidate_dir(self, dir):
+        prefix = dir.rstrip(_os.sep) + _os.sep
+
+        with self.lock:
+            for fs_path in [x for x in self.entries if x.startswith(prefix)]:
+                self.size -= self.entries.pop(fs_path).size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+class _CacheEntry:
+    def __init__(self, fs_path, stat_result, body, digest=None):
+        self.stat_key = _stat_key(stat_result)
+        self.checked = _time.monotonic()
+        self.body = body
+        self.media_type = _mimetypes.guess_type(fs_path)[0] or "application/octet-stream"
+        self.etag = file_etag(stat_result)
+        self.digest = None
+
+        if digest is not None:
+            headers = digest_headers(digest)
+            self.etag = headers["etag"]
+            self.digest = headers["digest"]
+        self.last_modified = _email_utils.formatdate(stat_result.st_mtime, usegmt=True)
+        self.variants = dict()
+        self.compressible = is_compressible(fs_path)
+
+        if self.compressible and len(body) >= compress_min_size:
+            variant = _gzip.compress(body)
+
+            if len(variant) < len(body):
+                self.variants["gzip"] = variant
+
+        self.size = len(body) + sum(len(x) for x in self.variants.values())
+
+    def response(self, request_headers):
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": self.etag,
+            "last-modified": self.last_modified,
+        }
+
+        if self.compressible:
+            headers["vary"] = "Accept-Encoding"
+
+        for encoding in accepted_encodings(request_headers.get("accept-encoding")):
+            if encoding in self.variants:
+                headers["content-encoding"] = encoding
+                headers["etag"] = encoded_etag(self.etag, encoding)
+
+                return Response(self.variants[encoding], headers=headers, media_type=self.media_type)
+
+        if self.digest is not None:
+            headers["digest"] = self.digest
+
+        return Response(self.body, headers=headers, media_type=self.media_type)
+
+def _stat_key(stat_result):
+    return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
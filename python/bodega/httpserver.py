@@ -17,23 +17,199 @@
 # under the License.
 #
 
+import asyncio as _asyncio
+import base64 as _base64
+import contextlib as _contextlib
+import io as _io
 import logging as _logging
+import mimetypes as _mimetypes
 import os as _os
+import re as _re
+import shutil as _shutil
+import tarfile as _tarfile
 import uuid as _uuid
 
 from brbn import *
 
+from .archive import archive_etag, archive_formats, generate_archive
+from .blobs import DigestMismatchError, compress_min_size, digest_headers, is_compressible, is_digest
+from .maven import artifact_dir, compute_checksums, parse_checksum_path, update_metadata
+from .metrics import load_snapshots
+from .uploads import UploadBusyError
+from .yum import is_repo_package, is_repodata_file, repo_dir_name, update_repodata
+
 _log = _logging.getLogger("httpserver")
 
+# Request chunks are coalesced into writes of at least this size
+_write_size = 1024 * 1024
+
+# The PAX header naming the stored blob for a bulk upload member
+_digest_header = "BODEGA.sha256"
+
+# Repodata is updated once uploads of packages to a build pause for
+# this long
+_repodata_delay = 1
+
 class HttpServer(Server):
-    def __init__(self, app, host="", port=8080):
-        super().__init__(app, host=host, port=port)
+    def __init__(self, app, host="", port=8080, workers=1):
+        super().__init__(app, host=host, port=port, workers=workers)
 
         self.add_route("/healthz", endpoint=Handler(), methods=["GET"])
+        self.add_route("/metrics", endpoint=MetricsHandler(), methods=["GET"])
+        self.add_route("/hooks/stagger", endpoint=StaggerHookHandler(), methods=["POST"])
+        self.add_route("/{repo_id}/{branch_id}/{build_id}",
+                       endpoint=BuildHandler(), methods=["PUT", "POST", "HEAD", "GET"])
         self.add_route("/{repo_id}/{branch_id}/{build_id}/{path:path}",
-                       endpoint=BuildFileHandler(), methods=["PUT", "HEAD", "GET"])
+                       endpoint=BuildFileHandler(), methods=["PUT", "POST", "HEAD", "GET"])
         self.add_route("/{path:path}", endpoint=DirectoryHandler(), methods=["GET"])
 
+    def on_worker_start(self):
+        self.app.init_worker()
+
+    def on_worker_exit(self, index, pid):
+        self.app.reset_worker(index, pid)
+
+    # The cleaner runs in the first serving process
+    @_contextlib.asynccontextmanager
+    async def lifespan(self, app):
+        if self.worker_index != 0:
+            yield
+            return
+
+        task = self.app.start_cleaner()
+
+        try:
+            yield
+        finally:
+            task.cancel()
+
+class MetricsHandler(Handler):
+    async def handle(self, request):
+        app = request.app
+        snapshots = list()
+
+        if app.workers > 1:
+            snapshots = await _run_io(request, load_snapshots, app.metrics_dir)
+
+        return MetricsResponse(await _run_io(request, app.metrics.render, snapshots))
+
+# Stagger posts here when tags change, so builds that lost their tags
+# are cleaned without waiting for the next scheduled pass
+class StaggerHookHandler(Handler):
+    async def handle(self, request):
+        request.app.trigger_cleaner()
+        return OkResponse()
+
+class BuildHandler(Handler):
+    async def handle(self, request):
+        repo_id = request.path_params["repo_id"]
+        branch_id = request.path_params["branch_id"]
+        build_id = request.path_params["build_id"]
+
+        if {repo_id, branch_id, build_id} & {".", ".."}:
+            return BadRequestResponse("Requested path not a build directory")
+
+        build_dir = _os.path.join(request.app.builds_dir, repo_id, branch_id, build_id)
+
+        if request.method in ("GET", "HEAD"):
+            if "meta" in request.query_params:
+                return await _build_meta_response(request, repo_id, branch_id, build_id)
+
+            format = request.query_params.get("archive")
+
+            if format is None:
+                return await _directory_response(request, build_dir)
+
+            if format not in archive_formats:
+                return BadRequestResponse("Unsupported archive format")
+
+            build = await _run_io(request, request.app.catalog.get_build, repo_id, branch_id, build_id)
+
+            if build is None:
+                return NotFoundResponse()
+
+            request.app.io_executor.submit(request.app.catalog.touch_build, repo_id, branch_id, build_id)
+
+            # Builds with files that have no recorded digest get no ETag
+
+            manifest_digest = await _run_io(request, request.app.catalog.get_manifest_digest,
+                                            repo_id, branch_id, build_id)
+
+            media_type, extension = archive_formats[format]
+            headers = {
+                "content-disposition": f'attachment; filename="{repo_id}-{branch_id}-{build_id}{extension}"',
+            }
+
+            if manifest_digest is not None:
+                headers["etag"] = archive_etag(manifest_digest, format)
+
+            if request.method == "HEAD":
+                return Response("", headers=headers, media_type=media_type)
+
+            return StreamingResponse(_stream_archive(request, build_dir, format), headers=headers,
+                                     media_type=media_type)
+
+        if request.method == "PUT":
+            if request.query_params.get("format") != "tar":
+                return BadRequestResponse("Unsupported upload format")
+
+            # A dry run reports an existing build, so the client stops
+            # before it hashes and streams the files
+
+            if _os.path.exists(build_dir):
+                return ConflictResponse("The build already exists")
+
+            if request.query_params.get("dry-run") == "1":
+                return OkResponse()
+
+            meter = await _check_quota(request, repo_id, branch_id, _content_length(request))
+
+            # The build is unpacked outside the builds tree and then
+            # moved into place with one rename, so it appears whole
+
+            temp_dir = _os.path.join(request.app.temp_dir, str(_uuid.uuid4()))
+            stream = _RequestStream(request, _asyncio.get_running_loop(), meter)
+
+            request.app.start_upload()
+
+            try:
+                files = await _run_io(request, _extract_tar, stream, temp_dir, request.app.blob_store)
+                files = await _run_io(request, _add_repodata, request.app, temp_dir, files)
+                files = await _run_io(request, _add_maven_metadata, request.app, temp_dir, files)
+                await _run_io(request, _os.makedirs, _os.path.dirname(build_dir), exist_ok=True)
+
+                try:
+                    await _run_io(request, _os.rename, temp_dir, build_dir)
+                except OSError:
+                    return ConflictResponse("The build already exists")
+            finally:
+                request.app.end_upload()
+                await _run_io(request, _shutil.rmtree, temp_dir, ignore_errors=True)
+
+            await _run_io(request, request.app.catalog.add_build, repo_id, branch_id, build_id, files)
+            request.app.directory_cache.invalidate(build_dir)
+
+            for path, size, digest in files:
+                request.app.io_executor.submit(request.app.blob_store.write_variants, digest, path)
+
+            return OkResponse()
+
+        if request.method == "POST":
+            if "commit" in request.query_params:
+                return await _commit_build(request, build_dir, repo_id, branch_id, build_id)
+
+            if "manifest" not in request.query_params:
+                return BadRequestResponse("Unsupported build operation")
+
+            try:
+                manifest = await request.json()
+            except ValueError as e:
+                return BadJsonResponse(e)
+
+            missing = await _run_io(request, _find_missing_files, manifest, request.app.blob_store)
+
+            return JsonResponse({"missing": missing})
+
 class BuildFileHandler(Handler):
     async def handle(self, request):
         repo_id = request.path_params["repo_id"]
@@ -48,39 +224,69 @@ class BuildFileHandler(Handler):
         if not fs_path.startswith(build_dir):
             return BadRequestResponse("Requested path not under the build directory")
 
+        file_key = (repo_id, branch_id, build_id, _os.path.relpath(fs_path, build_dir))
+        staged = request.query_params.get("staged") == "1"
+
+        if staged and request.method in ("PUT", "POST") and _os.path.exists(build_dir):
+            return ConflictResponse("The build already exists")
+
+        if "uploads" in request.query_params or "upload" in request.query_params:
+            return await _handle_upload(request, file_key, staged)
+
         if request.method == "PUT":
             if fs_path.endswith("/"):
                 return BadRequestResponse("PUT of a directory is not supported")
 
-            temp_path = f"{fs_path}.{_uuid.uuid4()}.temp"
-            dir_path, _ = _os.path.split(temp_path)
-
             if request.query_params.get("dry-run") == "1":
                 return OkResponse()
 
-            if not _os.path.exists(dir_path):
-                _os.makedirs(dir_path)
+            meter = await _check_quota(request, repo_id, branch_id, _content_length(request))
+            expected = _expected_digests(request)
+            store = request.app.blob_store
+            writer = await _run_io(request, store.open_writer, "md5" in expected)
+
+            request.app.start_upload()
 
-            with open(temp_path, "wb") as f:
-                async for chunk in request.stream():
-                    f.write(chunk)
+            try:
+                await _receive_file(request, writer, meter)
+                writer.verify(expected)
+                digest = await _run_io(request, writer.commit)
+            except DigestMismatchError as e:
+                await _run_io(request, writer.abort)
+                return BadRequestResponse(str(e))
+            except BaseException:
+                await _run_io(request, writer.abort)
+                raise
+            finally:
+                request.app.end_upload()
 
-            _os.rename(temp_path, fs_path)
+            await _publish_file(request, file_key, digest, writer.size, staged)
 
             return OkResponse()
 
-        if request.method == "GET":
+        if request.method in ("GET", "HEAD"):
+            request.app.io_executor.submit(request.app.catalog.touch_build, repo_id, branch_id, build_id)
+
+            # Range requests always go to the file
+
+            if "range" not in request.headers:
+                entry = request.app.file_cache.get(fs_path)
+
+                if entry is not None:
+                    return entry.response(request.headers)
+
             if not _os.path.exists(fs_path):
-                return NotFoundResponse()
+                return await _checksum_response(request, file_key)
 
             if _os.path.isfile(fs_path):
-                return FileResponse(fs_path)
+                return await _file_response(request, fs_path, file_key)
             elif _os.path.isdir(fs_path):
-                request_path = _os.path.join(repo_id, branch_id, build_id, request_path)
-                return DirectoryIndexResponse(request.app.builds_dir, request_path)
+                return await _directory_response(request, fs_path)
             else:
                 raise Exception()
 
+        return BadRequestResponse("Unsupported build file operation")
+
 class DirectoryHandler(Handler):
     async def handle(self, request):
         request_path = request.path_params["path"]
@@ -90,7 +296,664 @@ class DirectoryHandler(Handler):
         if not fs_path.startswith(request.app.builds_dir):
             return BadRequestResponse("Requested path not under the builds directory")
 
-        if not _os.path.exists(fs_path):
-            return NotFoundResponse()
+        return await _directory_response(request, fs_path)
+
+# Answers from the catalog alone.  A HEAD request is one lookup of the
+# build record.
+async def _build_meta_response(request, repo_id, branch_id, build_id):
+    catalog = request.app.catalog
+    build = await _run_io(request, catalog.get_build, repo_id, branch_id, build_id)
+
+    if build is None:
+        return NotFoundResponse()
+
+    if request.method == "HEAD":
+        return Response("", media_type="application/json")
+
+    manifest_digest = await _run_io(request, catalog.get_manifest_digest, repo_id, branch_id, build_id)
+
+    return JsonResponse({
+        "repo": build.repo,
+        "branch": build.branch,
+        "build": build.build,
+        "created": build.created,
+        "file_count": build.file_count,
+        "total_bytes": build.total_bytes,
+        "manifest_sha256": manifest_digest,
+    })
+
+async def _directory_response(request, fs_path):
+    app = request.app
+    parts = _os.path.relpath(fs_path, app.builds_dir).split(_os.sep)
+    parts = [x for x in parts if x != "."]
+
+    index = await _run_io(request, app.directory_cache.get, fs_path,
+                          lambda: _load_directory_index(app, fs_path, parts))
+
+    if index is None:
+        return NotFoundResponse()
+
+    return index.response(request)
+
+# The repo and branch levels are listed from the catalog, and the
+# levels below from the filesystem, with digests from the catalog
+def _load_directory_index(app, fs_path, parts):
+    if len(parts) < 3:
+        entries = _list_catalog(app.catalog, parts)
+
+        if parts and not entries:
+            return None
+    else:
+        if not _os.path.isdir(fs_path):
+            return None
+
+        digests = app.catalog.get_file_digests(*parts[:3], "/".join(parts[3:]))
+        entries = [x._replace(sha256=digests.get(x.name)) for x in list_directory(fs_path)]
+
+    return DirectoryIndex("/".join(parts), entries)
+
+# Links a stored blob into the build tree and records it.  A staged file
+# goes into the staging area instead, where it stays unseen until the
+# build is committed.
+async def _publish_file(request, file_key, digest, size, staged=False):
+    app = request.app
+    store = app.blob_store
+
+    if staged:
+        fs_path = _os.path.join(app.staging_area.build_dir(*file_key[:3]), file_key[3])
+
+        await _run_io(request, store.link, digest, fs_path)
+        await _run_io(request, app.catalog.add_staged_file, *file_key, size, digest)
+    else:
+        fs_path = _os.path.join(app.builds_dir, *file_key)
+
+        # Cached entries carry the digest, so the cache is invalidated
+        # once the catalog has the new one
+
+        await _run_io(request, store.link, digest, fs_path)
+        await _run_io(request, app.catalog.add_file, *file_key, size, digest)
+
+        app.file_cache.invalidate(fs_path)
+        app.directory_cache.invalidate(fs_path)
+
+        # Repodata from the client is replaced as well
+
+        if is_repo_package(file_key[3]) or is_repodata_file(file_key[3]):
+            _schedule_repodata_update(app, file_key[:3])
+
+        if artifact_dir(file_key[3]) is not None:
+            await _run_io(request, _update_maven_metadata, app, file_key[:3], {artifact_dir(file_key[3])})
+
+    app.io_executor.submit(store.write_variants, digest, fs_path)
+
+# Repodata for packages is generated on the server.  A build published
+# whole, by tar upload or by commit, gets it before it becomes visible.
+# Packages PUT into a published build update it after a short delay, so
+# a batch of uploads is handled once.
+def _schedule_repodata_update(app, build_key):
+    loop = _asyncio.get_running_loop()
+    handle = app.repodata_timers.pop(build_key, None)
+
+    if handle is not None:
+        handle.cancel()
+
+    def update():
+        del app.repodata_timers[build_key]
+        app.io_executor.submit(_log_errors, _update_repodata, app, build_key)
+
+    app.repodata_timers[build_key] = loop.call_later(_repodata_delay, update)
+
+def _update_repodata(app, build_key, staged=False):
+    catalog = app.catalog
+
+    if staged:
+        build_dir = app.staging_area.build_dir(*build_key)
+    else:
+        build_dir = _os.path.join(app.builds_dir, *build_key)
+
+    files = catalog.get_build_files(*build_key, staged=staged)
+    digests = {x[0][len(repo_dir_name) + 1:]: x[2] for x in files if is_repo_package(x[0])}
+
+    if not digests:
+        return
+
+    generated, removed = update_repodata(_os.path.join(build_dir, repo_dir_name), digests,
+                                         app.package_cache, app.blob_store)
+
+    for path in removed:
+        path = f"{repo_dir_name}/{path}"
+
+        if staged:
+            catalog.remove_staged_file(*build_key, path)
+        else:
+            catalog.remove_file(*build_key, path)
+            app.file_cache.invalidate(_os.path.join(build_dir, path))
+
+    for path, size, digest in generated:
+        path = f"{repo_dir_name}/{path}"
+        fs_path = _os.path.join(build_dir, path)
+
+        if staged:
+            catalog.add_staged_file(*build_key, path, size, digest)
+        else:
+            catalog.add_file(*build_key, path, size, digest)
+            app.file_cache.invalidate(fs_path)
+
+        app.io_executor.submit(app.blob_store.write_variants, digest, fs_path)
+
+    if not staged:
+        app.directory_cache.invalidate(_os.path.join(build_dir, repo_dir_name, "repodata"))
+
+# Returns the files of an unpacked build with repodata added
+def _add_repodata(app, build_dir, files):
+    digests = {x[0][len(repo_dir_name) + 1:]: x[2] for x in files if is_repo_package(x[0])}
+
+    if not digests:
+        return files
+
+    generated, removed = update_repodata(_os.path.join(build_dir, repo_dir_name), digests,
+                                         app.package_cache, app.blob_store)
+    files = {x[0]: x for x in files}
+
+    for path in removed:
+        files.pop(f"{repo_dir_name}/{path}", None)
+
+    for path, size, digest in generated:
+        path = f"{repo_dir_name}/{path}"
+        files[path] = (path, size, digest)
+
+    return list(files.values())
+
+# Maven metadata is generated on the server as well.  It is updated at
+# once when a POM is published, since each update covers one artifact.
+# Artifact dirs of None means all the artifact dirs of the build.
+def _update_maven_metadata(app, build_key, artifact_dirs=None, staged=False):
+    catalog = app.catalog
+
+    if staged:
+        build_dir = app.staging_area.build_dir(*build_key)
+    else:
+        build_dir = _os.path.join(app.builds_dir, *build_key)
+
+    if artifact_dirs is None:
+        files = catalog.get_build_files(*build_key, staged=staged)
+        artifact_dirs = {artifact_dir(x[0]) for x in files} - {None}
+
+    for path, size, digest in update_metadata(build_dir, artifact_dirs, app.blob_store):
+        fs_path = _os.path.join(build_dir, path)
+
+        if staged:
+            catalog.add_staged_file(*build_key, path, size, digest)
+        else:
+            catalog.add_file(*build_key, path, size, digest)
+            app.file_cache.invalidate(fs_path)
+            app.directory_cache.invalidate(fs_path)
+
+        app.io_executor.submit(app.blob_store.write_variants, digest, fs_path)
+
+# Returns the files of an unpacked build with Maven metadata added
+def _add_maven_metadata(app, build_dir, files):
+    artifact_dirs = {artifact_dir(x[0]) for x in files} - {None}
+
+    if not artifact_dirs:
+        return files
+
+    files = {x[0]: x for x in files}
+
+    for path, size, digest in update_metadata(build_dir, artifact_dirs, app.blob_store):
+        files[path] = (path, size, digest)
+
+    return list(files.values())
+
+# Checksum files that were not uploaded are answered from the digest of
+# the file they belong to
+async def _checksum_response(request, file_key):
+    app = request.app
+    parsed = parse_checksum_path(file_key[3])
+
+    if parsed is None:
+        return NotFoundResponse()
+
+    path, extension = parsed
+    digest = await _run_io(request, app.catalog.get_file_digest, *file_key[:3], path)
+
+    if digest is None:
+        return NotFoundResponse()
+
+    if extension == "sha256":
+        checksum = digest
+    else:
+        fs_path = _os.path.join(app.builds_dir, *file_key[:3], path)
+        checksums = await _run_io(request, app.checksum_cache.get, digest, compute_checksums, fs_path)
+        checksum = checksums[extension]
+
+    return Response(checksum, media_type="text/plain", headers={"etag": f'"{digest}.{extension}"'})
+
+def _log_errors(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        _log.exception(f"Failure in {func.__name__}")
+
+# Staged builds:
+#
+#   PUT {build}/{path}?staged=1             Stage a file
+#   POST {build}/{path}?uploads&staged=1    Start a staged upload session
+#   POST {build}?commit                     Publish the staged files
+#
+# The commit moves the staged tree into the builds tree with one rename.
+# Staging or committing a build that already exists is a conflict.
+async def _commit_build(request, build_dir, repo_id, branch_id, build_id):
+    app = request.app
+
+    if _os.path.exists(build_dir):
+        return ConflictResponse("The build already exists")
+
+    if request.query_params.get("dry-run") == "1":
+        return OkResponse()
+
+    await _run_io(request, _update_repodata, app, (repo_id, branch_id, build_id), True)
+    await _run_io(request, _update_maven_metadata, app, (repo_id, branch_id, build_id), None, True)
+
+    try:
+        published = await _run_io(request, app.staging_area.publish, repo_id, branch_id, build_id)
+    except FileExistsError:
+        return ConflictResponse("The build already exists")
+
+    if not published:
+        return NotFoundResponse()
+
+    await _run_io(request, app.catalog.commit_staged_build, repo_id, branch_id, build_id)
+    app.directory_cache.invalidate(build_dir)
+
+    return OkResponse()
+
+# Resumable uploads:
+#
+#   POST {path}?uploads                     Start a session
+#   HEAD or GET {path}?upload={id}          Get the offset
+#   PUT {path}?upload={id}                  Append, with a Content-Range
+#                                           starting at the offset
+#   POST {path}?upload={id}&commit          Publish the file
+#
+# Responses carry the offset in an Upload-Offset header and a JSON body.
+# An append that does not start at the offset gets a 409 with the
+# offset, and the client resumes from there.
+async def _handle_upload(request, file_key, staged):
+    sessions = request.app.upload_sessions
+
+    if file_key[3] == ".":
+        return BadRequestResponse("Upload of a directory is not supported")
+
+    if "uploads" in request.query_params:
+        if request.method != "POST":
+            return BadRequestResponse("Starting an upload requires POST")
+
+        upload_id = await _run_io(request, sessions.create, *file_key, staged=staged)
+
+        return _upload_response(upload_id, 0, 201)
+
+    upload_id = request.query_params["upload"]
+    session = await _run_io(request, sessions.get, upload_id)
+
+    if session is None or tuple(session[x] for x in ("repo", "branch", "build", "path")) != file_key:
+        return NotFoundResponse()
+
+    if request.method in ("GET", "HEAD"):
+        offset = await _run_io(request, sessions.get_offset, upload_id)
+        return _upload_response(upload_id, offset)
+
+    if request.method == "PUT":
+        start = _parse_content_range(request.headers.get("content-range"))
+
+        if start is None:
+            return BadRequestResponse("Missing or malformed Content-Range")
+
+        meter = await _check_quota(request, *file_key[:2], _content_length(request), start)
+
+        try:
+            appender = await _run_io(request, sessions.open_appender, upload_id)
+        except UploadBusyError:
+            return ConflictResponse("Another append to the upload is in progress")
+
+        try:
+            if start != appender.offset:
+                return _upload_response(upload_id, appender.offset, 409)
+
+            request.app.start_upload()
+
+            try:
+                await _receive_file(request, appender, meter)
+            finally:
+                request.app.end_upload()
+        finally:
+            await _run_io(request, appender.close)
+
+        return _upload_response(upload_id, appender.offset)
+
+    if request.method == "POST" and "commit" in request.query_params:
+        expected_digest = _expected_digests(request).get("sha-256")
+        size = await _run_io(request, sessions.get_offset, upload_id)
+
+        await _check_quota(request, *file_key[:2], size)
+
+        try:
+            digest, size = await _run_io(request, sessions.commit, upload_id, request.app.blob_store,
+                                         expected_digest)
+        except UploadBusyError:
+            return ConflictResponse("An append to the upload is in progress")
+        except DigestMismatchError as e:
+            return BadRequestResponse(str(e))
+
+        await _publish_file(request, file_key, digest, size, session.get("staged", False))
+
+        return OkResponse()
+
+    return BadRequestResponse("Unsupported upload operation")
+
+# Raises a 507 error if adding the received bytes and size more to the
+# branch would exceed a hard quota.  Returns a meter for counting the
+# bytes as they arrive, or None if the branch has no hard quotas.
+async def _check_quota(request, repo_id, branch_id, size, received=0):
+    app = request.app
+
+    if not app.quotas.has_hard_limits(repo_id, branch_id):
+        return None
+
+    allowance, message = await _run_io(request, app.quotas.get_allowance, app.catalog, repo_id, branch_id)
+    meter = _QuotaMeter(app, repo_id, allowance, message, received)
+    meter.check(received + size)
+
+    return meter
+
+# The declared length is checked before an upload starts, but a chunked
+# upload has none, so the bytes are counted again as they arrive.  Add
+# is called from the loop or from the I/O executor.
+class _QuotaMeter:
+    def __init__(self, app, repo_id, allowance, message, received=0):
+        self.app = app
+        self.repo_id = repo_id
+        self.allowance = allowance
+        self.message = message
+        self.received = received
+        self.loop = _asyncio.get_running_loop()
+
+    def add(self, size):
+        self.received += size
+        self.check(self.received)
+
+    def check(self, size):
+        if size > self.allowance:
+            self.loop.call_soon_threadsafe(self.app.metrics.inc, "bodega_quota_rejections_total", 1,
+                                           (("repo", self.repo_id),))
+            raise InsufficientStorageError(self.message)
+
+def _content_length(request):
+    try:
+        return int(request.headers.get("content-length", 0))
+    except ValueError:
+        return 0
+
+# Returns a map of "sha-256" or "md5" to the hex digest the client
+# supplied in a Digest or Content-MD5 header.  Other algorithms are
+# ignored.
+def _expected_digests(request):
+    values = parse_digest_header(request.headers.get("digest"))
+    expected = dict()
+
+    if "content-md5" in request.headers:
+        values.setdefault("md5", request.headers["content-md5"])
+
+    for algorithm, size in (("sha-256", 32), ("md5", 16)):
+        if algorithm not in values:
+            continue
+
+        try:
+            digest = _base64.b64decode(values[algorithm], validate=True)
+        except ValueError:
+            digest = None
+
+        if digest is None or len(digest) != size:
+            raise BadRequestError(f"Malformed {algorithm} digest")
+
+        expected[algorithm] = digest.hex()
+
+    return expected
+
+def _upload_response(upload_id, offset, status_code=200):
+    return JsonResponse({"upload_id": upload_id, "offset": offset}, status_code,
+                        headers={"upload-offset": str(offset)})
+
+_content_range_regex = _re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# Returns the start offset, or None if the header is missing or
+# malformed
+def _parse_content_range(value):
+    if value is None:
+        return None
+
+    match = _content_range_regex.fullmatch(value.strip())
+
+    if match is None:
+        return None
+
+    return int(match.group(1))
+
+# Compressible files are served from a precompressed variant if the
+# blob store has one, or else compressed as they are sent.  Files with
+# a stored digest get an ETag and a Digest header derived from it.  The
+# Digest header goes only on unencoded responses.
+async def _file_response(request, fs_path, file_key):
+    stat_result = _os.stat(fs_path)
+    digest = await _run_io(request, request.app.catalog.get_file_digest, *file_key)
+
+    if stat_result.st_size <= request.app.file_cache.max_file_size and "range" not in request.headers:
+        entry = await _run_io(request, request.app.file_cache.load, fs_path, stat_result, digest)
+
+        if entry is not None:
+            return entry.response(request.headers)
+
+    headers = digest_headers(digest) if digest is not None else dict()
+
+    if not is_compressible(fs_path):
+        return FileResponse(fs_path, headers=headers, stat_result=stat_result, chunk_size=request.app.read_size)
+
+    headers["vary"] = "Accept-Encoding"
+    encodings = accepted_encodings(request.headers.get("accept-encoding"))
+
+    if stat_result.st_size < compress_min_size or not encodings:
+        return FileResponse(fs_path, headers=headers, stat_result=stat_result,
+                            chunk_size=request.app.read_size)
+
+    store = request.app.blob_store
+    encoded_headers = {x: y for x, y in headers.items() if x != "digest"}
+
+    if digest is not None:
+        for encoding in encodings:
+            if encoding not in store.encodings:
+                continue
+
+            variant_path = store.variant_path(digest, encoding)
+
+            if _os.path.exists(variant_path):
+                encoded_headers["content-encoding"] = encoding
+                encoded_headers["etag"] = encoded_etag(headers["etag"], encoding)
+                media_type = _mimetypes.guess_type(fs_path)[0]
+
+                return FileResponse(variant_path, headers=encoded_headers, media_type=media_type,
+                                    chunk_size=request.app.read_size)
+
+    if "gzip" in encodings and request.method == "GET":
+        return GzipFileResponse(fs_path, headers=encoded_headers, stat_result=stat_result)
+
+    return FileResponse(fs_path, headers=headers, stat_result=stat_result,
+                        chunk_size=request.app.read_size)
+
+def _list_catalog(catalog, parts):
+    if len(parts) == 0:
+        return [DirectoryEntry(x, True) for x in catalog.list_repos()]
+
+    if len(parts) == 1:
+        return [DirectoryEntry(x, True) for x in catalog.list_branches(*parts)]
+
+    return [DirectoryEntry(x.build, True, x.total_bytes, x.created)
+            for x in catalog.list_branch_builds(*parts)]
+
+# Each piece is produced in the I/O executor only after the previous one
+# has been sent, so a slow client slows the archive generation
+async def _stream_archive(request, build_dir, format):
+    chunks = generate_archive(build_dir, format)
+
+    while True:
+        chunk = await _run_io(request, next, chunks, None)
+
+        if chunk is None:
+            break
+
+        yield chunk
+
+async def _run_io(request, func, *args, **kwargs):
+    loop = _asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app.io_executor, lambda: func(*args, **kwargs))
+
+async def _receive_file(request, writer, meter=None):
+    # Writes are handed to the I/O executor while the next buffer fills
+    # from the network, so at most two buffers are held at a time
+
+    buffer = bytearray()
+    pending = None
+
+    try:
+        async for chunk in request.stream():
+            if meter is not None:
+                meter.add(len(chunk))
+
+            buffer += chunk
+
+            if len(buffer) >= _write_size:
+                if pending is not None:
+                    await pending
+
+                pending = _asyncio.ensure_future(_run_io(request, writer.write, buffer))
+                buffer = bytearray()
+
+        if pending is not None:
+            await pending
+
+        if buffer:
+            await _run_io(request, writer.write, buffer)
+    finally:
+        if pending is not None and not pending.done():
+            await _asyncio.wait([pending])
+
+class _RequestStream(_io.RawIOBase):
+    # A blocking file object over the request body, for use from the
+    # I/O executor.  Each read waits for the next chunk from the loop.
+
+    def __init__(self, request, loop, meter=None):
+        self.chunks = request.stream().__aiter__()
+        self.loop = loop
+        self.meter = meter
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            future = _asyncio.run_coroutine_threadsafe(self._next_chunk(), self.loop)
+            chunk = future.result()
+
+            if chunk is None:
+                return 0
+
+            if self.meter is not None:
+                self.meter.add(len(chunk))
+
+            self.buffer = chunk
+
+        size = min(len(b), len(self.buffer))
+
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+
+        return size
+
+    async def _next_chunk(self):
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+# Blobs found present are refreshed, so garbage collection keeps them
+# for the upload that refers to them
+def _find_missing_files(manifest, store):
+    try:
+        files = manifest["files"]
+        missing = list()
+
+        for entry in files:
+            digest = entry["sha256"]
+
+            if not is_digest(digest) or store.refresh(digest) != entry["size"]:
+                missing.append(entry)
+    except (KeyError, TypeError) as e:
+        raise BadRequestError(f"Malformed manifest: {e}")
+
+    return missing
+
+# Returns a list of (path, size, digest) tuples for the extracted files
+def _extract_tar(stream, output_dir, store):
+    _os.makedirs(output_dir)
+
+    stream = _io.BufferedReader(stream, _write_size)
+    files = dict()
+
+    try:
+        with _tarfile.open(fileobj=stream, mode="r|*") as tar:
+            for member in tar:
+                fs_path = _os.path.normpath(_os.path.join(output_dir, member.name))
+
+                # Tar writes a "./" member first for an archive of "."
+
+                if fs_path == output_dir and member.isdir():
+                    continue
+
+                if not fs_path.startswith(output_dir + _os.sep):
+                    raise BadRequestError(f"Archive member not under the build directory: {member.name}")
+
+                if member.isdir():
+                    _os.makedirs(fs_path, exist_ok=True)
+                elif member.isfile():
+                    # A member with a digest header and no content refers
+                    # to a blob the server already has
+
+                    digest = member.pax_headers.get(_digest_header)
+
+                    if digest is None:
+                        digest = _store_member(tar, member, store)
+                    elif not is_digest(digest) or store.refresh(digest) is None:
+                        raise BadRequestError(f"Unknown blob for archive member: {member.name}")
+
+                    store.link(digest, fs_path)
+
+                    path = _os.path.relpath(fs_path, output_dir)
+                    files[path] = (path, store.blob_size(digest), digest)
+                else:
+                    raise BadRequestError(f"Unsupported archive member type: {member.name}")
+    except _tarfile.TarError as e:
+        raise BadRequestError(f"Failure reading archive: {e}")
+
+    return list(files.values())
+
+def _store_member(tar, member, store):
+    writer = store.open_writer()
+
+    try:
+        with tar.extractfile(member) as source:
+            _shutil.copyfileobj(source, writer, _write_size)
 
-        return DirectoryIndexResponse(request.app.builds_dir, request_path)
+        return writer.commit()
+    except BaseException:
+        writer.abort()
+        raise
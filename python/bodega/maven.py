@@ -0,0 +1,186 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import fcntl as _fcntl
+import hashlib as _hashlib
+import os as _os
+import re as _re
+import time as _time
+
+from xml.sax.saxutils import escape as _escape
+
+from .yum import repo_dir_name
+
+# Maven repos share the repo dir with yum repos.  Artifacts are laid
+# out as repo/{group path}/{artifact}/{version}/{artifact}-{version}*.
+
+metadata_name = "maven-metadata.xml"
+
+# Checksum files are answered from the digest of the file they belong
+# to.  SHA-256 is the stored digest, and the others are computed once
+# per blob.
+checksum_extensions = ("sha1", "md5", "sha256")
+
+_chunk_size = 1024 * 1024
+
+# Returns the path of the artifact dir, relative to the build dir, if
+# the path is a POM in the Maven layout, or else None
+def artifact_dir(path):
+    parts = path.split("/")
+
+    if len(parts) < 5 or parts[0] != repo_dir_name:
+        return None
+
+    artifact, version, name = parts[-3:]
+
+    if name != f"{artifact}-{version}.pom":
+        return None
+
+    return "/".join(parts[:-2])
+
+# Returns the path of the file a checksum file belongs to and the
+# checksum extension, or None if the path is not a checksum file in the
+# repo dir
+def parse_checksum_path(path):
+    base_path, _, extension = path.rpartition(".")
+
+    if extension not in checksum_extensions or not base_path.startswith(f"{repo_dir_name}/"):
+        return None
+
+    return base_path, extension
+
+# Returns a map of checksum extension to hex digest, computed in one
+# pass over the file
+def compute_checksums(fs_path):
+    hashes = {"sha1": _hashlib.sha1(), "md5": _hashlib.md5()}
+
+    with open(fs_path, "rb") as f:
+        while True:
+            chunk = f.read(_chunk_size)
+
+            if not chunk:
+                break
+
+            for hash in hashes.values():
+                hash.update(chunk)
+
+    return {x: y.hexdigest() for x, y in hashes.items()}
+
+# Regenerates maven-metadata.xml in each of the artifact dirs, given
+# relative to the build dir.  The generated files are added to the blob
+# store and linked into place.
+#
+# Returns the generated files as (path, size, digest) tuples, relative
+# to the build dir.
+def update_metadata(build_dir, artifact_dirs, store):
+    generated = list()
+
+    for path in sorted(artifact_dirs):
+        fs_path = _os.path.join(build_dir, path)
+        fd = _os.open(fs_path, _os.O_RDONLY)
+
+        # Updates of the same artifact in other workers wait here
+        try:
+            _fcntl.flock(fd, _fcntl.LOCK_EX)
+
+            data = make_metadata(fs_path, path)
+
+            if data is None:
+                continue
+
+            writer = store.open_writer()
+
+            try:
+                writer.write(data)
+                digest = writer.commit()
+            except BaseException:
+                writer.abort()
+                raise
+
+            store.link(digest, _os.path.join(fs_path, metadata_name))
+            generated.append((f"{path}/{metadata_name}", len(data), digest))
+        finally:
+            _os.close(fd)
+
+    return generated
+
+# Returns the metadata document for the artifact dir, or None if it has
+# no versions.  The versions are the subdirs holding a POM.  The output
+# depends only on the POMs, so an unchanged artifact gets the same
+# document.
+def make_metadata(fs_path, path):
+    parts = path.split("/")
+    group_id = ".".join(parts[1:-1])
+    artifact_id = parts[-1]
+    versions = list()
+    last_updated = 0
+
+    for version in _os.listdir(fs_path):
+        try:
+            stat_result = _os.stat(_os.path.join(fs_path, version, f"{artifact_id}-{version}.pom"))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        versions.append(version)
+        last_updated = max(last_updated, stat_result.st_mtime)
+
+    if not versions:
+        return None
+
+    versions.sort(key=_version_key)
+    releases = [x for x in versions if not x.endswith("-SNAPSHOT")]
+
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<metadata>",
+        f"  <groupId>{_escape(group_id)}</groupId>",
+        f"  <artifactId>{_escape(artifact_id)}</artifactId>",
+        "  <versioning>",
+        f"    <latest>{_escape(versions[-1])}</latest>",
+    ]
+
+    if releases:
+        lines.append(f"    <release>{_escape(releases[-1])}</release>")
+
+    lines.append("    <versions>")
+    lines.extend(f"      <version>{_escape(x)}</version>" for x in versions)
+    lines.append("    </versions>")
+    lines.append(f"    <lastUpdated>{_time.strftime('%Y%m%d%H%M%S', _time.gmtime(last_updated))}</lastUpdated>")
+    lines.append("  </versioning>")
+    lines.append("</metadata>")
+
+    return ("\n".join(lines) + "\n").encode()
+
+_version_token_regex = _re.compile(r"\d+|[^\W\d_]+")
+
+# An approximation of Maven version order.  Numbers compare as numbers,
+# and a qualifier, such as alpha or SNAPSHOT, sorts before the end of
+# the version, so 1.0-beta comes before 1.0 and 1.0 before 1.0.1.
+def _version_key(version):
+    key = list()
+
+    for token in _version_token_regex.findall(version):
+        if token.isdigit():
+            key.append((2, int(token)))
+        else:
+            key.append((0, token.lower()))
+
+    key.append((1, ""))
+
+    return key
@@ -0,0 +1,127 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import glob as _glob
+import json as _json
+import logging as _logging
+import os as _os
+import threading as _threading
+import time as _time
+import traceback as _traceback
+
+_log = _logging.getLogger("metrics")
+
+def describe_metrics(metrics):
+    metrics.describe("bodega_repo_bytes", "gauge", "Bytes in the builds of each repo, before deduplication")
+    metrics.describe("bodega_repo_builds", "gauge", "Builds in each repo")
+    metrics.describe("bodega_uploads_in_progress", "gauge", "Uploads in progress in all workers")
+    metrics.describe("bodega_cleaner_passes_total", "counter", "Completed cleaner passes")
+    metrics.describe("bodega_cleaner_pass_duration_seconds", "histogram", "Duration of cleaner passes",
+                     buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+    metrics.describe("bodega_cleaner_builds_deleted_total", "counter", "Builds deleted by the cleaner")
+    metrics.describe("bodega_cleaner_bytes_freed_total", "counter", "Bytes freed by the cleaner")
+    metrics.describe("bodega_cleaner_builds_evicted_total", "counter",
+                     "Builds deleted by the cleaner for being over quota")
+    metrics.describe("bodega_quota_rejections_total", "counter",
+                     "Uploads rejected for exceeding a hard quota, by repo")
+    metrics.describe("bodega_stagger_fetch_duration_seconds", "histogram",
+                     "Duration of tag data requests to Stagger, by result")
+    metrics.describe("bodega_file_cache_hits_total", "counter", "Requests answered from the file cache")
+    metrics.describe("bodega_file_cache_misses_total", "counter", "File cache lookups that found no entry")
+    metrics.describe("bodega_file_cache_evictions_total", "counter", "Entries evicted from the file cache")
+    metrics.describe("bodega_file_cache_entries", "gauge", "Entries in the file cache")
+    metrics.describe("bodega_file_cache_bytes", "gauge", "Bytes held by the file cache")
+    metrics.describe("bodega_directory_cache_hits_total", "counter", "Directory listings answered from the cache")
+    metrics.describe("bodega_directory_cache_misses_total", "counter", "Directory listings loaded anew")
+    metrics.describe("bodega_directory_cache_entries", "gauge", "Entries in the directory cache")
+
+# Sets the values that are read from the catalog when the metrics are
+# rendered.  The cache counts belong to each process, so they go into
+# its snapshots and are summed with those of the others.
+def add_collectors(metrics, app):
+    def collect(merged):
+        for repo, builds, size in app.catalog.get_repo_usage():
+            merged.set("bodega_repo_bytes", size, (("repo", repo),))
+            merged.set("bodega_repo_builds", builds, (("repo", repo),))
+
+        merged.set("bodega_uploads_in_progress", app.active_uploads)
+
+    def sample(metrics):
+        file_cache = app.file_cache.stats()
+        directory_cache = app.directory_cache.stats()
+
+        metrics.set("bodega_file_cache_hits_total", file_cache["hits"])
+        metrics.set("bodega_file_cache_misses_total", file_cache["misses"])
+        metrics.set("bodega_file_cache_evictions_total", file_cache["evictions"])
+        metrics.set("bodega_file_cache_entries", file_cache["entries"])
+        metrics.set("bodega_file_cache_bytes", file_cache["bytes"])
+        metrics.set("bodega_directory_cache_hits_total", directory_cache["hits"])
+        metrics.set("bodega_directory_cache_misses_total", directory_cache["misses"])
+        metrics.set("bodega_directory_cache_entries", directory_cache["entries"])
+
+    metrics.collectors.append(collect)
+    metrics.samplers.append(sample)
+
+# With several worker processes, each process writes a snapshot of its
+# metrics to the metrics dir at an interval, and the process answering a
+# scrape merges the snapshots of the others with its own.  Snapshots of
+# exited workers are kept, so their counts are not lost.
+
+class MetricsDumpThread(_threading.Thread):
+    def __init__(self, metrics, metrics_dir, interval=5):
+        super().__init__(name="metrics")
+
+        self.metrics = metrics
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self.daemon = True
+
+    def run(self):
+        while True:
+            _time.sleep(self.interval)
+
+            try:
+                self.dump()
+            except Exception:
+                _traceback.print_exc()
+
+    def dump(self):
+        file = _os.path.join(self.metrics_dir, f"{_os.getpid()}.json")
+        temp_file = f"{file}.temp"
+
+        with open(temp_file, "w") as f:
+            _json.dump(self.metrics.snapshot(), f)
+
+        _os.replace(temp_file, file)
+
+def load_snapshots(metrics_dir):
+    own_file = _os.path.join(metrics_dir, f"{_os.getpid()}.json")
+    snapshots = list()
+
+    for file in _glob.glob(_os.path.join(metrics_dir, "*.json")):
+        if file == own_file:
+            continue
+
+        try:
+            with open(file) as f:
+                snapshots.append(_json.load(f))
+        except (OSError, ValueError) as e:
+            _log.warning(f"Failed reading metrics snapshot {file}: {e}")
+
+    return snapshots
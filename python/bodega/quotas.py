@@ -0,0 +1,181 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import collections as _collections
+import json as _json
+
+# Limits on the bytes and builds of each repo and of each branch.  The
+# soft limits, max_bytes and max_builds, are enforced by the cleaner,
+# which deletes the oldest untagged builds of any repo or branch over
+# them.  The hard limit, hard_max_bytes, is enforced at upload, where a
+# PUT that would take usage past it is rejected before its content is
+# read.
+#
+# Usage comes from the catalog, which keeps the totals of each build
+# as files are added, so it is known without walking the builds tree.
+#
+# The configuration is JSON:
+#
+#   {
+#       "repo": {"max_bytes": ..., "max_builds": ..., "hard_max_bytes": ...},
+#       "branch": {...},
+#       "repos": {
+#           "<repo>": {
+#               "repo": {...},
+#               "branch": {...},
+#               "branches": {"<branch>": {...}}
+#           }
+#       }
+#   }
+#
+# The top-level "repo" and "branch" limits are the defaults for every
+# repo and branch.  Limits that are not set are not enforced.
+
+_limit_names = ("max_bytes", "max_builds", "hard_max_bytes")
+
+class Quotas:
+    def __init__(self, config=None):
+        self.config = config if config is not None else dict()
+
+        for limits in self._all_limits():
+            for name, value in limits.items():
+                if name not in _limit_names or not isinstance(value, int) or value < 0:
+                    raise QuotaConfigError(f"Invalid quota limit: {name}: {value!r}")
+
+    @staticmethod
+    def load(file):
+        with open(file) as f:
+            try:
+                return Quotas(_json.load(f))
+            except ValueError as e:
+                raise QuotaConfigError(f"Failure reading {file}: {e}")
+
+    def repo_limits(self, repo):
+        return self.config.get("repos", {}).get(repo, {}).get("repo", self.config.get("repo", {}))
+
+    def branch_limits(self, repo, branch):
+        repo_config = self.config.get("repos", {}).get(repo, {})
+        limits = repo_config.get("branch", self.config.get("branch", {}))
+
+        return repo_config.get("branches", {}).get(branch, limits)
+
+    def has_hard_limits(self, repo, branch):
+        return ("hard_max_bytes" in self.branch_limits(repo, branch)
+                or "hard_max_bytes" in self.repo_limits(repo))
+
+    # Returns the bytes the branch can still add under its hard limits,
+    # with the message for going past them, or None if it has no hard
+    # limits
+    def get_allowance(self, catalog, repo, branch):
+        branch_limit = self.branch_limits(repo, branch).get("hard_max_bytes")
+        repo_limit = self.repo_limits(repo).get("hard_max_bytes")
+        allowances = list()
+
+        if branch_limit is not None:
+            used = catalog.get_usage(repo, branch)[1]
+            allowances.append((branch_limit - used,
+                               f"Branch {repo}/{branch} would exceed its limit of {branch_limit} bytes"))
+
+        if repo_limit is not None:
+            used = catalog.get_usage(repo)[1]
+            allowances.append((repo_limit - used, f"Repo {repo} would exceed its limit of {repo_limit} bytes"))
+
+        if not allowances:
+            return None
+
+        return min(allowances, key=lambda x: x[0])
+
+    # Returns the builds to delete to bring every branch and then every
+    # repo within its soft limits, oldest first.  Builds for which
+    # is_tagged returns True are kept, as is the newest build of each
+    # branch, which may still be in use by the uploader.  The builds of
+    # a branch are listed only if it or its repo is over a limit.
+    def find_evictions(self, catalog, is_tagged):
+        evictions = list()
+        repo_usage = _collections.defaultdict(lambda: [0, 0])
+        candidates = dict()
+
+        def list_candidates(repo, branch):
+            builds = sorted(catalog.list_branch_builds(repo, branch), key=lambda x: x.created)
+            return [x for x in builds[:-1] if not is_tagged(x.repo, x.branch, x.build)]
+
+        for repo, branch, count, size in catalog.get_branch_usage():
+            limits = self.branch_limits(repo, branch)
+
+            if not _is_within(count, size, limits):
+                branch_candidates = list_candidates(repo, branch)
+                branch_evictions = list(_evict(branch_candidates, count, size, limits))
+
+                evictions.extend(branch_evictions)
+                candidates[(repo, branch)] = branch_candidates[len(branch_evictions):]
+
+                count -= len(branch_evictions)
+                size -= sum(x.total_bytes for x in branch_evictions)
+
+            repo_usage[repo][0] += count
+            repo_usage[repo][1] += size
+
+        for repo, (count, size) in repo_usage.items():
+            limits = self.repo_limits(repo)
+
+            if _is_within(count, size, limits):
+                continue
+
+            repo_candidates = list()
+
+            for branch in catalog.list_branches(repo):
+                if (repo, branch) not in candidates:
+                    candidates[(repo, branch)] = list_candidates(repo, branch)
+
+                repo_candidates.extend(candidates[(repo, branch)])
+
+            repo_candidates.sort(key=lambda x: x.created)
+            evictions.extend(_evict(repo_candidates, count, size, limits))
+
+        return evictions
+
+    def _all_limits(self):
+        yield self.config.get("repo", {})
+        yield self.config.get("branch", {})
+
+        for repo_config in self.config.get("repos", {}).values():
+            yield repo_config.get("repo", {})
+            yield repo_config.get("branch", {})
+            yield from repo_config.get("branches", {}).values()
+
+class QuotaConfigError(Exception):
+    pass
+
+def _is_within(count, size, limits):
+    max_builds = limits.get("max_builds")
+    max_bytes = limits.get("max_bytes")
+
+    return (max_builds is None or count <= max_builds) and (max_bytes is None or size <= max_bytes)
+
+# Yields a leading run of the candidates until the count and size are
+# within the limits
+def _evict(candidates, count, size, limits):
+    for build in candidates:
+        if _is_within(count, size, limits):
+            break
+
+        yield build
+
+        count -= 1
+        size -= build.total_bytes
@@ -0,0 +1,122 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import asyncio as _asyncio
+import logging as _logging
+import os as _os
+import requests as _requests
+
+try:
+    import httpx as _httpx
+except ImportError:
+    _httpx = None
+
+_log = _logging.getLogger("stagger")
+
+# Request failures and malformed data
+_errors = (_requests.RequestException, ValueError)
+
+if _httpx is not None:
+    _errors += (_httpx.HTTPError,)
+
+# The set of tagged builds from Stagger, refreshed with conditional
+# requests so an unchanged document is not downloaded again.  Requests
+# are made with httpx if it is available, and otherwise with requests
+# in an executor thread.
+
+class StaggerTags:
+    def __init__(self, service_url=None, timeout=30):
+        self.service_url = service_url
+        self.timeout = timeout
+
+        if self.service_url is None:
+            self.service_url = _os.environ.get("STAGGER_HTTP_URL")
+
+        self.client = None
+        self.session = None
+        self.etag = None
+        self.last_modified = None
+        self.tagged_builds = frozenset()
+
+    # Returns True if the data changed.  Raises StaggerError if the
+    # data cannot be fetched.
+    async def update(self, executor=None):
+        if not self.service_url:
+            raise StaggerError("No Stagger URL is configured")
+
+        loop = _asyncio.get_running_loop()
+        url = f"{self.service_url}/api/data"
+        headers = dict()
+
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        try:
+            if _httpx is not None:
+                if self.client is None:
+                    self.client = _httpx.AsyncClient(timeout=self.timeout, follow_redirects=True)
+
+                response = await self.client.get(url, headers=headers)
+            else:
+                if self.session is None:
+                    self.session = _requests.Session()
+
+                response = await loop.run_in_executor(executor, lambda: self.session.get(url, headers=headers,
+                                                                                         timeout=self.timeout))
+
+            if response.status_code == 304:
+                return False
+
+            response.raise_for_status()
+
+            # Parsing a large document can take a while, so it is kept
+            # off the event loop
+            tagged_builds = await loop.run_in_executor(executor, lambda: _tagged_builds(response.json()))
+        except _errors as e:
+            raise StaggerError(e)
+
+        self.tagged_builds = tagged_builds
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+
+        _log.info(f"Loaded {len(self.tagged_builds)} tagged builds from Stagger")
+
+        return True
+
+    def is_tagged(self, repo, branch, build_id):
+        return (repo, branch, build_id) in self.tagged_builds
+
+def _tagged_builds(data):
+    builds = set()
+
+    for repo_id, repo in data.get("repos", {}).items():
+        for branch_id, branch in repo.get("branches", {}).items():
+            for tag in branch.get("tags", {}).values():
+                build_id = tag.get("build_id")
+
+                if build_id is not None:
+                    builds.add((repo_id, branch_id, str(build_id)))
+
+    return frozenset(builds)
+
+class StaggerError(Exception):
+    pass
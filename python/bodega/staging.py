@@ -0,0 +1,98 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import os as _os
+import shutil as _shutil
+import time as _time
+
+# Staged builds are written under the staging dir, outside the builds
+# tree, and recorded as staged files in the catalog.  A commit publishes
+# the whole build with one rename, so consumers never see part of it.
+
+class StagingArea:
+    def __init__(self, staging_dir, builds_dir):
+        self.staging_dir = staging_dir
+        self.builds_dir = builds_dir
+
+    def build_dir(self, repo, branch, build):
+        return _os.path.join(self.staging_dir, repo, branch, build)
+
+    # Moves the staged build into place.  Returns False if nothing is
+    # staged for the build, and raises FileExistsError if the build is
+    # already published.
+    def publish(self, repo, branch, build):
+        staged_dir = self.build_dir(repo, branch, build)
+        build_dir = _os.path.join(self.builds_dir, repo, branch, build)
+
+        if not _os.path.isdir(staged_dir):
+            return False
+
+        if _os.path.exists(build_dir):
+            raise FileExistsError(build_dir)
+
+        _os.makedirs(_os.path.dirname(build_dir), exist_ok=True)
+
+        try:
+            _os.rename(staged_dir, build_dir)
+        except OSError:
+            raise FileExistsError(build_dir)
+
+        return True
+
+    # Removes staged builds with no new files for max_age seconds.
+    # Returns the count of removed builds.
+    def collect_garbage(self, catalog, max_age=24 * 60 * 60):
+        now = _time.time()
+        builds = set(catalog.list_staged_builds())
+        count = 0
+
+        for repo in _list_dirs(self.staging_dir):
+            for branch in _list_dirs(_os.path.join(self.staging_dir, repo)):
+                for build in _list_dirs(_os.path.join(self.staging_dir, repo, branch)):
+                    builds.add((repo, branch, build))
+
+        for repo, branch, build in builds:
+            staged_dir = self.build_dir(repo, branch, build)
+
+            # A build being committed has records but no staged dir
+
+            if _os.path.exists(_os.path.join(self.builds_dir, repo, branch, build)):
+                continue
+
+            # File times belong to the shared blobs, so the dir times
+            # show when files were added
+
+            mtimes = [_os.path.getmtime(x[0]) for x in _os.walk(staged_dir)]
+            mtime = max(mtimes, default=0)
+
+            if now - mtime < max_age:
+                continue
+
+            catalog.remove_staged_build(repo, branch, build)
+            _shutil.rmtree(staged_dir, ignore_errors=True)
+
+            count += 1
+
+        return count
+
+def _list_dirs(dir):
+    try:
+        return [x for x in _os.listdir(dir) if _os.path.isdir(_os.path.join(dir, x))]
+    except FileNotFoundError:
+        return []
@@ -17,8 +17,32 @@
 # under the License.
 #
 
+import base64 as _base64
+import fortworth as _fortworth
+import gzip as _gzip
+import hashlib as _hashlib
+import http.server as _http_server
+import io as _io
+import json as _json
+import os as _os
+import requests as _requests
+import signal as _signal
+import struct as _struct
+import subprocess as _subprocess
+import tarfile as _tarfile
+import threading as _threading
+import time as _time
+import xml.etree.ElementTree as _xml_etree
+import zipfile as _zipfile
+
+from bodega.blobs import BlobStore
+from bodega.catalog import Catalog
+from bodega.quotas import Quotas
+from bodega.staging import StagingArea
+from bodega.uploads import UploadSessions
 from commandant import TestSkipped
 from fortworth import *
+from requests.exceptions import HTTPError
 
 def open_test_session(session):
     enable_logging(level="error")
@@ -33,6 +57,15 @@ def test_put_build_python(session):
         bodega_put_build(build_dir, build_info, service_url=server.http_url)
         assert bodega_build_exists(build_info, service_url=server.http_url)
 
+def test_put_build_python_files(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_info = BuildInfo("a", "b", "c")
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, build_info, service_url=server.http_url, archive=False, concurrency=4)
+        assert bodega_build_exists(build_info, service_url=server.http_url)
+
 def test_put_build_curl(session):
     test_data_dir = join(session.module.command.home, "test-data")
     build_dir = join(test_data_dir, "build1")
@@ -52,6 +85,435 @@ def test_put_build_curl(session):
 
         get(build_url)
 
+def test_put_build_archive(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_info = BuildInfo("a", "b", "c")
+
+    with TestServer() as server:
+        build_url = f"{server.http_url}/{build_info.repo}/{build_info.branch}/{build_info.id}"
+
+        bodega_put_build(build_dir, build_info, service_url=server.http_url)
+
+        assert http_get(f"{build_url}/dir1/file4.txt") == read(join(build_dir, "dir1/file4.txt"))
+
+        response = _requests.put(f"{build_url}?format=tar&dry-run=1")
+        assert response.status_code == 409, response.status_code
+
+        # An archive of "." starts with a "./" member
+
+        data = _subprocess.run(["tar", "-C", build_dir, "-cf", "-", "."], stdout=_subprocess.PIPE, check=True).stdout
+        _requests.put(f"{server.http_url}/a/b/dot?format=tar", data=data).raise_for_status()
+
+        assert http_get(f"{server.http_url}/a/b/dot/dir1/file4.txt") == read(join(build_dir, "dir1/file4.txt"))
+
+        try:
+            bodega_put_build(build_dir, build_info, service_url=server.http_url)
+        except HTTPError as e:
+            assert e.response.status_code == 409, e.response.status_code
+        else:
+            assert False, "A second upload of the same build should conflict"
+
+def test_put_build_dedup(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, BuildInfo("a", "b", "1"), service_url=server.http_url)
+        bodega_put_build(build_dir, BuildInfo("a", "b", "2"), service_url=server.http_url)
+        put(f"{server.http_url}/a/b/3/file3.bin", join(build_dir, "file3.bin"))
+
+        builds_dir = join(server.data_dir, "builds")
+        inodes = [_os.stat(join(builds_dir, "a", "b", x, "file3.bin")).st_ino for x in ("1", "2", "3")]
+
+        assert len(set(inodes)) == 1, inodes
+
+def test_put_build_manifest(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+
+    with TestServer() as server:
+        build_url = f"{server.http_url}/a/b/2"
+        manifest = _fortworth._bodega_make_manifest(build_dir)
+        unknown = {"path": "file5.txt", "size": 3, "sha256": 64 * "0"}
+
+        missing = post_json(f"{build_url}?manifest", manifest)["missing"]
+        assert len(missing) == len(manifest["files"]), missing
+
+        bodega_put_build(build_dir, BuildInfo("a", "b", "1"), service_url=server.http_url)
+
+        manifest["files"].append(unknown)
+
+        missing = post_json(f"{build_url}?manifest", manifest)["missing"]
+        assert missing == [unknown], missing
+
+        # Blobs reported present are refreshed, so collection keeps them
+        # for the upload that follows, and their times stay the same
+
+        blob_path = BlobStore(join(server.data_dir, "blobs"), None).blob_path(manifest["files"][0]["sha256"])
+        stat = _os.stat(blob_path)
+
+        _os.remove(join(server.data_dir, "builds", "a", "b", "1", manifest["files"][0]["path"]))
+        sleep(0.1)
+        post_json(f"{build_url}?manifest", manifest)
+
+        assert _os.stat(blob_path).st_ctime_ns > stat.st_ctime_ns
+        assert _os.stat(blob_path).st_mtime_ns == stat.st_mtime_ns
+        assert BlobStore(join(server.data_dir, "blobs"), None).collect_garbage() == (0, 0)
+
+def test_put_resumable(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    content = _os.urandom(100000)
+
+    with TestServer() as server:
+        url = f"{server.http_url}/a/b/c/large.bin"
+
+        response = _requests.post(f"{url}?uploads")
+        assert response.status_code == 201, response.status_code
+
+        upload_url = f"{url}?upload={response.json()['upload_id']}"
+
+        response = _requests.put(upload_url, data=content[:60000],
+                                 headers={"Content-Range": "bytes 0-59999/100000"})
+        assert response.json()["offset"] == 60000, response.json()
+
+        response = _requests.put(upload_url, data=content[50000:],
+                                 headers={"Content-Range": "bytes 50000-99999/100000"})
+        assert response.status_code == 409, response.status_code
+        assert response.headers["Upload-Offset"] == "60000", response.headers
+
+        assert _requests.head(upload_url).headers["Upload-Offset"] == "60000"
+
+        response = _requests.put(upload_url, data=content[60000:],
+                                 headers={"Content-Range": "bytes 60000-99999/100000"})
+        assert response.json()["offset"] == 100000, response.json()
+
+        _requests.post(f"{upload_url}&commit").raise_for_status()
+
+        assert _requests.get(url).content == content
+        assert _requests.head(upload_url).status_code == 404
+
+        abandoned_url = f"{url}?upload={_requests.post(f'{url}?uploads').json()['upload_id']}"
+        sessions = UploadSessions(join(server.data_dir, "uploads"))
+
+        assert sessions.collect_garbage(max_age=0)[0] == 1
+        assert _requests.head(abandoned_url).status_code == 404
+
+        resumable_size = _fortworth._bodega_resumable_size
+        _fortworth._bodega_resumable_size = 1
+
+        try:
+            bodega_put_build(build_dir, BuildInfo("a", "b", "d"), service_url=server.http_url, archive=False)
+        finally:
+            _fortworth._bodega_resumable_size = resumable_size
+
+        assert http_get(f"{server.http_url}/a/b/d/dir1/file4.txt") == read(join(build_dir, "dir1/file4.txt"))
+
+def test_put_staged(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+
+    with TestServer() as server:
+        build_url = f"{server.http_url}/a/b/c"
+
+        _requests.post(f"{build_url}?commit&dry-run=1").raise_for_status()
+        assert _requests.post(f"{build_url}?commit").status_code == 404
+
+        _requests.put(f"{build_url}/x.txt?staged=1", data=b"x").raise_for_status()
+        _requests.put(f"{build_url}/dir/y.txt?staged=1", data=b"y").raise_for_status()
+
+        assert _requests.get(build_url).status_code == 404
+        assert _requests.get(f"{build_url}/x.txt").status_code == 404
+        assert not bodega_build_exists(BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        _requests.post(f"{build_url}?commit").raise_for_status()
+
+        assert bodega_build_exists(BuildInfo("a", "b", "c"), service_url=server.http_url)
+        assert http_get(f"{build_url}/dir/y.txt") == "y"
+        assert _requests.get(f"{server.http_url}/a/b?format=json").json()["entries"][0]["size"] == 2
+
+        assert _requests.post(f"{build_url}?commit").status_code == 409
+        assert _requests.put(f"{build_url}/z.txt?staged=1", data=b"z").status_code == 409
+
+        _requests.put(f"{server.http_url}/a/b/d/x.txt?staged=1", data=b"x").raise_for_status()
+        staging_area = StagingArea(join(server.data_dir, "staging"), join(server.data_dir, "builds"))
+        catalog = Catalog(join(server.data_dir, "catalog.db"))
+        catalog.open(join(server.data_dir, "builds"))
+
+        try:
+            assert staging_area.collect_garbage(catalog, max_age=0) == 1
+            assert catalog.list_staged_builds() == []
+        finally:
+            catalog.close()
+
+        bodega_put_build(build_dir, BuildInfo("a", "b", "e"), service_url=server.http_url, archive=False)
+
+        assert http_get(f"{server.http_url}/a/b/e/dir1/file4.txt") == read(join(build_dir, "dir1/file4.txt"))
+        assert not exists(join(server.data_dir, "staging", "a", "b", "e"))
+
+def test_quotas(session):
+    with temp_working_dir():
+        write_json("quotas.json", {
+            "branch": {"max_builds": 2},
+            "repos": {
+                "a": {"branch": {"hard_max_bytes": 1000}},
+                "b": {"repo": {"max_bytes": 150}},
+            },
+        })
+
+        with TestServer(BODEGA_QUOTAS_FILE=_os.path.abspath("quotas.json")) as server:
+            _requests.put(f"{server.http_url}/a/main/1/x.bin", data=bytes(600)).raise_for_status()
+
+            response = _requests.put(f"{server.http_url}/a/main/2/x.bin", data=bytes(600))
+            assert response.status_code == 507, response.status_code
+
+            response = _requests.put(f"{server.http_url}/a/main/2?format=tar", data=bytes(600))
+            assert response.status_code == 507, response.status_code
+
+            # Chunked uploads have no declared length and are counted as
+            # they arrive
+
+            response = _requests.put(f"{server.http_url}/a/main/2/x.bin", data=(bytes(100) for i in range(6)))
+            assert response.status_code == 507, response.status_code
+
+            with temp_working_dir():
+                write("build/x.bin", "x" * 600)
+
+                try:
+                    bodega_put_build("build", BuildInfo("a", "main", "2"), service_url=server.http_url)
+                except HTTPError as e:
+                    assert e.response.status_code == 507, e.response.status_code
+                else:
+                    raise Exception("The upload was not rejected")
+
+            assert _requests.head(f"{server.http_url}/a/main/2/x.bin").status_code == 404
+
+            _requests.put(f"{server.http_url}/a/other/1/x.bin", data=bytes(600)).raise_for_status()
+
+            for build in range(1, 5):
+                _requests.put(f"{server.http_url}/c/main/{build}/x.bin", data=bytes(10)).raise_for_status()
+
+            for branch in ("main", "other"):
+                for build in range(1, 3):
+                    _requests.put(f"{server.http_url}/b/{branch}/{build}/x.bin", data=bytes(50)).raise_for_status()
+
+            quotas = Quotas.load("quotas.json")
+            catalog = Catalog(join(server.data_dir, "catalog.db"))
+            catalog.open(join(server.data_dir, "builds"))
+
+            try:
+                is_tagged = lambda repo, branch, build: (repo, branch, build) == ("c", "main", "1")
+                evictions = [(x.repo, x.branch, x.build) for x in quotas.find_evictions(catalog, is_tagged)]
+            finally:
+                catalog.close()
+
+            assert evictions == [("c", "main", "2"), ("c", "main", "3"), ("b", "main", "1")], evictions
+
+def test_get_build_meta(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_files = sorted(x[len(build_dir) + 1:] for x in find(build_dir) if is_file(x))
+    build_info = BuildInfo("a", "b", "c")
+
+    with TestServer() as server:
+        assert _requests.head(f"{server.http_url}/a/b/c?meta").status_code == 404
+        assert bodega_get_build_meta(build_info, service_url=server.http_url) is None
+
+        bodega_put_build(build_dir, build_info, service_url=server.http_url)
+
+        assert _requests.head(f"{server.http_url}/a/b/c?meta").status_code == 200
+
+        manifest = "".join(f"{_hashlib.sha256(open(join(build_dir, x), 'rb').read()).hexdigest()}  {x}\n"
+                           for x in build_files)
+        meta = bodega_get_build_meta(build_info, service_url=server.http_url)
+
+        assert meta["file_count"] == len(build_files), meta
+        assert meta["total_bytes"] == sum(file_size(join(build_dir, x)) for x in build_files), meta
+        assert meta["manifest_sha256"] == _hashlib.sha256(manifest.encode()).hexdigest(), meta
+
+        _requests.put(f"{server.http_url}/a/b/c/extra.txt", data=b"extra").raise_for_status()
+
+        changed = bodega_get_build_meta(build_info, service_url=server.http_url)
+
+        assert changed["file_count"] == len(build_files) + 1, changed
+        assert changed["manifest_sha256"] != meta["manifest_sha256"], changed
+
+def test_put_build_rpms(session):
+    def repodata(base_url):
+        repomd = _xml_etree.fromstring(_requests.get(f"{base_url}/repo/repodata/repomd.xml").content)
+        ns = {"repo": "http://linux.duke.edu/metadata/repo", "common": "http://linux.duke.edu/metadata/common"}
+        href = repomd.find("repo:data[@type='primary']/repo:location", ns).get("href")
+        primary = _xml_etree.fromstring(_gzip.decompress(_requests.get(f"{base_url}/repo/{href}").content))
+        packages = {x.find("common:name", ns).text: x for x in primary.findall("common:package", ns)}
+
+        return href, packages, ns
+
+    foo = _make_rpm("foo", "1.0", "1", ["/usr/bin/foo", "/usr/share/doc/foo"], ["bar >= 2.0"])
+    bar = _make_rpm("bar", "2.0", "3", ["/usr/lib/bar.so"], [])
+
+    with TestServer() as server, temp_working_dir():
+        base_url = f"{server.http_url}/a/b/1"
+
+        _requests.put(f"{base_url}/repo/x86_64/foo-1.0-1.x86_64.rpm", data=foo).raise_for_status()
+
+        for i in range(50):
+            if _requests.head(f"{base_url}/repo/repodata/repomd.xml").status_code == 200:
+                break
+
+            sleep(0.1)
+        else:
+            raise Exception("No repodata was generated")
+
+        href, packages, ns = repodata(base_url)
+        entry = packages["foo"]
+
+        assert entry.find("common:checksum", ns).text == _hashlib.sha256(foo).hexdigest()
+        assert entry.find("common:location", ns).get("href") == "x86_64/foo-1.0-1.x86_64.rpm"
+        assert entry.find("common:format/{http://linux.duke.edu/metadata/common}file", ns).text == "/usr/bin/foo"
+
+        requires = entry.find("common:format/{http://linux.duke.edu/metadata/rpm}requires", ns)[0]
+        assert (requires.get("name"), requires.get("flags"), requires.get("ver")) == ("bar", "GE", "2.0")
+
+        _requests.put(f"{base_url}/repo/x86_64/bar-2.0-3.x86_64.rpm", data=bar).raise_for_status()
+
+        for i in range(50):
+            if len(repodata(base_url)[1]) == 2:
+                break
+
+            sleep(0.1)
+        else:
+            raise Exception("The repodata was not updated")
+
+        assert _requests.get(f"{base_url}/repo/{href}").status_code == 404
+        assert len(find(join(server.data_dir, "packages"), "*.json")) == 2
+
+        # Repodata written by the client is replaced
+
+        _requests.put(f"{base_url}/repo/repodata/repomd.xml", data=b"stale").raise_for_status()
+
+        for i in range(50):
+            if _requests.get(f"{base_url}/repo/repodata/repomd.xml").content != b"stale":
+                break
+
+            sleep(0.1)
+        else:
+            raise Exception("The repodata was not regenerated")
+
+        assert len(repodata(base_url)[1]) == 2
+
+        write("build/repo/x86_64/foo-1.0-1.x86_64.rpm", "")
+        write("build/repo/repodata/stale-primary.xml.gz", "stale")
+
+        with open("build/repo/x86_64/foo-1.0-1.x86_64.rpm", "wb") as f:
+            f.write(foo)
+
+        for build, archive in (("2", True), ("3", False)):
+            bodega_put_build("build", BuildInfo("a", "b", build), service_url=server.http_url, archive=archive)
+
+            base_url = f"{server.http_url}/a/b/{build}"
+            href, packages, ns = repodata(base_url)
+
+            assert list(packages) == ["foo"], packages
+            assert _requests.get(f"{base_url}/repo/repodata/stale-primary.xml.gz").status_code == 404
+
+            meta = bodega_get_build_meta(BuildInfo("a", "b", build), service_url=server.http_url)
+            assert meta["file_count"] == 5, meta
+
+def test_maven_metadata(session):
+    pom = b"<project/>\n"
+    jar = b"PK jar content\n"
+
+    with TestServer() as server, temp_working_dir():
+        for version in ("1.1", "1.0", "1.1-beta"):
+            write(f"build/repo/org/example/foo/{version}/foo-{version}.pom", pom.decode())
+            write(f"build/repo/org/example/foo/{version}/foo-{version}.jar", jar.decode())
+            write(f"build/repo/org/example/foo/{version}/foo-{version}.jar.sha1", "stale")
+
+        write("build/repo/org/example/foo/maven-metadata-local.xml", "<metadata/>")
+        write("build/notes.txt", "notes")
+
+        for build, archive in (("1", True), ("2", False)):
+            bodega_put_build("build", BuildInfo("a", "b", build), service_url=server.http_url, archive=archive,
+                             exclude=_fortworth._maven_generated_files)
+
+            artifact_url = f"{server.http_url}/a/b/{build}/repo/org/example/foo"
+
+            response = _requests.get(f"{artifact_url}/maven-metadata.xml")
+            response.raise_for_status()
+
+            metadata = _xml_etree.fromstring(response.content)
+
+            assert metadata.findtext("groupId") == "org.example"
+            assert metadata.findtext("artifactId") == "foo"
+            assert metadata.findtext("versioning/latest") == "1.1"
+            assert metadata.findtext("versioning/release") == "1.1"
+            assert [x.text for x in metadata.findall("versioning/versions/version")] == ["1.0", "1.1-beta", "1.1"]
+
+            assert _requests.get(f"{artifact_url}/maven-metadata-local.xml").status_code == 404
+
+            for extension, hash in (("sha1", _hashlib.sha1), ("md5", _hashlib.md5), ("sha256", _hashlib.sha256)):
+                response = _requests.get(f"{artifact_url}/1.0/foo-1.0.jar.{extension}")
+                response.raise_for_status()
+
+                assert response.text == hash(jar).hexdigest(), response.text
+
+                response = _requests.get(f"{artifact_url}/1.0/foo-1.0.jar.{extension}",
+                                         headers={"If-None-Match": response.headers["etag"]})
+                assert response.status_code == 304, response.status_code
+
+            response = _requests.get(f"{artifact_url}/maven-metadata.xml.sha1")
+            response.raise_for_status()
+
+            assert response.text == _hashlib.sha1(_requests.get(f"{artifact_url}/maven-metadata.xml").content).hexdigest()
+
+            assert _requests.get(f"{artifact_url}/1.0/foo-1.0.war.sha1").status_code == 404
+            assert _requests.get(f"{server.http_url}/a/b/{build}/notes.txt.sha1").status_code == 404
+
+        # The checksums of each distinct blob are computed once
+        assert len(find(join(server.data_dir, "checksums"), "*.json")) == 2
+
+        artifact_url = f"{server.http_url}/a/b/1/repo/org/example/foo"
+
+        _requests.put(f"{artifact_url}/1.2/foo-1.2.pom", data=pom).raise_for_status()
+
+        metadata = _xml_etree.fromstring(_requests.get(f"{artifact_url}/maven-metadata.xml").content)
+        assert metadata.findtext("versioning/latest") == "1.2"
+
+        _requests.put(f"{artifact_url}/2.0-SNAPSHOT/foo-2.0-SNAPSHOT.pom", data=pom).raise_for_status()
+
+        metadata = _xml_etree.fromstring(_requests.get(f"{artifact_url}/maven-metadata.xml").content)
+        assert metadata.findtext("versioning/latest") == "2.0-SNAPSHOT"
+        assert metadata.findtext("versioning/release") == "1.2"
+
+def test_catalog(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_files = [x for x in find(build_dir) if is_file(x)]
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, BuildInfo("a", "b", "1"), service_url=server.http_url)
+        bodega_put_build(build_dir, BuildInfo("a", "b", "2"), service_url=server.http_url, archive=False)
+
+        catalog = Catalog(join(server.data_dir, "catalog.db"))
+        catalog.open(join(server.data_dir, "builds"))
+
+        for build_id in ("1", "2"):
+            build = catalog.get_build("a", "b", build_id)
+
+            assert build.file_count == len(build_files), build
+            assert build.total_bytes == sum(file_size(x) for x in build_files), build
+
+        assert catalog.list_build_ids("a", "b") == ["1", "2"]
+        assert "/a/b/2" in http_get(f"{server.http_url}/a/b")
+
+        # Access times are remembered only for builds that exist
+
+        catalog.touch_build("a", "b", "1")
+        catalog.touch_build("a", "b", "3")
+
+        assert list(catalog.access_times) == [("a", "b", "1")], catalog.access_times
+
 def test_put_build_dry_run(session):
     test_data_dir = join(session.module.command.home, "test-data")
     build_dir = join(test_data_dir, "build1")
@@ -86,6 +548,425 @@ def test_get(session):
         get(f"{server.http_url}")
         get(f"{server.http_url}/")
 
+def test_get_range(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_info = BuildInfo("a", "b", "c")
+    content = read(join(build_dir, "file1.txt")).encode()
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, build_info, service_url=server.http_url)
+
+        file_url = f"{server.http_url}/a/b/c/file1.txt"
+
+        response = _requests.get(file_url, headers={"Range": "bytes=1-3"})
+        assert response.status_code == 206, response.status_code
+        assert response.content == content[1:4], response.content
+        assert response.headers["Content-Range"] == f"bytes 1-3/{len(content)}"
+
+        response = _requests.get(file_url, headers={"Range": "bytes=0-0,-2"})
+        assert response.status_code == 206, response.status_code
+        assert response.headers["Content-Type"].startswith("multipart/byteranges")
+        assert content[:1] in response.content and content[-2:] in response.content
+
+        response = _requests.get(file_url, headers={"Range": f"bytes={len(content)}-"})
+        assert response.status_code == 416, response.status_code
+
+        response = _requests.get(file_url, headers={"Range": "bytes=1-3", "If-Range": '"stale"'})
+        assert response.status_code == 200, response.status_code
+        assert response.content == content
+
+        etag = response.headers["ETag"]
+        response = _requests.get(file_url, headers={"Range": "bytes=1-3", "If-Range": etag})
+        assert response.status_code == 206, response.status_code
+
+        head(file_url)
+
+def test_get_conditional(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_info = BuildInfo("a", "b", "c")
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, build_info, service_url=server.http_url)
+
+        for url in (f"{server.http_url}/a/b/c/file1.txt", f"{server.http_url}/a/b/c/dir1",
+                    f"{server.http_url}/a/b"):
+            response = _requests.get(url)
+            assert response.status_code == 200, response.status_code
+
+            etag = response.headers["ETag"]
+
+            response = _requests.get(url, headers={"If-None-Match": etag})
+            assert response.status_code == 304, response.status_code
+            assert response.headers["ETag"] == etag
+
+            response = _requests.get(url, headers={"If-None-Match": '"other"'})
+            assert response.status_code == 200, response.status_code
+
+        url = f"{server.http_url}/a/b/c/file1.txt"
+        last_modified = _requests.head(url).headers["Last-Modified"]
+
+        response = _requests.get(url, headers={"If-Modified-Since": last_modified})
+        assert response.status_code == 304, response.status_code
+
+def test_put_digest(session):
+    content = b"x" * 100000
+    sha256 = _base64.b64encode(_hashlib.sha256(content).digest()).decode()
+    md5 = _base64.b64encode(_hashlib.md5(content).digest()).decode()
+    other = _base64.b64encode(_hashlib.sha256(b"y").digest()).decode()
+
+    with TestServer() as server:
+        url = f"{server.http_url}/a/b/c/file.bin"
+
+        response = _requests.put(url, data=content, headers={"Digest": f"SHA-256={other}"})
+        assert response.status_code == 400, response.status_code
+
+        response = _requests.put(url, data=content, headers={"Content-MD5": sha256})
+        assert response.status_code == 400, response.status_code
+
+        assert _requests.get(url).status_code == 404
+
+        _requests.put(url, data=content, headers={"Digest": f"sha-256={sha256}",
+                                                  "Content-MD5": md5}).raise_for_status()
+
+        response = _requests.get(url)
+        assert response.headers["Digest"] == f"sha-256={sha256}", response.headers
+        assert response.headers["ETag"] == f'"{_hashlib.sha256(content).hexdigest()}"', response.headers
+
+        response = _requests.get(url, headers={"Range": "bytes=0-9", "If-Range": response.headers["ETag"]})
+        assert response.status_code == 206, response.status_code
+
+        response = _requests.post(f"{url}?uploads")
+        upload_url = f"{url}?upload={response.json()['upload_id']}"
+
+        _requests.put(upload_url, data=content, headers={"Content-Range": "bytes 0-99999/100000"})
+
+        response = _requests.post(f"{upload_url}&commit", headers={"Digest": f"sha-256={other}"})
+        assert response.status_code == 400, response.status_code
+
+        response = _requests.post(f"{upload_url}&commit", headers={"Digest": f"sha-256={sha256}"})
+        assert response.status_code == 200, response.status_code
+
+def test_get_compressed(session):
+    with TestServer() as server, temp_working_dir():
+        content = "<metadata>\n" + "  <version>1.0</version>\n" * 200 + "</metadata>\n"
+        write("build/repo/maven-metadata.xml", content)
+        write("build/repo/data.zip", content)
+
+        bodega_put_build("build", BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        assert len(find(join(server.data_dir, "blobs"), "*.gz")) == 1
+
+        for path in ("maven-metadata.xml", "data.zip"):
+            url = f"{server.http_url}/a/b/c/repo/{path}"
+
+            response = _requests.get(url, headers={"Accept-Encoding": "gzip"})
+            assert response.status_code == 200, response.status_code
+            assert response.text == content
+
+            encoding = response.headers.get("Content-Encoding")
+            assert encoding == ("gzip" if path.endswith(".xml") else None), encoding
+
+            response = _requests.get(url, headers={"Accept-Encoding": "identity"})
+            assert "Content-Encoding" not in response.headers
+            assert response.text == content
+
+def test_get_cached(session):
+    with TestServer() as server:
+        url = f"{server.http_url}/a/b/c/repodata/repomd.xml"
+        content = "<repomd>\n" + "  <data/>\n" * 200 + "</repomd>\n"
+
+        _requests.put(url, data=content).raise_for_status()
+
+        for i in range(3):
+            response = _requests.get(url, headers={"Accept-Encoding": "gzip"})
+            assert response.status_code == 200, response.status_code
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.text == content
+
+        values = _get_metrics(server)
+        assert values["bodega_file_cache_hits_total"] == "2", values
+        assert values["bodega_file_cache_entries"] == "1", values
+
+        response = _requests.get(url, headers={"Range": "bytes=0-8", "Accept-Encoding": "identity"})
+        assert response.status_code == 206, response.status_code
+        assert response.text == content[:9]
+
+        _requests.put(url, data="<repomd/>\n").raise_for_status()
+
+        response = _requests.get(url)
+        assert response.text == "<repomd/>\n", response.text
+
+def test_get_directory_json(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        data = _requests.get(f"{server.http_url}/a/b/c/dir1?format=json").json()
+        names = [x["name"] for x in data["entries"]]
+
+        assert names == sorted(_os.listdir(join(build_dir, "dir1"))), names
+
+        entry = [x for x in data["entries"] if x["name"] == "file4.txt"][0]
+        assert entry["size"] == file_size(join(build_dir, "dir1/file4.txt")), entry
+        assert len(entry["sha256"]) == 64, entry
+
+        data = _requests.get(f"{server.http_url}/a/b", headers={"Accept": "application/json"}).json()
+        assert [x["name"] for x in data["entries"]] == ["c"], data
+
+        bodega_put_build(build_dir, BuildInfo("a", "b", "d"), service_url=server.http_url)
+
+        data = _requests.get(f"{server.http_url}/a/b?format=json").json()
+        assert [x["name"] for x in data["entries"]] == ["c", "d"], data
+
+        values = _get_metrics(server)
+        assert values["bodega_directory_cache_misses_total"] == "3", values
+
+def test_get_directory_compressed(session):
+    with TestServer() as server, temp_working_dir():
+        for i in range(30):
+            write(f"build/file{i}.txt", "x")
+
+        bodega_put_build("build", BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        for params, media_type in (("", "text/html"), ("?format=json", "application/json")):
+            url = f"{server.http_url}/a/b/c{params}"
+
+            response = _requests.get(url, headers={"Accept-Encoding": "identity"})
+            assert "Content-Encoding" not in response.headers
+            assert response.headers["Vary"] == "Accept, Accept-Encoding", response.headers
+            content, etag = response.content, response.headers["ETag"]
+
+            response = _requests.get(url, headers={"Accept-Encoding": "gzip"})
+            assert response.headers["Content-Encoding"] == "gzip", response.headers
+            assert response.headers["Content-Type"].startswith(media_type), response.headers
+            assert response.headers["ETag"] == etag[:-1] + '-gzip"', response.headers
+            assert response.content == content
+
+            headers = {"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]}
+            response = _requests.get(url, headers=headers)
+            assert response.status_code == 304, response.status_code
+
+def test_get_archive(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_files = sorted(x[len(build_dir) + 1:] for x in find(build_dir) if is_file(x))
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        for format in ("tar", "tar.gz", "zip"):
+            url = f"{server.http_url}/a/b/c?archive={format}"
+            response = _requests.get(url)
+            assert response.status_code == 200, response.status_code
+
+            if format == "zip":
+                with _zipfile.ZipFile(_io.BytesIO(response.content)) as archive:
+                    names = sorted(archive.namelist())
+                    content = archive.read("dir1/file4.txt")
+            else:
+                with _tarfile.open(fileobj=_io.BytesIO(response.content)) as archive:
+                    names = sorted(archive.getnames())
+                    content = archive.extractfile("dir1/file4.txt").read()
+
+            assert names == build_files, names
+            assert content.decode() == read(join(build_dir, "dir1/file4.txt"))
+
+            response = _requests.get(url, headers={"If-None-Match": response.headers["ETag"]})
+            assert response.status_code == 304, response.status_code
+
+        # Replacing a file with content of the same size changes the ETag
+
+        etag = _requests.get(f"{server.http_url}/a/b/c?archive=tar").headers["ETag"]
+        content = read(join(build_dir, "dir1/file4.txt"))
+
+        _requests.put(f"{server.http_url}/a/b/c/dir1/file4.txt", data=content.upper()).raise_for_status()
+
+        response = _requests.get(f"{server.http_url}/a/b/c?archive=tar", headers={"If-None-Match": etag})
+        assert response.status_code == 200, response.status_code
+        assert response.headers["ETag"] != etag
+
+        response = _requests.get(f"{server.http_url}/a/b/d?archive=tar")
+        assert response.status_code == 404, response.status_code
+
+        response = _requests.get(f"{server.http_url}/a/b/c?archive=rar")
+        assert response.status_code == 400, response.status_code
+
+def test_workers(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_files = [x for x in find(build_dir) if is_file(x)]
+
+    with TestServer(BODEGA_WORKERS=2) as server:
+        with open(f"/proc/{server.pid}/task/{server.pid}/children") as f:
+            workers = f.read().split()
+
+        assert len(workers) == 2, workers
+
+        bodega_put_build(build_dir, BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        for i in range(4):
+            for fs_path in build_files:
+                path = fs_path[len(build_dir) + 1:]
+                response = _requests.get(f"{server.http_url}/a/b/c/{path}", headers={"Connection": "close"})
+
+                assert response.status_code == 200, response.status_code
+
+                with open(fs_path, "rb") as f:
+                    assert response.content == f.read()
+
+        assert "/a/b/c" in http_get(f"{server.http_url}/a/b")
+
+        # A worker killed during an upload is restarted, and its upload
+        # no longer counts as in progress.  Its metrics snapshot is
+        # removed.
+
+        killed = _threading.Event()
+
+        def body():
+            yield b"x"
+            killed.wait(10)
+            yield b"x"
+
+        upload = _threading.Thread(target=_requests.put, args=(f"{server.http_url}/a/b/d/x.bin",),
+                                   kwargs={"data": body()}, daemon=True)
+        upload.start()
+
+        sleep(1)
+        assert "bodega_uploads_in_progress 1" in http_get(f"{server.http_url}/metrics")
+
+        snapshots = [join(server.data_dir, "metrics", f"{x}.json") for x in workers]
+
+        for i in range(70):
+            if all(_os.path.exists(x) for x in snapshots):
+                break
+
+            sleep(0.1)
+        else:
+            raise Exception("The metrics snapshots were not written")
+
+        for pid in workers:
+            _os.kill(int(pid), _signal.SIGKILL)
+
+        killed.set()
+
+        for i in range(50):
+            try:
+                if "bodega_uploads_in_progress 0" in http_get(f"{server.http_url}/metrics"):
+                    break
+            except CalledProcessError:
+                pass
+
+            sleep(0.1)
+        else:
+            raise Exception("The upload count was not reset")
+
+        assert not any(_os.path.exists(x) for x in snapshots), _os.listdir(join(server.data_dir, "metrics"))
+
+def test_metrics(session):
+    test_data_dir = join(session.module.command.home, "test-data")
+    build_dir = join(test_data_dir, "build1")
+    build_files = [x for x in find(build_dir) if is_file(x)]
+
+    with TestServer() as server:
+        bodega_put_build(build_dir, BuildInfo("a", "b", "c"), service_url=server.http_url)
+
+        for i in range(3):
+            get(f"{server.http_url}/a/b/c/file1.txt")
+
+        values = _get_metrics(server)
+
+        route = "/{repo_id}/{branch_id}/{build_id}/{path:path}"
+        key = f'http_requests_total{{route="{route}",method="GET",status="200"}}'
+        assert values[key] == "3", values
+
+        key = f'http_request_duration_seconds_count{{route="{route}",method="GET"}}'
+        assert values[key] == "3", values
+
+        key = f'http_response_bytes_total{{route="{route}",method="GET"}}'
+        assert int(values[key]) == 3 * file_size(join(build_dir, "file1.txt")), values
+
+        key = 'bodega_repo_bytes{repo="a"}'
+        assert int(values[key]) == sum(file_size(x) for x in build_files), values
+
+        assert values["http_requests_in_flight"] == "1", values
+
+def test_cleaner_hook(session):
+    stagger_data = {"repos": {"a": {"branches": {"main": {"tags": {"ok": {"build_id": 1}}}}}}}
+
+    class StaggerHandler(_http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = _json.dumps(stagger_data).encode()
+
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    stagger = _http_server.ThreadingHTTPServer(("localhost", 0), StaggerHandler)
+    _threading.Thread(target=stagger.serve_forever, daemon=True).start()
+
+    try:
+        with temp_working_dir():
+            write_json("quotas.json", {"branch": {"max_builds": 1}})
+
+            for workers in (1, 2):
+                with TestServer(BODEGA_WORKERS=workers, BODEGA_QUOTAS_FILE=_os.path.abspath("quotas.json"),
+                                STAGGER_HTTP_URL=f"http://localhost:{stagger.server_port}") as server:
+                    for build in range(1, 4):
+                        _requests.put(f"{server.http_url}/a/main/{build}/x.txt", data=b"x").raise_for_status()
+
+                    # Any worker can take the hook
+                    for i in range(workers):
+                        _requests.post(f"{server.http_url}/hooks/stagger",
+                                       headers={"Connection": "close"}).raise_for_status()
+
+                    for i in range(50):
+                        if _requests.get(f"{server.http_url}/a/main/2").status_code == 404:
+                            break
+
+                        sleep(0.1)
+                    else:
+                        raise Exception("The cleaner did not run")
+
+                    assert _requests.get(f"{server.http_url}/a/main/1").status_code == 200
+                    assert _requests.get(f"{server.http_url}/a/main/3").status_code == 200
+    finally:
+        stagger.shutdown()
+
+def test_cleaner_without_stagger(session):
+    with TestServer(STAGGER_HTTP_URL="") as server:
+        _requests.put(f"{server.http_url}/a/main/1/x.txt", data=b"x").raise_for_status()
+
+        url = f"{server.http_url}/a/main/2/x.txt"
+        upload_id = _requests.post(f"{url}?uploads").json()["upload_id"]
+        session_dir = join(server.data_dir, "uploads", upload_id)
+        stale_time = _time.time() - 2 * 24 * 60 * 60
+
+        for path in (join(session_dir, "data"), session_dir):
+            _os.utime(path, (stale_time, stale_time))
+
+        _requests.post(f"{server.http_url}/hooks/stagger").raise_for_status()
+
+        # Garbage is collected without the Stagger data, but no builds
+        # are deleted
+
+        for i in range(50):
+            if _requests.head(f"{url}?upload={upload_id}").status_code == 404:
+                break
+
+            sleep(0.1)
+        else:
+            raise Exception("The cleaner did not collect garbage")
+
+        assert _requests.get(f"{server.http_url}/a/main/1/x.txt").status_code == 200
+
 def test_healthz(session):
     with TestServer() as server:
         get(f"{server.http_url}/healthz")
@@ -100,6 +981,16 @@ def get(url):
     print(f"GET {url} -> ", end="", flush=True)
     call("curl {} {}", url, curl_options)
 
+def post_json(url, data):
+    print(f"POST {url} -> ", end="", flush=True)
+
+    response = _requests.post(url, json=data)
+    response.raise_for_status()
+
+    print(response.status_code)
+
+    return response.json()
+
 def head(url):
     print(f"HEAD {url} -> ", end="", flush=True)
     call("curl --head {} {}", url, curl_options)
@@ -111,16 +1002,61 @@ def delete(url):
 def receive(url, count):
     return start_process("qreceive --count {} {}", count, url)
 
+# A minimal RPM with the given files and requirements and no payload
+def _make_rpm(name, version, release, files, requires):
+    def header(entries):
+        index = bytearray()
+        store = bytearray()
+
+        for tag, type, value in entries:
+            if type == 4:
+                store += bytes(-len(store) % 4)
+                offset = len(store)
+                store += _struct.pack(f">{len(value)}I", *value)
+            elif type == 3:
+                store += bytes(-len(store) % 2)
+                offset = len(store)
+                store += _struct.pack(f">{len(value)}H", *value)
+            else:
+                offset = len(store)
+                store += b"".join(x.encode() + b"\0" for x in value)
+
+            index += _struct.pack(">IIII", tag, type, offset, len(value))
+
+        return b"\x8e\xad\xe8\x01" + bytes(4) + _struct.pack(">II", len(entries), len(store)) + index + store
+
+    requires = [x.split() for x in requires]
+    dirs = sorted({x.rsplit("/", 1)[0] + "/" for x in files})
+
+    signature = header([(1007, 4, [0])])
+    main = header([
+        (1000, 6, [name]), (1001, 6, [version]), (1002, 6, [release]), (1004, 9, [f"The {name} package"]),
+        (1005, 9, [f"The {name} package"]), (1006, 4, [1700000000]), (1009, 4, [100]), (1022, 6, ["x86_64"]),
+        (1030, 3, [0o100755] * len(files)), (1037, 4, [0] * len(files)), (1044, 6, [f"{name}.src.rpm"]),
+        (1048, 4, [12 if len(x) > 1 else 0 for x in requires]), (1049, 8, [x[0] for x in requires]),
+        (1050, 8, [x[2] if len(x) > 1 else "" for x in requires]),
+        (1116, 4, [dirs.index(x.rsplit("/", 1)[0] + "/") for x in files]),
+        (1117, 8, [x.rsplit("/", 1)[1] for x in files]), (1118, 8, dirs),
+    ])
+
+    return b"\xed\xab\xee\xdb" + bytes(92) + signature + bytes(-len(signature) % 8) + main
+
+# Returns a map of series to value from the metrics endpoint
+def _get_metrics(server):
+    text = http_get(f"{server.http_url}/metrics")
+    return dict(x.rsplit(" ", 1) for x in text.splitlines() if not x.startswith("#"))
+
 class TestServer(object):
-    def __init__(self):
+    def __init__(self, **env):
         http_port = random_port()
         amqp_port = random_port()
         data_dir = make_temp_dir()
 
-        with working_env(BODEGA_HTTP_PORT_=http_port, BODEGA_DATA_DIR=data_dir):
+        with working_env(BODEGA_HTTP_PORT_=http_port, BODEGA_DATA_DIR=data_dir, **env):
             self.proc = start_process("bodega")
 
         self.proc.http_url = f"http://localhost:{http_port}"
+        self.proc.data_dir = data_dir
 
     def __enter__(self):
         for i in range(10):
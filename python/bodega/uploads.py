@@ -0,0 +1,211 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import fcntl as _fcntl
+import hashlib as _hashlib
+import json as _json
+import os as _os
+import shutil as _shutil
+import threading as _threading
+import time as _time
+import uuid as _uuid
+
+from .blobs import DigestMismatchError
+
+# Resumable uploads.  Each session is a dir under the uploads dir with
+# the target of the upload in info.json and the data received so far in
+# a data file, so sessions survive restarts and are visible to every
+# worker.  The size of the data file is the session offset.
+#
+# The hash of the data is kept in memory as appends complete, so a
+# commit in the same process does not read the data again.  Otherwise
+# the data is hashed at commit.
+
+class UploadSessions:
+    def __init__(self, uploads_dir):
+        self.uploads_dir = uploads_dir
+        self.lock = _threading.Lock()
+        self.hashes = dict()
+
+    def create(self, repo, branch, build, path, staged=False):
+        upload_id = _uuid.uuid4().hex
+        session_dir = _os.path.join(self.uploads_dir, upload_id)
+
+        _os.makedirs(session_dir)
+
+        with open(_os.path.join(session_dir, "data"), "wb"):
+            pass
+
+        with open(_os.path.join(session_dir, "info.json"), "w") as f:
+            _json.dump({"repo": repo, "branch": branch, "build": build, "path": path,
+                        "staged": staged, "created": _time.time()}, f)
+
+        return upload_id
+
+    # Returns the session target as a dict, or None if there is no such
+    # session
+    def get(self, upload_id):
+        if not _is_upload_id(upload_id):
+            return None
+
+        try:
+            with open(_os.path.join(self.uploads_dir, upload_id, "info.json")) as f:
+                return _json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def get_offset(self, upload_id):
+        return _os.path.getsize(self._data_file(upload_id))
+
+    # Raises UploadBusyError if another append to the session is in
+    # progress
+    def open_appender(self, upload_id):
+        return UploadAppender(self, upload_id)
+
+    # Moves the data into the blob store and removes the session.
+    # Returns the digest and size.  Raises UploadBusyError if an append
+    # is in progress, and DigestMismatchError if the data does not have
+    # the expected SHA-256 digest.
+    def commit(self, upload_id, store, expected_digest=None):
+        data_file = self._data_file(upload_id)
+
+        with open(data_file, "rb") as f:
+            try:
+                _lock_file(f, blocking=False)
+            except BlockingIOError:
+                raise UploadBusyError()
+
+            size = _os.fstat(f.fileno()).st_size
+
+            with self.lock:
+                offset, hash = self.hashes.pop(upload_id, (None, None))
+
+            if offset != size:
+                hash = _hashlib.sha256()
+
+                while True:
+                    chunk = f.read(1024 * 1024)
+
+                    if not chunk:
+                        break
+
+                    hash.update(chunk)
+
+            digest = hash.hexdigest()
+
+            if expected_digest is not None and digest != expected_digest:
+                with self.lock:
+                    self.hashes[upload_id] = (size, hash)
+
+                raise DigestMismatchError("sha-256")
+
+            store.add(data_file, digest)
+
+        self.remove(upload_id)
+
+        return digest, size
+
+    def remove(self, upload_id):
+        with self.lock:
+            self.hashes.pop(upload_id, None)
+
+        _shutil.rmtree(_os.path.join(self.uploads_dir, upload_id), ignore_errors=True)
+
+    # Removes sessions with no data received for max_age seconds.
+    # Returns the count and size of the removed sessions.
+    def collect_garbage(self, max_age=24 * 60 * 60):
+        now = _time.time()
+        count = 0
+        size = 0
+
+        for upload_id in _os.listdir(self.uploads_dir):
+            if not _is_upload_id(upload_id):
+                continue
+
+            try:
+                stat_result = _os.stat(self._data_file(upload_id))
+            except FileNotFoundError:
+                stat_result = _os.stat(_os.path.join(self.uploads_dir, upload_id))
+
+            if now - stat_result.st_mtime < max_age:
+                continue
+
+            self.remove(upload_id)
+
+            count += 1
+            size += stat_result.st_size
+
+        return count, size
+
+    def _data_file(self, upload_id):
+        return _os.path.join(self.uploads_dir, upload_id, "data")
+
+class UploadBusyError(Exception):
+    pass
+
+class UploadAppender:
+    def __init__(self, sessions, upload_id):
+        self.sessions = sessions
+        self.upload_id = upload_id
+        self.fd = _os.open(sessions._data_file(upload_id), _os.O_WRONLY | _os.O_APPEND)
+
+        try:
+            _lock_file(self.fd, blocking=False)
+        except BlockingIOError:
+            _os.close(self.fd)
+            raise UploadBusyError()
+
+        self.offset = _os.fstat(self.fd).st_size
+
+        with sessions.lock:
+            offset, hash = sessions.hashes.pop(upload_id, (None, None))
+
+        if offset == self.offset:
+            self.hash = hash
+        elif self.offset == 0:
+            self.hash = _hashlib.sha256()
+        else:
+            self.hash = None
+
+    def write(self, data):
+        view = memoryview(data)
+
+        while view:
+            count = _os.write(self.fd, view)
+
+            if self.hash is not None:
+                self.hash.update(view[:count])
+
+            self.offset += count
+            view = view[count:]
+
+    # Keeps the running hash for the next append or the commit
+    def close(self):
+        if self.hash is not None:
+            with self.sessions.lock:
+                self.sessions.hashes[self.upload_id] = (self.offset, self.hash)
+
+        _os.close(self.fd)
+
+def _lock_file(file, blocking=True):
+    flags = _fcntl.LOCK_EX if blocking else _fcntl.LOCK_EX | _fcntl.LOCK_NB
+    _fcntl.flock(file, flags)
+
+def _is_upload_id(value):
+    return len(value) == 32 and all(x in "0123456789abcdef" for x in value)
@@ -0,0 +1,502 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import fcntl as _fcntl
+import gzip as _gzip
+import hashlib as _hashlib
+import logging as _logging
+import os as _os
+import stat as _stat
+import struct as _struct
+import time as _time
+
+from xml.sax.saxutils import escape as _escape, quoteattr as _quoteattr
+
+from .blobs import DigestCache
+
+_log = _logging.getLogger("yum")
+
+# Yum repodata for the RPMs under a build's repo dir, generated on the
+# server as RPMs arrive.  The primary, filelists, and other documents
+# are written under repodata with their digests in their names, as
+# createrepo does, and repomd.xml points to them.  Anything else under
+# repodata is removed.
+#
+# The package details come from the RPM headers.  They are parsed once
+# for each package digest and kept as JSON in the package cache, so an
+# update reads only the headers of new packages.
+
+repo_dir_name = "repo"
+
+def is_repo_package(path):
+    parts = path.split("/")
+    return len(parts) > 1 and parts[0] == repo_dir_name and parts[1] != "repodata" and path.endswith(".rpm")
+
+def is_repodata_file(path):
+    parts = path.split("/")
+    return len(parts) > 2 and parts[0] == repo_dir_name and parts[1] == "repodata"
+
+class PackageCache(DigestCache):
+    # Returns the package details, or None if the file is not a
+    # readable RPM
+    def get(self, digest, fs_path):
+        return super().get(digest, _read_package_or_none, fs_path)
+
+# Regenerates the repodata of the repo dir.  Digests is a map of package
+# path, relative to the repo dir, to content digest.  Packages missing
+# from it are hashed.  The generated files are added to the blob store
+# and linked into place.
+#
+# Returns the generated files as (path, size, digest) tuples and the
+# paths of the removed files, both relative to the repo dir.
+def update_repodata(repo_dir, digests, package_cache, store):
+    repodata_dir = _os.path.join(repo_dir, "repodata")
+    fd = _os.open(repo_dir, _os.O_RDONLY)
+
+    # Updates of the same repo in other workers wait here
+    try:
+        _fcntl.flock(fd, _fcntl.LOCK_EX)
+
+        packages = list()
+
+        for root, dirs, names in _os.walk(repo_dir):
+            if root == repo_dir:
+                dirs[:] = [x for x in dirs if x != "repodata"]
+
+            for name in sorted(names):
+                if not name.endswith(".rpm"):
+                    continue
+
+                fs_path = _os.path.join(root, name)
+                path = _os.path.relpath(fs_path, repo_dir)
+                digest = digests.get(path) or _hash_file(fs_path)
+                package = package_cache.get(digest, fs_path)
+
+                if package is not None:
+                    stat_result = _os.stat(fs_path)
+                    packages.append((path, digest, stat_result.st_size, int(stat_result.st_mtime), package))
+
+        generated = list()
+
+        for name, data in make_repodata(sorted(packages)):
+            writer = store.open_writer()
+
+            try:
+                writer.write(data)
+                digest = writer.commit()
+            except BaseException:
+                writer.abort()
+                raise
+
+            store.link(digest, _os.path.join(repodata_dir, name))
+            generated.append((f"repodata/{name}", len(data), digest))
+
+        removed = list()
+        keep = {x[0] for x in generated}
+
+        for root, dirs, names in _os.walk(repodata_dir):
+            for name in names:
+                path = _os.path.relpath(_os.path.join(root, name), repo_dir)
+
+                if path not in keep:
+                    _os.remove(_os.path.join(repo_dir, path))
+                    removed.append(path)
+
+        return generated, removed
+    finally:
+        _os.close(fd)
+
+# Returns (file name, content) pairs for the repodata.  Packages is a
+# sequence of (path, digest, size, mtime, details) tuples.
+def make_repodata(packages):
+    now = int(_time.time())
+    documents = (
+        ("primary", _make_primary(packages)),
+        ("filelists", _make_filelists(packages)),
+        ("other", _make_other(packages)),
+    )
+    files = list()
+    entries = list()
+
+    for type, document in documents:
+        # A fixed gzip time keeps the output the same for the same input
+        data = _gzip.compress(document, mtime=0)
+        digest = _hashlib.sha256(data).hexdigest()
+        name = f"{digest}-{type}.xml.gz"
+
+        files.append((name, data))
+        entries.append(f"""  <data type="{type}">
+    <checksum type="sha256">{digest}</checksum>
+    <open-checksum type="sha256">{_hashlib.sha256(document).hexdigest()}</open-checksum>
+    <location href="repodata/{name}"/>
+    <timestamp>{now}</timestamp>
+    <size>{len(data)}</size>
+    <open-size>{len(document)}</open-size>
+  </data>
+""")
+
+    repomd = (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+              f'<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+              f'  <revision>{now}</revision>\n'
+              f'{"".join(entries)}'
+              f'</repomd>\n')
+
+    files.append(("repomd.xml", repomd.encode()))
+
+    return files
+
+def _make_primary(packages):
+    out = [f'<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<metadata xmlns="http://linux.duke.edu/metadata/common" '
+           f'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="{len(packages)}">\n']
+
+    for path, digest, size, mtime, p in packages:
+        out.append(f"""<package type="rpm">
+  <name>{_escape(p["name"])}</name>
+  <arch>{_escape(p["arch"])}</arch>
+  <version epoch="{p["epoch"]}" ver={_quoteattr(p["version"])} rel={_quoteattr(p["release"])}/>
+  <checksum type="sha256" pkgid="YES">{digest}</checksum>
+  <summary>{_escape(p["summary"])}</summary>
+  <description>{_escape(p["description"])}</description>
+  <packager>{_escape(p["packager"])}</packager>
+  <url>{_escape(p["url"])}</url>
+  <time file="{mtime}" build="{p["build_time"]}"/>
+  <size package="{size}" installed="{p["installed_size"]}" archive="{p["archive_size"]}"/>
+  <location href={_quoteattr(path)}/>
+  <format>
+    <rpm:license>{_escape(p["license"])}</rpm:license>
+    <rpm:vendor>{_escape(p["vendor"])}</rpm:vendor>
+    <rpm:group>{_escape(p["group"])}</rpm:group>
+    <rpm:buildhost>{_escape(p["build_host"])}</rpm:buildhost>
+    <rpm:sourcerpm>{_escape(p["source_rpm"])}</rpm:sourcerpm>
+    <rpm:header-range start="{p["header_start"]}" end="{p["header_end"]}"/>
+""")
+
+        for kind in ("provides", "requires", "conflicts", "obsoletes"):
+            if p[kind]:
+                out.append(f"    <rpm:{kind}>\n")
+                out.extend(f"      {_dependency_entry(x)}\n" for x in p[kind])
+                out.append(f"    </rpm:{kind}>\n")
+
+        for file_path, file_type in p["files"]:
+            if _is_primary_file(file_path):
+                out.append(f"    {_file_element(file_path, file_type)}\n")
+
+        out.append("  </format>\n</package>\n")
+
+    out.append("</metadata>\n")
+
+    return "".join(out).encode()
+
+def _make_filelists(packages):
+    out = [f'<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="{len(packages)}">\n']
+
+    for path, digest, size, mtime, p in packages:
+        out.append(f"{_package_element(digest, p)}\n")
+        out.extend(f"  {_file_element(*x)}\n" for x in p["files"])
+        out.append("</package>\n")
+
+    out.append("</filelists>\n")
+
+    return "".join(out).encode()
+
+def _make_other(packages):
+    out = [f'<?xml version="1.0" encoding="UTF-8"?>\n'
+           f'<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="{len(packages)}">\n']
+
+    for path, digest, size, mtime, p in packages:
+        out.append(f"{_package_element(digest, p)}\n")
+
+        for author, date, text in p["changelogs"]:
+            out.append(f"  <changelog author={_quoteattr(author)} date=\"{date}\">{_escape(text)}</changelog>\n")
+
+        out.append("</package>\n")
+
+    out.append("</otherdata>\n")
+
+    return "".join(out).encode()
+
+def _package_element(digest, p):
+    return (f'<package pkgid="{digest}" name={_quoteattr(p["name"])} arch={_quoteattr(p["arch"])}>\n'
+            f'  <version epoch="{p["epoch"]}" ver={_quoteattr(p["version"])} rel={_quoteattr(p["release"])}/>')
+
+def _file_element(path, type):
+    if type == "file":
+        return f"<file>{_escape(path)}</file>"
+
+    return f'<file type="{type}">{_escape(path)}</file>'
+
+def _dependency_entry(dependency):
+    name, flags, epoch, version, release, pre = dependency
+    attrs = f"name={_quoteattr(name)}"
+
+    if flags:
+        attrs += f' flags="{flags}" epoch="{epoch or 0}" ver={_quoteattr(version)}'
+
+        if release:
+            attrs += f" rel={_quoteattr(release)}"
+
+    if pre:
+        attrs += ' pre="1"'
+
+    return f"<rpm:entry {attrs}/>"
+
+# The files listed in primary, as createrepo chooses them
+def _is_primary_file(path):
+    return path.startswith("/etc/") or "bin/" in path or path == "/usr/lib/sendmail"
+
+def _hash_file(fs_path):
+    hash = _hashlib.sha256()
+
+    with open(fs_path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+
+            if not chunk:
+                break
+
+            hash.update(chunk)
+
+    return hash.hexdigest()
+
+# RPM files
+#
+# An RPM file is a 96-byte lead, a signature header padded to a multiple
+# of 8 bytes, the main header, and the payload.  Each header is a 16-byte
+# intro, an index of 16-byte entries, and a data store.  Only the lead
+# and the headers are read.
+
+_lead_magic = b"\xed\xab\xee\xdb"
+_header_magic = b"\x8e\xad\xe8\x01"
+_lead_size = 96
+
+_string_types = {6, 8, 9}
+_int_formats = {2: "B", 3: "H", 4: "I", 5: "Q"}
+
+# Header tags
+_NAME = 1000
+_VERSION = 1001
+_RELEASE = 1002
+_EPOCH = 1003
+_SUMMARY = 1004
+_DESCRIPTION = 1005
+_BUILDTIME = 1006
+_BUILDHOST = 1007
+_SIZE = 1009
+_VENDOR = 1011
+_LICENSE = 1014
+_PACKAGER = 1015
+_GROUP = 1016
+_URL = 1020
+_ARCH = 1022
+_OLDFILENAMES = 1027
+_FILEMODES = 1030
+_FILEFLAGS = 1037
+_SOURCERPM = 1044
+_ARCHIVESIZE = 1046
+_PROVIDENAME = 1047
+_REQUIREFLAGS = 1048
+_REQUIRENAME = 1049
+_REQUIREVERSION = 1050
+_CONFLICTFLAGS = 1053
+_CONFLICTNAME = 1054
+_CONFLICTVERSION = 1055
+_CHANGELOGTIME = 1080
+_CHANGELOGNAME = 1081
+_CHANGELOGTEXT = 1082
+_OBSOLETENAME = 1090
+_PROVIDEFLAGS = 1112
+_PROVIDEVERSION = 1113
+_OBSOLETEFLAGS = 1114
+_OBSOLETEVERSION = 1115
+_DIRINDEXES = 1116
+_BASENAMES = 1117
+_DIRNAMES = 1118
+
+# The payload size in the signature header
+_SIG_PAYLOADSIZE = 1007
+
+_dependency_tags = {
+    "provides": (_PROVIDENAME, _PROVIDEFLAGS, _PROVIDEVERSION),
+    "requires": (_REQUIRENAME, _REQUIREFLAGS, _REQUIREVERSION),
+    "conflicts": (_CONFLICTNAME, _CONFLICTFLAGS, _CONFLICTVERSION),
+    "obsoletes": (_OBSOLETENAME, _OBSOLETEFLAGS, _OBSOLETEVERSION),
+}
+
+_comparisons = {2: "LT", 4: "GT", 8: "EQ", 10: "LE", 12: "GE"}
+
+# Requirements of scriptlets and of rpm itself
+_sense_pre = (1 << 6) | (1 << 9) | (1 << 10)
+_sense_rpmlib = 1 << 24
+
+_file_ghost = 1 << 6
+
+class PackageError(Exception):
+    pass
+
+def _read_package_or_none(fs_path):
+    try:
+        return read_package(fs_path)
+    except (OSError, PackageError) as e:
+        _log.warning(f"Failed reading package {fs_path}: {e}")
+        return None
+
+# Returns the details of the package that go into the repodata
+def read_package(fs_path):
+    with open(fs_path, "rb") as f:
+        lead = f.read(_lead_size)
+
+        if len(lead) != _lead_size or lead[:4] != _lead_magic:
+            raise PackageError("Not an RPM file")
+
+        signature, signature_size = _read_header(f)
+        header_start = _lead_size + signature_size + (-signature_size % 8)
+
+        f.seek(header_start)
+        header, header_size = _read_header(f)
+
+    def string(tag):
+        value = header.get(tag)
+        return value[0] if value else ""
+
+    def number(tag, default=0):
+        value = header.get(tag)
+        return value[0] if value else default
+
+    package = {
+        "name": string(_NAME),
+        "version": string(_VERSION),
+        "release": string(_RELEASE),
+        "epoch": number(_EPOCH),
+        "arch": string(_ARCH) if _SOURCERPM in header else "src",
+        "summary": string(_SUMMARY),
+        "description": string(_DESCRIPTION),
+        "packager": string(_PACKAGER),
+        "url": string(_URL),
+        "license": string(_LICENSE),
+        "vendor": string(_VENDOR),
+        "group": string(_GROUP),
+        "build_host": string(_BUILDHOST),
+        "source_rpm": string(_SOURCERPM),
+        "build_time": number(_BUILDTIME),
+        "installed_size": number(_SIZE),
+        "archive_size": number(_ARCHIVESIZE, (signature.get(_SIG_PAYLOADSIZE) or [0])[0]),
+        "header_start": header_start,
+        "header_end": header_start + header_size,
+        "files": _read_files(header),
+        "changelogs": list(zip(header.get(_CHANGELOGNAME, []), header.get(_CHANGELOGTIME, []),
+                               header.get(_CHANGELOGTEXT, []))),
+    }
+
+    if not package["name"]:
+        raise PackageError("The package has no name")
+
+    for kind, tags in _dependency_tags.items():
+        package[kind] = _read_dependencies(header, kind, *tags)
+
+    return package
+
+# Returns a map of tag to a list of values, and the header size
+def _read_header(f):
+    intro = f.read(16)
+
+    if len(intro) != 16 or intro[:4] != _header_magic:
+        raise PackageError("Bad header magic")
+
+    count, size = _struct.unpack(">II", intro[8:])
+    index = f.read(count * 16)
+    store = f.read(size)
+
+    if len(index) != count * 16 or len(store) != size:
+        raise PackageError("Truncated header")
+
+    tags = dict()
+
+    for i in range(count):
+        tag, type, offset, item_count = _struct.unpack_from(">IIII", index, i * 16)
+
+        try:
+            if type in _string_types:
+                items = list()
+
+                # A plain string has a count of 1
+
+                for j in range(item_count):
+                    end = store.index(b"\0", offset)
+                    items.append(store[offset:end].decode("utf-8", "replace"))
+                    offset = end + 1
+
+                tags[tag] = items
+            elif type in _int_formats:
+                tags[tag] = list(_struct.unpack_from(f">{item_count}{_int_formats[type]}", store, offset))
+        except (ValueError, _struct.error):
+            raise PackageError(f"Bad value for header tag {tag}")
+
+    return tags, 16 + len(index) + len(store)
+
+# Returns (path, type) tuples, with type file, dir, or ghost
+def _read_files(header):
+    if _BASENAMES in header:
+        dir_names = header.get(_DIRNAMES, [])
+        paths = [dir_names[x] + y for x, y in zip(header.get(_DIRINDEXES, []), header[_BASENAMES])]
+    else:
+        paths = header.get(_OLDFILENAMES, [])
+
+    modes = header.get(_FILEMODES, [])
+    flags = header.get(_FILEFLAGS, [])
+    files = list()
+
+    for i, path in enumerate(paths):
+        if i < len(flags) and flags[i] & _file_ghost:
+            type = "ghost"
+        elif i < len(modes) and _stat.S_ISDIR(modes[i]):
+            type = "dir"
+        else:
+            type = "file"
+
+        files.append((path, type))
+
+    return files
+
+# Returns (name, flags, epoch, version, release, pre) tuples
+def _read_dependencies(header, kind, name_tag, flags_tag, version_tag):
+    names = header.get(name_tag, [])
+    flags = header.get(flags_tag, [0] * len(names))
+    versions = header.get(version_tag, [""] * len(names))
+    dependencies = list()
+
+    for name, sense, evr in zip(names, flags, versions):
+        if kind == "requires" and (sense & _sense_rpmlib or name.startswith("rpmlib(")):
+            continue
+
+        epoch, version, release = _parse_evr(evr)
+        entry = (name, _comparisons.get(sense & 0xe, ""), epoch, version, release,
+                 kind == "requires" and bool(sense & _sense_pre))
+
+        if entry not in dependencies:
+            dependencies.append(entry)
+
+    return dependencies
+
+def _parse_evr(value):
+    epoch, _, rest = value.rpartition(":")
+    version, _, release = rest.partition("-")
+
+    return epoch, version, release
@@ -17,42 +17,197 @@
 # under the License.
 #
 
+import bisect as _bisect
+import collections as _collections
+import contextlib as _contextlib
+import email.utils as _email_utils
+import gzip as _gzip
+import hashlib as _hashlib
+import html as _html
+import json as _json
 import logging as _logging
+import mimetypes as _mimetypes
 import os as _os
+import signal as _signal
+import socket as _socket
+import starlette.concurrency as _concurrency
+import starlette.datastructures as _datastructures
 import starlette.requests as _requests
 import starlette.routing as _routing
 import starlette.staticfiles as _staticfiles
+import time as _time
 import traceback as _traceback
+import uuid as _uuid
 import uvicorn as _uvicorn
+import zlib as _zlib
 
 from starlette.responses import *
 
 _log = _logging.getLogger("brbn")
 
+# Smaller bodies are not worth compressing
+compress_min_size = 1024
+
+# With more than one worker, the server forks worker processes that
+# each listen on the port with SO_REUSEPORT, so the kernel spreads
+# connections across them.  The parent restarts workers that exit and
+# stops them all on SIGTERM or SIGINT.
+#
+# A worker that exits within min_uptime of starting is restarted after
+# a delay that doubles with each such exit.  After max_failures of them
+# in a row, the parent stops the server.
+
 class Server:
-    def __init__(self, app, host="", port=8080):
+    def __init__(self, app, host="", port=8080, workers=1):
         self.app = app
         self.host = host
         self.port = port
+        self.workers = workers
+
+        # The index of the serving process, from 0 to workers - 1.  A
+        # restarted worker keeps the index of the one it replaces.
+        self.worker_index = 0
 
-        self.router = Router(self.app)
+        self.min_uptime = 10
+        self.max_restart_delay = 60
+        self.max_failures = 8
 
-    def add_route(self, *args, **kwargs):
-        self.router.add_route(*args, **kwargs)
+        self.metrics = Metrics()
+        self.router = Router(self.app, self.metrics, lifespan=self.lifespan)
+
+    def add_route(self, path, endpoint, **kwargs):
+        if isinstance(endpoint, Handler):
+            endpoint.route = path
+
+        self.router.add_route(path, endpoint, **kwargs)
 
     def add_static_files(self, path, dir):
         self.router.mount(path, app=_staticfiles.StaticFiles(directory=dir))
 
     def run(self):
-        _uvicorn.run(self.router, host=self.host, port=self.port, log_level="info")
+        if self.workers == 1:
+            _uvicorn.run(self.router, host=self.host, port=self.port, log_level="info")
+            return
+
+        pids = dict()
+        start_times = dict()
+        failures = [0] * self.workers
+        stopping = False
+        failed = False
+
+        def stop(signum=None, frame=None):
+            nonlocal stopping
+            stopping = True
+
+            for pid in pids:
+                try:
+                    _os.kill(pid, _signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        def start(index):
+            pids[self.start_worker(index)] = index
+            start_times[index] = _time.monotonic()
+
+        for index in range(self.workers):
+            start(index)
+
+        _signal.signal(_signal.SIGTERM, stop)
+        _signal.signal(_signal.SIGINT, stop)
+
+        self.on_workers_started()
+
+        while pids:
+            pid, status = _os.wait()
+            index = pids.pop(pid, None)
+
+            if stopping or index is None:
+                continue
+
+            self.on_worker_exit(index, pid)
+
+            if _time.monotonic() - start_times[index] < self.min_uptime:
+                failures[index] += 1
+            else:
+                failures[index] = 0
+
+            if failures[index] >= self.max_failures:
+                _log.error(f"Worker {pid} exited with status {status} {failures[index]} times in a row "
+                           "soon after starting; stopping")
+                failed = True
+                stop()
+                continue
+
+            delay = min(self.max_restart_delay, 2 ** failures[index] // 2)
+
+            _log.warning(f"Worker {pid} exited with status {status}; restarting it in {delay} s")
+            _time.sleep(delay)
+
+            if not stopping:
+                start(index)
+
+        if failed:
+            raise SystemExit(1)
+
+    def start_worker(self, index):
+        pid = _os.fork()
+
+        if pid != 0:
+            return pid
+
+        status = 0
+
+        try:
+            _signal.signal(_signal.SIGTERM, _signal.SIG_DFL)
+            _signal.signal(_signal.SIGINT, _signal.SIG_DFL)
+
+            self.worker_index = index
+            self.on_worker_start()
+
+            # With the protocol given, asyncio sets TCP_NODELAY on
+            # accepted connections
+
+            sock = _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM, _socket.IPPROTO_TCP)
+            sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, 1)
+            sock.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+
+            config = _uvicorn.Config(self.router, log_level="info")
+            _uvicorn.Server(config).run(sockets=[sock])
+        except BaseException:
+            _traceback.print_exc()
+            status = 1
+        finally:
+            _os._exit(status)
+
+    # Called in each worker process after it is forked
+    def on_worker_start(self):
+        pass
+
+    # Called in the parent process once the workers are running
+    def on_workers_started(self):
+        pass
+
+    # Called in the parent process when a worker exits, before it is
+    # restarted, with the index and process ID of the worker
+    def on_worker_exit(self, index, pid):
+        pass
+
+    # Entered when the event loop of a serving process starts and exited
+    # when it stops, for running background tasks
+    @_contextlib.asynccontextmanager
+    async def lifespan(self, app):
+        yield
 
 class Router(_routing.Router):
-    def __init__(self, app):
-        super().__init__()
+    def __init__(self, app, metrics=None, lifespan=None):
+        super().__init__(lifespan=lifespan)
         self.app = app
+        self.metrics = metrics
 
     async def __call__(self, scope, receive, send):
         scope["app"] = self.app
+        scope["metrics"] = self.metrics
         await super().__call__(scope, receive, send)
 
 class Request(_requests.Request):
@@ -61,7 +216,55 @@ class Request(_requests.Request):
         return self["app"]
 
 class Handler:
+    # The route path, for metrics labels
+    route = None
+
+    # Every request is counted and timed here, along with the body bytes
+    # received and sent.  Pathsend bodies are counted by their content
+    # length.
     async def __call__(self, scope, receive, send):
+        metrics = scope.get("metrics")
+
+        if metrics is None:
+            await self.respond(scope, receive, send)
+            return
+
+        labels = (("route", self.route), ("method", scope["method"]))
+        status = 500
+        content_length = 0
+
+        async def counting_receive():
+            message = await receive()
+            metrics.inc("http_request_bytes_total", len(message.get("body", b"")), labels)
+            return message
+
+        async def counting_send(message):
+            nonlocal status, content_length
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+                for name, value in message["headers"]:
+                    if name == b"content-length":
+                        content_length = int(value)
+            elif message["type"] == "http.response.body":
+                metrics.inc("http_response_bytes_total", len(message.get("body", b"")), labels)
+            elif message["type"] == "http.response.pathsend":
+                metrics.inc("http_response_bytes_total", content_length, labels)
+
+            await send(message)
+
+        metrics.inc("http_requests_in_flight", 1)
+        start = _time.perf_counter()
+
+        try:
+            await self.respond(scope, counting_receive, counting_send)
+        finally:
+            metrics.observe("http_request_duration_seconds", _time.perf_counter() - start, labels)
+            metrics.inc("http_requests_total", 1, labels + (("status", str(status)),))
+            metrics.inc("http_requests_in_flight", -1)
+
+    async def respond(self, scope, receive, send):
         request = Request(scope, receive)
 
         try:
@@ -71,6 +274,15 @@ class Handler:
         except Exception as e:
             response = ServerErrorResponse(e)
 
+        if request.method in ("GET", "HEAD") and response.status_code == 200:
+            response = compress_response(request.headers, response)
+
+            etag = response.headers.get("etag")
+            last_modified = response.headers.get("last-modified")
+
+            if is_not_modified(request.headers, etag, last_modified):
+                response = NotModifiedResponse(etag, last_modified)
+
         await response(scope, receive, send)
 
     async def handle(self, request):
@@ -79,10 +291,9 @@ class Handler:
 
         if server_etag is not None:
             server_etag = f'"{server_etag}"'
-            client_etag = request.headers.get("if-none-match")
 
-            if client_etag == server_etag:
-                return NotModifiedResponse()
+            if is_not_modified(request.headers, server_etag):
+                return NotModifiedResponse(server_etag)
 
         if request.method == "HEAD":
             response = Response("")
@@ -104,6 +315,139 @@ class Handler:
     async def render(self, request, entity):
         return OkResponse()
 
+# Counters, gauges, and histograms, rendered in the Prometheus text
+# format.  Series are keyed by name and a tuple of label pairs.  Updates
+# are plain dict operations with no locking, which is safe on the event
+# loop and keeps the cost per request low.
+#
+# Snapshots are JSON-compatible and can be merged into the rendered
+# output, for combining metrics from several processes.  Collectors are
+# called at render time to set values that are read on demand.
+
+class Metrics:
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.descriptions = dict()
+        self.buckets = dict()
+        self.values = dict()
+        self.histograms = dict()
+
+        # Called with the merged metrics when they are rendered
+        self.collectors = list()
+
+        # Called with these metrics before each snapshot, for values a
+        # process keeps elsewhere
+        self.samplers = list()
+
+        self.describe("http_requests_total", "counter", "HTTP requests by route, method, and status")
+        self.describe("http_request_duration_seconds", "histogram",
+                      "Time from request start to the end of the response body")
+        self.describe("http_request_bytes_total", "counter", "Request body bytes received")
+        self.describe("http_response_bytes_total", "counter", "Response body bytes sent")
+        self.describe("http_requests_in_flight", "gauge", "Requests in progress")
+
+    def reset(self):
+        self.values = dict()
+        self.histograms = dict()
+
+    def describe(self, name, type, help, buckets=None):
+        self.descriptions[name] = (type, help)
+
+        if type == "histogram":
+            self.buckets[name] = tuple(buckets or self.default_buckets)
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        self.values[(name, labels)] = value
+
+    # Histogram counts are kept per bucket, with the overflow count and
+    # then the sum at the end
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        buckets = self.buckets[name]
+        counts = self.histograms.get(key)
+
+        if counts is None:
+            counts = self.histograms[key] = [0] * (len(buckets) + 2)
+
+        counts[_bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        for sampler in self.samplers:
+            sampler(self)
+
+        return {
+            "values": [[name, labels, value] for (name, labels), value in self.values.copy().items()],
+            "histograms": [[name, labels, list(counts)]
+                           for (name, labels), counts in self.histograms.copy().items()],
+        }
+
+    def render(self, snapshots=()):
+        merged = Metrics()
+        merged.descriptions = self.descriptions
+        merged.buckets = self.buckets
+
+        for snapshot in (self.snapshot(),) + tuple(snapshots):
+            for name, labels, value in snapshot["values"]:
+                merged.inc(name, value, tuple(tuple(x) for x in labels))
+
+            for name, labels, counts in snapshot["histograms"]:
+                key = (name, tuple(tuple(x) for x in labels))
+                totals = merged.histograms.setdefault(key, [0] * len(counts))
+
+                for i, count in enumerate(counts):
+                    totals[i] += count
+
+        for collector in self.collectors:
+            collector(merged)
+
+        lines = list()
+
+        for name in sorted(self.descriptions):
+            type, help = self.descriptions[name]
+
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+
+            for (series, labels), value in sorted(merged.values.items()):
+                if series == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            for (series, labels), counts in sorted(merged.histograms.items()):
+                if series != name:
+                    continue
+
+                total = 0
+
+                for bound, count in zip(self.buckets[name] + ("+Inf",), counts):
+                    total += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {total}")
+
+                lines.append(f"{name}_sum{_format_labels(labels)} {counts[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {total}")
+
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    items = list()
+
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        items.append(f'{key}="{value}"')
+
+    return "{" + ",".join(items) + "}"
+
+class MetricsResponse(PlainTextResponse):
+    media_type = "text/plain; version=0.0.4"
+
 class HandlingException(Exception):
     def __init__(self, message, response):
         super().__init__(message)
@@ -121,6 +465,10 @@ class NotFoundError(HandlingException):
     def __init__(self, message):
         super().__init__(message, NotFoundResponse(message))
 
+class InsufficientStorageError(HandlingException):
+    def __init__(self, message):
+        super().__init__(message, InsufficientStorageResponse(message))
+
 class BadRequestResponse(PlainTextResponse):
     def __init__(self, exception):
         super().__init__(f"Bad request: {exception}\n", 400)
@@ -129,9 +477,23 @@ class NotFoundResponse(PlainTextResponse):
     def __init__(self):
         super().__init__(f"Not found\n", 404)
 
-class NotModifiedResponse(PlainTextResponse):
-    def __init__(self):
-        super().__init__("Not modified\n", 304)
+class ConflictResponse(PlainTextResponse):
+    def __init__(self, message):
+        super().__init__(f"Conflict: {message}\n", 409)
+
+class InsufficientStorageResponse(PlainTextResponse):
+    def __init__(self, message):
+        super().__init__(f"Insufficient storage: {message}\n", 507)
+
+class NotModifiedResponse(Response):
+    def __init__(self, etag=None, last_modified=None):
+        super().__init__(None, 304)
+
+        if etag is not None:
+            self.headers["etag"] = etag
+
+        if last_modified is not None:
+            self.headers["last-modified"] = last_modified
 
 class ServerErrorResponse(PlainTextResponse):
     def __init__(self, exception):
@@ -156,6 +518,345 @@ class CompressedJsonResponse(Response):
     def __init__(self, content):
         super().__init__(content, headers={"Content-Encoding": "gzip"}, media_type="application/json")
 
+# Serves a file with byte-range support.  Range requests get a 206
+# response with one range or a multipart/byteranges body with several.
+# If-Range is honored against the ETag and Last-Modified validators,
+# which come from the file metadata.
+
+class FileResponse(Response):
+    chunk_size = 1024 * 1024
+    max_ranges = 100
+
+    def __init__(self, path, headers=None, media_type=None, stat_result=None, chunk_size=None):
+        self.path = path
+        self.status_code = 200
+        self.background = None
+        self.stat_result = stat_result
+
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+        if self.stat_result is None:
+            self.stat_result = _os.stat(path)
+
+        if media_type is None:
+            media_type = _mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        self.media_type = media_type
+        self.raw_headers = list()
+
+        if headers is not None:
+            self.headers.update(headers)
+
+        self.headers["accept-ranges"] = "bytes"
+        self.headers.setdefault("etag", file_etag(self.stat_result))
+        self.headers.setdefault("last-modified", _email_utils.formatdate(self.stat_result.st_mtime, usegmt=True))
+
+    async def __call__(self, scope, receive, send):
+        request_headers = _datastructures.Headers(scope=scope)
+        size = self.stat_result.st_size
+        ranges = None
+
+        if "range" in request_headers and self.if_range_matches(request_headers.get("if-range")):
+            ranges = parse_ranges(request_headers["range"], size, self.max_ranges)
+
+        if ranges is None:
+            self.headers["content-type"] = self.media_type
+            self.headers["content-length"] = str(size)
+            parts = [(b"", 0, size)]
+        elif len(ranges) == 0:
+            response = PlainTextResponse("Range not satisfiable\n", 416,
+                                         headers={"content-range": f"bytes */{size}"})
+            await response(scope, receive, send)
+            return
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+
+            self.status_code = 206
+            self.headers["content-type"] = self.media_type
+            self.headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+            self.headers["content-length"] = str(end - start)
+            parts = [(b"", start, end)]
+        else:
+            boundary = _uuid.uuid4().hex
+            parts = list()
+
+            for start, end in ranges:
+                preamble = (f"--{boundary}\r\nContent-Type: {self.media_type}\r\n"
+                            f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n")
+
+                if parts:
+                    preamble = "\r\n" + preamble
+
+                parts.append((preamble.encode(), start, end))
+
+            parts.append((f"\r\n--{boundary}--\r\n".encode(), 0, 0))
+
+            self.status_code = 206
+            self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+            self.headers["content-length"] = str(sum(len(x) + end - start for x, start, end in parts))
+
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        # With the ASGI pathsend extension, the server sends the whole
+        # file itself, typically with sendfile
+
+        if ranges is None and "http.response.pathsend" in scope.get("extensions", {}):
+            await send({"type": "http.response.pathsend", "path": _os.path.abspath(self.path)})
+            return
+
+        await self.send_parts(send, parts)
+
+    async def send_parts(self, send, parts):
+        # Positional reads on an unbuffered descriptor, in large chunks,
+        # keep copies and thread pool round trips per byte low
+
+        fd = await _concurrency.run_in_threadpool(_os.open, self.path, _os.O_RDONLY)
+
+        try:
+            for preamble, start, end in parts:
+                if preamble:
+                    await send({"type": "http.response.body", "body": preamble, "more_body": True})
+
+                offset = start
+
+                while offset < end:
+                    chunk = await _concurrency.run_in_threadpool(_os.pread, fd, min(self.chunk_size, end - offset), offset)
+
+                    if not chunk:
+                        raise Exception(f"File {self.path} was truncated while sending")
+
+                    offset += len(chunk)
+
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            _os.close(fd)
+
+        await send({"type": "http.response.body", "body": b""})
+
+    def if_range_matches(self, value):
+        if value is None:
+            return True
+
+        if value.startswith("W/"):
+            return False
+
+        if value.startswith('"'):
+            return value == self.headers["etag"]
+
+        return value == self.headers["last-modified"]
+
+# If-None-Match takes precedence over If-Modified-Since, and uses weak
+# comparison
+def is_not_modified(request_headers, etag, last_modified=None):
+    if_none_match = request_headers.get("if-none-match")
+
+    if if_none_match is not None:
+        if etag is None:
+            return False
+
+        if if_none_match.strip() == "*":
+            return True
+
+        client_etags = [_strip_weak(x.strip()) for x in if_none_match.split(",")]
+
+        return _strip_weak(etag) in client_etags
+
+    if_modified_since = request_headers.get("if-modified-since")
+
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            client_time = _email_utils.parsedate_to_datetime(if_modified_since)
+            server_time = _email_utils.parsedate_to_datetime(last_modified)
+
+            return server_time <= client_time
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+# Returns the acceptable content codings, most preferred first
+def accepted_encodings(accept_encoding):
+    if not accept_encoding:
+        return []
+
+    encodings = list()
+
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+
+        if name and quality > 0:
+            encodings.append((quality, name))
+
+    encodings.sort(key=lambda x: -x[0])
+
+    return [x[1] for x in encodings]
+
+# Returns a map of lowercase algorithm name to encoded value for a
+# Digest header, as in RFC 3230
+def parse_digest_header(value):
+    digests = dict()
+
+    if not value:
+        return digests
+
+    for item in value.split(","):
+        name, _, encoded = item.partition("=")
+        name = name.strip().lower()
+
+        if name and encoded:
+            digests[name] = encoded.strip()
+
+    return digests
+
+def is_compressible_media_type(media_type):
+    if media_type is None:
+        return False
+
+    media_type = media_type.split(";")[0].strip()
+
+    return (media_type.startswith("text/")
+            or media_type.endswith(("/xml", "+xml", "/json", "+json", "/javascript")))
+
+# Gzips a fully rendered response body if the client accepts it
+def compress_response(request_headers, response):
+    body = getattr(response, "body", None)
+
+    if (body is None or len(body) < compress_min_size
+        or "content-encoding" in response.headers
+        or not is_compressible_media_type(response.headers.get("content-type"))):
+        return response
+
+    vary = response.headers.get("vary")
+
+    if vary is None:
+        response.headers["vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response.headers["vary"] = f"{vary}, Accept-Encoding"
+
+    if "gzip" not in accepted_encodings(request_headers.get("accept-encoding")):
+        return response
+
+    response.body = _gzip.compress(body)
+    response.headers["content-encoding"] = "gzip"
+    response.headers["content-length"] = str(len(response.body))
+
+    if "etag" in response.headers:
+        response.headers["etag"] = encoded_etag(response.headers["etag"], "gzip")
+
+    return response
+
+def encoded_etag(etag, encoding):
+    return f'{etag[:-1]}-{encoding}"'
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith("W/") else etag
+
+# Compresses a file with gzip as it streams.  Range requests are not
+# supported on this path.
+
+class GzipFileResponse(StreamingResponse):
+    chunk_size = 256 * 1024
+
+    def __init__(self, path, headers=None, media_type=None, stat_result=None):
+        if stat_result is None:
+            stat_result = _os.stat(path)
+
+        if media_type is None:
+            media_type = _mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        super().__init__(self.compress(path), headers=headers, media_type=media_type)
+
+        self.headers["content-encoding"] = "gzip"
+        self.headers["vary"] = "Accept-Encoding"
+        self.headers["etag"] = "W/" + encoded_etag(self.headers.get("etag", file_etag(stat_result)), "gzip")
+        self.headers["last-modified"] = _email_utils.formatdate(stat_result.st_mtime, usegmt=True)
+
+    async def compress(self, path):
+        compressor = _zlib.compressobj(6, _zlib.DEFLATED, 31)
+        f = await _concurrency.run_in_threadpool(open, path, "rb")
+
+        try:
+            while True:
+                chunk, eof = await _concurrency.run_in_threadpool(self.read_chunk, f, compressor)
+
+                if chunk:
+                    yield chunk
+
+                if eof:
+                    break
+        finally:
+            await _concurrency.run_in_threadpool(f.close)
+
+    def read_chunk(self, f, compressor):
+        data = f.read(self.chunk_size)
+
+        if not data:
+            return compressor.flush(), True
+
+        return compressor.compress(data), False
+
+def file_etag(stat_result):
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+# Returns a list of (start, end) tuples, with end exclusive.  Returns
+# None if the header is malformed and should be ignored, and an empty
+# list if no range is satisfiable.
+def parse_ranges(value, size, max_ranges=100):
+    unit, _, specs = value.partition("=")
+
+    if unit.strip().lower() != "bytes":
+        return None
+
+    specs = [x.strip() for x in specs.split(",") if x.strip()]
+    ranges = list()
+
+    if not specs or len(specs) > max_ranges:
+        return None
+
+    for spec in specs:
+        start, sep, end = spec.partition("-")
+
+        if not sep:
+            return None
+
+        try:
+            if start == "":
+                length = int(end)
+
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size))
+
+                continue
+
+            start = int(start)
+            end = int(end) + 1 if end else None
+        except ValueError:
+            return None
+
+        if start < 0 or (end is not None and end <= start):
+            return None
+
+        if start < size:
+            ranges.append((start, size if end is None else min(end, size)))
+
+    return ranges
+
 _directory_index_template = """
 <html>
   <head>
@@ -166,34 +867,112 @@ _directory_index_template = """
 </html>
 """.strip()
 
-class DirectoryIndexResponse(HtmlResponse):
-    def __init__(self, base_dir, file_path):
-        super().__init__(self.make_index(base_dir, file_path))
+DirectoryEntry = _collections.namedtuple("DirectoryEntry", ("name", "is_dir", "size", "mtime", "sha256"),
+                                         defaults=(False, None, None, None))
+
+# Returns the entries of a directory in name order
+def list_directory(fs_path):
+    entries = list()
+
+    with _os.scandir(fs_path) as scan:
+        for item in scan:
+            stat_result = item.stat()
+            is_dir = item.is_dir()
+            size = None if is_dir else stat_result.st_size
+
+            entries.append(DirectoryEntry(item.name, is_dir, size, stat_result.st_mtime))
 
-    def make_index(self, base_dir, request_path):
+    entries.sort()
+
+    return entries
+
+# A rendered directory listing, in HTML and JSON, with an ETag and a
+# gzip variant for each.  It can be kept and used to answer many
+# requests.
+
+class DirectoryIndex:
+    def __init__(self, request_path, entries):
         assert not request_path.startswith("/")
 
-        if request_path != "/" and request_path.endswith("/"):
+        if request_path.endswith("/"):
             request_path = request_path[:-1]
 
-        fs_path = _os.path.join(base_dir, request_path)
+        self.request_path = request_path
+        self.entries = entries
+
+        self.html = self.make_html().encode("utf-8")
+        self.html_etag = f'"{_hashlib.sha1(self.html).hexdigest()}"'
 
-        assert _os.path.isdir(fs_path), fs_path
+        self.json = self.make_json().encode("utf-8")
+        self.json_etag = f'"{_hashlib.sha1(self.json).hexdigest()}"'
 
-        names = _os.listdir(fs_path)
+        self.html_variants = _gzip_variants(self.html)
+        self.json_variants = _gzip_variants(self.json)
+
+    def make_html(self):
         lines = list()
 
-        if request_path == "":
+        if self.request_path == "":
             lines.append("..")
+        else:
+            lines.append(f"<a href=\"/{_html.escape(self.request_path)}/..\">..</a>")
+
+        for entry in self.entries:
+            href = _html.escape(f"{self.request_path}/{entry.name}".lstrip("/"))
+            label = entry.name + ("/" if entry.is_dir else "")
+            padding = " " * max(1, 50 - len(label))
+            mtime = "" if entry.mtime is None else _time.strftime("%Y-%m-%d %H:%M", _time.gmtime(entry.mtime))
+            size = "-" if entry.size is None else entry.size
 
-            for name in names:
-                lines.append(f"<a href=\"/{name}\">{name}</a>")
+            lines.append(f"<a href=\"/{href}\">{_html.escape(label)}</a>{padding}{mtime:16} {size:>14}")
+
+        return _directory_index_template.format(title=_html.escape(self.request_path), lines="\n".join(lines))
+
+    def make_json(self):
+        entries = list()
+
+        for entry in self.entries:
+            data = {"name": entry.name, "type": "dir" if entry.is_dir else "file"}
+
+            for field in ("size", "mtime", "sha256"):
+                value = getattr(entry, field)
+
+                if value is not None:
+                    data[field] = value
+
+            entries.append(data)
+
+        return _json.dumps({"path": self.request_path, "entries": entries})
+
+    # JSON is chosen by a format=json query parameter or an Accept
+    # header naming application/json
+    def response(self, request):
+        if (request.query_params.get("format") == "json"
+            or "application/json" in request.headers.get("accept", "")):
+            body, etag, variants, media_type = self.json, self.json_etag, self.json_variants, "application/json"
         else:
-            lines.append(f"<a href=\"/{request_path}/..\">..</a>")
+            body, etag, variants, media_type = self.html, self.html_etag, self.html_variants, "text/html"
+
+        headers = {"vary": "Accept, Accept-Encoding" if variants else "Accept", "etag": etag}
+
+        for encoding in accepted_encodings(request.headers.get("accept-encoding")):
+            if encoding in variants:
+                headers["content-encoding"] = encoding
+                headers["etag"] = encoded_etag(etag, encoding)
+
+                return Response(variants[encoding], headers=headers, media_type=media_type)
+
+        return Response(body, headers=headers, media_type=media_type)
+
+# Returns a map of content coding to encoded body, empty if the body is
+# too small to gain from compression
+def _gzip_variants(body):
+    if len(body) < compress_min_size:
+        return dict()
 
-            for name in names:
-                lines.append(f"<a href=\"/{request_path}/{name}\">{name}</a>")
+    variant = _gzip.compress(body)
 
-        html = _directory_index_template.format(title=request_path, lines="\n".join(lines))
+    if len(variant) >= len(body):
+        return dict()
 
-        return html
+    return {"gzip": variant}
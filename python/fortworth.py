@@ -1,4 +1,12 @@
+import base64 as _base64
+import concurrent.futures as _futures
+import fnmatch as _fnmatch
+import hashlib as _hashlib
 import requests as _requests
+import requests.adapters as _requests_adapters
+import tarfile as _tarfile
+import threading as _threading
+import time as _time
 
 from plano import *
 
@@ -126,31 +134,350 @@ def stagger_put_artifact(repo, branch, tag, artifact, artifact_data, service_url
 
     return response.text
 
-def bodega_put_build(build_dir, build_info, service_url=_bodega_url):
+_bodega_chunk_size = 1024 * 1024
+_bodega_put_attempts = 4
+_bodega_retry_delay = 0.5
+_bodega_resumable_size = 64 * 1024 * 1024
+_bodega_upload_chunk_size = 16 * 1024 * 1024
+
+# With archive=False, or if the server does not support bulk upload,
+# files are PUT individually, concurrency at a time.  If the server
+# supports staging, the files are staged and the build is committed at
+# the end, so it becomes visible all at once.
+#
+# A bulk upload of a build that already exists fails with a 409 before
+# any files are sent.  Individual PUTs to an existing build replace its
+# files in place.
+#
+# Files with paths matching one of the exclude patterns are not
+# uploaded.
+def bodega_put_build(build_dir, build_info, service_url=_bodega_url, archive=True, concurrency=8, exclude=()):
     build_url = bodega_build_url(build_info, service_url=service_url)
+    session = _bodega_session(concurrency)
+    progress = _BodegaProgress()
+
+    if archive and _bodega_put_build_archive(session, build_dir, build_url, build_info, progress, exclude):
+        progress.report(final=True)
+        return
+
+    staged = build_info.id is not None and _bodega_supports_staging(session, build_url)
+    executor = _futures.ThreadPoolExecutor(concurrency)
+    futures = list()
+
+    for relative_path in _bodega_find_files(build_dir, exclude):
+        fs_path = join(build_dir, relative_path)
+        request_url = "{0}/{1}".format(build_url, relative_path)
+
+        if build_info.id is None:
+            request_url += "?dry-run=1"
+        elif staged:
+            request_url += "?staged=1"
+
+        futures.append(executor.submit(_bodega_put_file, session, request_url, fs_path, progress))
+
+    try:
+        for future in _futures.as_completed(futures):
+            future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    if staged:
+        response = session.post("{0}?commit".format(build_url))
+        response.raise_for_status()
+
+    progress.report(final=True)
+
+# A build that already exists cannot be staged, and its files are
+# replaced in place as before
+def _bodega_supports_staging(session, build_url):
+    response = session.post("{0}?commit&dry-run=1".format(build_url))
+
+    if response.status_code in (400, 404, 405, 409):
+        return False
+
+    response.raise_for_status()
+
+    return True
+
+def _bodega_session(concurrency):
     session = _requests.Session()
+    adapter = _requests_adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+# Retries on connection failures and server errors, with exponential
+# backoff
+def _bodega_put_file(session, request_url, fs_path, progress):
+    if "dry-run=1" not in request_url and file_size(fs_path) >= _bodega_resumable_size:
+        if _bodega_put_file_resumable(session, request_url, fs_path):
+            progress.add(file_size(fs_path))
+            return
+
+    headers = dict()
+
+    if "dry-run=1" not in request_url:
+        headers["Digest"] = _bodega_digest_header(fs_path)
+
+    for attempt in range(_bodega_put_attempts):
+        last_attempt = attempt == _bodega_put_attempts - 1
+
+        try:
+            with open(fs_path, "rb") as f:
+                response = session.put(request_url, data=f, headers=headers)
+        except (_requests.ConnectionError, _requests.Timeout) as e:
+            if last_attempt:
+                raise
+
+            warn("Failed uploading {0}: {1}", request_url, e)
+        else:
+            if response.status_code < 500 or last_attempt:
+                break
+
+            warn("Failed uploading {0}: {1}", request_url, response.status_code)
+
+        sleep(_bodega_retry_delay * 2 ** attempt)
+
+    response.raise_for_status()
+
+    progress.add(file_size(fs_path))
+
+# Large files are sent in chunks through an upload session.  After a
+# failure, the chunk is sent again from the last offset, and if part of
+# it arrived the server answers with the offset to continue from.
+# Returns False if the server does not support resumable uploads.
+def _bodega_put_file_resumable(session, request_url, fs_path):
+    response = session.post(_bodega_add_query(request_url, "uploads"))
+
+    if response.status_code in (400, 404, 405):
+        return False
+
+    response.raise_for_status()
+
+    upload_url = _bodega_add_query(request_url, "upload={0}".format(response.json()["upload_id"]))
+    size = file_size(fs_path)
+    offset = 0
+    failures = 0
+
+    with open(fs_path, "rb") as f:
+        while offset < size:
+            end = min(offset + _bodega_upload_chunk_size, size)
+            headers = {"Content-Range": "bytes {0}-{1}/{2}".format(offset, end - 1, size)}
+
+            f.seek(offset)
+
+            try:
+                response = session.put(upload_url, data=f.read(end - offset), headers=headers)
+            except (_requests.ConnectionError, _requests.Timeout) as e:
+                error = e
+            else:
+                # A 409 with an offset means the append started at the
+                # wrong place, and the offset is where to resume
+
+                if "Upload-Offset" in response.headers:
+                    new_offset = int(response.headers["Upload-Offset"])
+
+                    if new_offset > offset:
+                        failures = 0
+
+                    offset = new_offset
+                    continue
+
+                if response.status_code != 409 and response.status_code < 500:
+                    response.raise_for_status()
+
+                error = response.status_code
+
+            failures += 1
+
+            if failures == _bodega_put_attempts:
+                raise Exception("Failed uploading {0}: {1}".format(request_url, error))
+
+            warn("Failed uploading {0} at offset {1}: {2}", request_url, offset, error)
+            sleep(_bodega_retry_delay * 2 ** failures)
+
+    response = session.post("{0}&commit".format(upload_url), headers={"Digest": _bodega_digest_header(fs_path)})
+    response.raise_for_status()
+
+    return True
+
+def _bodega_add_query(url, query):
+    return "{0}{1}{2}".format(url, "&" if "?" in url else "?", query)
+
+class _BodegaProgress(object):
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.lock = _threading.Lock()
+        self.start_time = _time.time()
+        self.report_time = self.start_time
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+            if _time.time() - self.report_time >= self.interval:
+                self.report()
+
+    def report(self, final=False):
+        now = _time.time()
+        elapsed = max(now - self.start_time, 0.001)
+        megabytes = self.bytes / (1024 * 1024)
+
+        self.report_time = now
+
+        notice("{0} {1} {2} ({3:.1f} MB) in {4:.1f} s, {5:.1f} MB/s",
+               "Uploaded" if final else "Uploading", self.files, plural("file", self.files),
+               megabytes, elapsed, megabytes / elapsed)
+
+# Uploads the whole build as one tar stream, if the server supports it.
+# Returns False if it does not.
+def _bodega_put_build_archive(session, build_dir, build_url, build_info, progress, exclude=()):
+    request_url = "{0}?format=tar".format(build_url)
+
+    response = session.put("{0}&dry-run=1".format(request_url))
+
+    if response.status_code in (_requests.codes.not_found, _requests.codes.method_not_allowed):
+        return False
+
+    response.raise_for_status()
+
+    if build_info.id is None:
+        return True
+
+    manifest = _bodega_make_manifest(build_dir, exclude)
+    missing = _bodega_get_missing_files(session, build_url, manifest)
+
+    response = session.put(request_url, data=_bodega_tar_stream(build_dir, manifest, missing, progress))
+    response.raise_for_status()
+
+    return True
+
+def _bodega_make_manifest(build_dir, exclude=()):
+    files = list()
+
+    for path in _bodega_find_files(build_dir, exclude):
+        fs_path = join(build_dir, path)
+
+        files.append({
+            "path": path,
+            "size": file_size(fs_path),
+            "sha256": _bodega_file_hash(fs_path).hexdigest(),
+        })
+
+    return {"files": files}
+
+# Returns the paths of the files under the build dir, relative to it
+def _bodega_find_files(build_dir, exclude=()):
+    paths = list()
 
     for fs_path in find(build_dir):
         if is_dir(fs_path):
             continue
 
-        relative_path = fs_path[len(build_dir) + 1:]
-        request_url = "{0}/{1}".format(build_url, relative_path)
+        path = fs_path[len(build_dir) + 1:]
 
-        if build_info.id is None:
-            request_url += "?dry-run=1"
+        if any(_fnmatch.fnmatchcase(path, x) for x in exclude):
+            continue
+
+        paths.append(path)
+
+    return paths
+
+def _bodega_file_hash(fs_path):
+    hash = _hashlib.sha256()
+
+    with open(fs_path, "rb") as f:
+        while True:
+            chunk = f.read(_bodega_chunk_size)
+
+            if not chunk:
+                break
+
+            hash.update(chunk)
+
+    return hash
+
+# The server checks the content it receives against this and rejects
+# the upload if it does not match
+def _bodega_digest_header(fs_path):
+    return "sha-256={0}".format(_base64.b64encode(_bodega_file_hash(fs_path).digest()).decode())
+
+# Returns the set of paths whose content the server does not have
+def _bodega_get_missing_files(session, build_url, manifest):
+    response = session.post("{0}?manifest".format(build_url), json=manifest)
+
+    if response.status_code in (_requests.codes.not_found, _requests.codes.method_not_allowed):
+        return set(x["path"] for x in manifest["files"])
+
+    response.raise_for_status()
+
+    return set(x["path"] for x in response.json()["missing"])
+
+# Files the server already has are sent as empty members that name
+# the content by digest
+def _bodega_tar_stream(build_dir, manifest, missing, progress):
+    for entry in manifest["files"]:
+        fs_path = join(build_dir, entry["path"])
+
+        info = _tarfile.TarInfo(entry["path"])
+        info.mode = 0o644
+
+        if entry["path"] not in missing:
+            info.pax_headers = {"BODEGA.sha256": entry["sha256"]}
+            yield info.tobuf(_tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            progress.add(0)
+            continue
+
+        info.size = entry["size"]
+
+        yield info.tobuf(_tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
 
         with open(fs_path, "rb") as f:
-            response = session.put(request_url, data=f)
-            response.raise_for_status()
+            while True:
+                chunk = f.read(_bodega_chunk_size)
+
+                if not chunk:
+                    break
+
+                yield chunk
 
+        yield bytes(-info.size % _tarfile.BLOCKSIZE)
+
+        progress.add(info.size)
+
+    yield bytes(2 * _tarfile.BLOCKSIZE)
+
+# Only committed builds exist.  Servers without the meta query are
+# asked for the build listing instead.
 def bodega_build_exists(build_info, service_url=_bodega_url):
     build_url = bodega_build_url(build_info, service_url=service_url)
 
-    response = _requests.get(build_url)
+    response = _requests.head("{0}?meta".format(build_url))
+
+    if response.status_code in (_requests.codes.bad_request, _requests.codes.method_not_allowed):
+        response = _requests.get(build_url)
 
     return response.status_code == _requests.codes.ok
 
+# Returns the file count, total bytes, and manifest digest of the build,
+# with other details, or None if the build does not exist
+def bodega_get_build_meta(build_info, service_url=_bodega_url):
+    build_url = bodega_build_url(build_info, service_url=service_url)
+
+    response = _requests.get("{0}?meta".format(build_url))
+
+    if response.status_code == _requests.codes.not_found:
+        return None
+
+    response.raise_for_status()
+
+    return response.json()
+
 def bodega_build_url(build_info, service_url=_bodega_url):
     assert service_url
     return "{0}/{1}/{2}/{3}".format(service_url, build_info.repo, build_info.branch, build_info.id)
@@ -200,7 +527,8 @@ def rpm_build(spec_file, source_dir, build_dir, build_info):
     git_make_archive(source_dir, join(build_dir, "SOURCES"), archive_stem)
     call("rpmbuild -D '_topdir {0}' -ba {1}", get_absolute_path(build_dir), spec_file)
     copy(rpms_dir, yum_repo_dir)
-    call("createrepo {0}", yum_repo_dir)
+
+    # Bodega generates the repodata when the build is published
     write(yum_repo_file, yum_repo_config)
 
 def rpm_publish(spec_file, source_dir, build_dir, build_info, tag):
@@ -296,13 +624,17 @@ def _make_settings_file(repo_urls):
 
     return write(make_temp_file(), xml)
 
+# Bodega generates checksums and metadata from the artifacts, so the
+# local copies are not uploaded
+_maven_generated_files = ("repo/*.sha1", "repo/*.md5", "repo/*/maven-metadata*.xml")
+
 def maven_publish(source_dir, build_dir, build_info, tag):
     # Skip developer test builds
     if build_info.id is None:
         return
 
     if not bodega_build_exists(build_info):
-        bodega_put_build(build_dir, build_info)
+        bodega_put_build(build_dir, build_info, exclude=_maven_generated_files)
 
     tag_data = _maven_make_tag_data(source_dir, build_dir, build_info)
 